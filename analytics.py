@@ -0,0 +1,226 @@
+import os
+import glob
+import uuid
+import hashlib
+import datetime
+import threading
+import pandas as pd
+
+from rule_engine import clean_name, volume_cl
+from storage import data_path, load_invoice, saved_invoice_hashes
+from supplier_parsers import to_number
+
+# ==========================================
+# PRICE ANALYTICS (Finalised lines -> Parquet, queried with DuckDB)
+# ==========================================
+# data/lines/year=YYYY/month=MM/<invoice>-<stamp>.parquet, partitioned by issue date.
+# Re-saving an invoice adds a newer file; the `lines` view keeps only the latest
+# ingest per invoice, and compaction folds a month's small files into one.
+
+LINES_DIR = "lines"
+PRICE_DEVIATION = 0.10      # flag prices more than 10% off the product's median
+PRICE_MIN_HISTORY = 2       # invoices needed before a line can be flagged
+COMPACT_AT_FILES = 20       # per month partition
+HISTORY_LIMIT = 5000
+
+LINE_SCHEMA = {
+    "invoice_key": str, "pdf_hash": str, "supplier": str, "invoice_number": str,
+    "issue_date": "datetime64[ns]", "ingested_at": "datetime64[ns]", "source": str,
+    "brewery": str, "product": str, "product_key": str, "format": str, "pack_size": float, "volume": str,
+    "litres": float, "quantity": float, "item_price": float, "landed_price": float, "landed_per_litre": float,
+}
+
+_write_lock = threading.Lock()
+
+def duckdb_connect():
+    import duckdb    # only loaded once analytics are used
+    return duckdb.connect()
+
+def lines_root():
+    return data_path(LINES_DIR)
+
+def parquet_files():
+    return glob.glob(os.path.join(lines_root(), "year=*", "month=*", "*.parquet"))
+
+def store_signature():
+    """Changes whenever a file is added or compacted; use it as a cache key for query results."""
+    files = parquet_files()
+    return len(files), max((os.path.getmtime(f) for f in files), default=0)
+
+def product_key(brewery, product, fmt, litres):
+    name = clean_name(str(product or "")).lower()
+    return f"{str(brewery or '').strip().lower()}|{name}|{fmt or ''}|{round(litres, 1) if litres else ''}"
+
+def invoice_key(header, pdf_hash=""):
+    if pdf_hash: return pdf_hash
+    raw = f"{header.get('Payable_To', '')}|{header.get('Invoice_Number', '')}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def parse_issue_date(value):
+    d = pd.to_datetime(value, dayfirst=True, errors="coerce")
+    return d if pd.notna(d) else pd.Timestamp(datetime.date.today())
+
+def unit_litres(row):
+    """Litres bought per unit of Item_Price (pack size x unit volume)."""
+    cl = volume_cl(row.get("Format"), row.get("Volume"))
+    if not cl: return None
+    pack = to_number(row.get("Pack_Size"))
+    return cl / 100 * (pack if pack and pd.notna(pack) else 1)
+
+def analytics_frame(header_df, lines_df, pdf_hash="", source="export"):
+    """One row per priced line, with shipping/discount spread over the lines by value."""
+    header = header_df.iloc[0].to_dict() if not header_df.empty else {}
+    rows = []
+    for _, r in lines_df.iterrows():
+        price, qty = to_number(r.get("Item_Price")), to_number(r.get("Quantity"))
+        if price is None or not qty: continue
+        rows.append((r, price, qty))
+    if not rows: return pd.DataFrame(columns=list(LINE_SCHEMA))
+
+    goods = sum(p * q for _, p, q in rows)
+    extras = (to_number(header.get("Shipping_Charge")) or 0) - (to_number(header.get("Total_Discount_Amount")) or 0)
+    landed_factor = (goods + extras) / goods if goods else 1.0
+    key, issued, stamp = invoice_key(header, pdf_hash), parse_issue_date(header.get("Issue_Date")), pd.Timestamp.now()
+
+    out = []
+    for r, price, qty in rows:
+        litres = unit_litres(r)
+        landed = price * landed_factor
+        out.append({
+            "invoice_key": key, "pdf_hash": pdf_hash or "", "supplier": str(header.get("Payable_To", "") or ""),
+            "invoice_number": str(header.get("Invoice_Number", "") or ""), "issue_date": issued, "ingested_at": stamp,
+            "source": source, "brewery": str(r.get("Supplier_Name", "") or ""), "product": str(r.get("Product_Name", "") or ""),
+            "product_key": product_key(r.get("Supplier_Name"), r.get("Product_Name"), r.get("Format"), litres),
+            "format": str(r.get("Format", "") or ""), "pack_size": to_number(r.get("Pack_Size")),
+            "volume": str(r.get("Volume", "") or ""), "litres": litres, "quantity": qty, "item_price": price,
+            "landed_price": round(landed, 4), "landed_per_litre": round(landed / litres, 4) if litres else None,
+        })
+    return pd.DataFrame(out).astype(LINE_SCHEMA)
+
+def _write_parquet(df, path):
+    con = duckdb_connect()
+    try:
+        con.register("batch", df)
+        tmp = f"{path}.tmp"
+        con.execute(f"COPY batch TO '{tmp}' (FORMAT PARQUET)")
+        os.replace(tmp, path)
+    finally:
+        con.close()
+
+def append_invoice_lines(header_df, lines_df, pdf_hash="", source="export"):
+    """Adds a finalised invoice to the store. Returns the number of lines written."""
+    df = analytics_frame(header_df, lines_df, pdf_hash, source)
+    if df.empty: return 0
+    issued = df["issue_date"].iloc[0]
+    folder = os.path.join(lines_root(), f"year={issued.year}", f"month={issued.month:02d}")
+    with _write_lock:
+        os.makedirs(folder, exist_ok=True)
+        _write_parquet(df, os.path.join(folder, f"{df['invoice_key'].iloc[0][:16]}-{uuid.uuid4().hex[:8]}.parquet"))
+        if len(glob.glob(os.path.join(folder, "*.parquet"))) >= COMPACT_AT_FILES: compact_partition(folder)
+    return len(df)
+
+def compact_partition(folder):
+    """Rewrites a month partition as one file holding only the latest ingest per invoice."""
+    files = glob.glob(os.path.join(folder, "*.parquet"))
+    if len(files) < 2: return 0
+    con = duckdb_connect()
+    try:
+        file_list = ", ".join(f"'{f}'" for f in files)
+        merged = con.execute(f"""
+            SELECT * FROM read_parquet([{file_list}], union_by_name = true)
+            QUALIFY ingested_at = max(ingested_at) OVER (PARTITION BY invoice_key)
+        """).df()
+    finally:
+        con.close()
+    _write_parquet(merged, os.path.join(folder, f"compacted-{uuid.uuid4().hex[:8]}.parquet"))
+    for f in files: os.remove(f)
+    return len(files)
+
+def stored_invoice_keys():
+    found = query("SELECT DISTINCT invoice_key FROM lines")
+    return set(found["invoice_key"]) if not found.empty else set()
+
+def backfill_from_history():
+    """
+    Loads the invoices saved in the history store that are not in the price store yet.
+    Invoices already there (e.g. recorded at export, with the buyer's edits) are left alone.
+    Returns (invoices, lines) written.
+    """
+    invoices, lines = 0, 0
+    stored = stored_invoice_keys()
+    for pdf_hash in saved_invoice_hashes():
+        if pdf_hash in stored: continue
+        saved = load_invoice(pdf_hash)
+        if not saved: continue
+        n = append_invoice_lines(saved[0], saved[1], pdf_hash, source="history")
+        invoices += bool(n)
+        lines += n
+    return invoices, lines
+
+# --- QUERIES ---
+def query(sql, params=None):
+    """Runs sql against the `lines` view (latest ingest per invoice). Empty frame if no data yet."""
+    if not parquet_files(): return pd.DataFrame()
+    con = duckdb_connect()
+    try:
+        pattern = os.path.join(lines_root(), "year=*", "month=*", "*.parquet")
+        con.execute(f"""
+            CREATE VIEW lines AS
+            SELECT * EXCLUDE (year, month) FROM read_parquet('{pattern}', hive_partitioning = true, union_by_name = true)
+            QUALIFY ingested_at = max(ingested_at) OVER (PARTITION BY invoice_key)
+        """)
+        return con.execute(sql, params or []).df()
+    finally:
+        con.close()
+
+def product_price_summary(search=""):
+    """Per product/format: invoices, first/last seen, last/median/min/max price and landed £/L."""
+    return query("""
+        SELECT brewery AS Brewery, product AS Product, format AS Format, volume AS Volume,
+               count(DISTINCT invoice_key) AS Invoices, min(issue_date)::DATE AS First_Seen, max(issue_date)::DATE AS Last_Seen,
+               arg_max(item_price, issue_date) AS Last_Price, median(item_price) AS Median_Price,
+               min(item_price) AS Min_Price, max(item_price) AS Max_Price,
+               arg_max(landed_per_litre, issue_date) AS Last_Landed_Per_L, product_key
+        FROM lines
+        WHERE ? = '' OR lower(product) LIKE '%' || lower(?) || '%' OR lower(brewery) LIKE '%' || lower(?) || '%'
+        GROUP BY ALL ORDER BY Last_Seen DESC, Brewery, Product
+        LIMIT ?
+    """, [search, search, search, HISTORY_LIMIT])
+
+def price_history(product_keys):
+    """Every purchase of the given product keys, oldest first."""
+    if not product_keys: return pd.DataFrame()
+    marks = ", ".join("?" * len(product_keys))
+    return query(f"""
+        SELECT issue_date::DATE AS Date, brewery AS Brewery, product AS Product, format AS Format, volume AS Volume,
+               supplier AS Supplier, invoice_number AS Invoice_Number, quantity AS Quantity,
+               item_price AS Item_Price, landed_price AS Landed_Price, landed_per_litre AS Landed_Per_L, product_key
+        FROM lines WHERE product_key IN ({marks}) ORDER BY issue_date
+    """, list(product_keys))
+
+def price_flags(header_df, lines_df, pdf_hash=""):
+    """
+    Ingest-time check: one label per line ('' when fine or no history). Compares Item_Price
+    with the median of earlier invoices for the same product/format/size.
+    """
+    labels = pd.Series("", index=lines_df.index, dtype=object)
+    df = analytics_frame(header_df, lines_df, pdf_hash)
+    if df.empty or not parquet_files(): return labels
+    keys = sorted(set(df["product_key"]))
+    marks = ", ".join("?" * len(keys))
+    stats = query(f"""
+        SELECT product_key, median(item_price) AS median_price, count(DISTINCT invoice_key) AS n
+        FROM lines WHERE product_key IN ({marks}) AND invoice_key <> ?
+        GROUP BY product_key
+    """, keys + [df["invoice_key"].iloc[0]])
+    if stats.empty: return labels
+    by_key = {r.product_key: (r.median_price, r.n) for r in stats.itertuples()}
+
+    priced = [i for i, r in lines_df.iterrows() if to_number(r.get("Item_Price")) is not None and to_number(r.get("Quantity"))]
+    for idx, (_, r) in zip(priced, df.iterrows()):
+        median, n = by_key.get(r["product_key"], (None, 0))
+        if not median or n < PRICE_MIN_HISTORY: continue
+        change = r["item_price"] / median - 1
+        if abs(change) > PRICE_DEVIATION:
+            labels[idx] = f"{'⬆️' if change > 0 else '⬇️'} {change:+.0%} vs £{median:.2f} median ({n} invoices)"
+    return labels
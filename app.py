@@ -1,24 +1,5 @@
 import streamlit as st
-import pandas as pd
-from pdf2image import convert_from_bytes
-import pytesseract
-from google import genai
-import json
-import re
-import io
-import requests
-import time
 import warnings
-from urllib.parse import quote
-from urllib.request import Request, urlopen
-from streamlit_gsheets import GSheetsConnection
-from thefuzz import process, fuzz
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-
-# Import the Brain
-from knowledge_base import GLOBAL_RULES_TEXT, SUPPLIER_RULEBOOK
 
 # --- SUPPRESS GOOGLE WARNING ---
 warnings.filterwarnings("ignore", category=FutureWarning, module="google.generativeai")
@@ -43,505 +24,41 @@ def check_password():
 
 if not check_password(): st.stop()
 
+# Pipeline imports come after the login gate so the password page renders on a cold
+# start without pandas. Google Drive, Gemini and the OCR stack load lazily on first use.
+import pandas as pd
+import re
+
+# Import the Brain & the Pipeline
+from integrations import (
+    list_files_in_folder, download_file_from_drive, batch_untappd_lookup,
+    fetch_all_cin7_suppliers_cached, Cin7SupplierIndex, create_cin7_purchase_order, get_master_supplier_list,
+    bulk_create_cin7_purchase_orders, LOCATIONS, SPLIT_LOCATION, bulk_create_shopify_products
+)
+from reconciliation import (
+    run_reconciliation_check, create_product_matrix, remember_confirmed_matches, MAX_FORMATS, FINGERPRINT_COL,
+    matrix_to_new_products, apply_created_products
+)
+from ocr import AUTO_PROFILE
+from knowledge_base import SUPPLIER_RULEBOOK, MODEL_TIERS, TIER_ORDER
+from extraction import compare_extraction_modes, EXTRACTION_MODE_LABELS, AUTO_TIER, get_genai_client
+from pipeline import process_pdf
+from ocr_pool import OcrError
+from image_cache import with_thumbnails
+from analytics import (
+    append_invoice_lines, product_price_summary, price_history, backfill_from_history, store_signature
+)
+from storage import list_exports, pdf_hashes, save_invoice, find_invoice, load_invoice, processed_drive_files
+
 st.title("Brewery Invoice Parser ⚡")
 
 # ==========================================
 # 1. HELPER FUNCTIONS
 # ==========================================
-
-# --- 1A. GOOGLE DRIVE ---
-def get_drive_service():
-    if "connections" in st.secrets and "gsheets" in st.secrets["connections"]:
-        creds_dict = st.secrets["connections"]["gsheets"]
-        creds = service_account.Credentials.from_service_account_info(
-            creds_dict, scopes=['https://www.googleapis.com/auth/drive.readonly']
-        )
-        return build('drive', 'v3', credentials=creds)
-    return None
-
-def list_files_in_folder(folder_id):
-    service = get_drive_service()
-    if not service: return []
-    try:
-        query = f"'{folder_id}' in parents and mimeType='application/pdf' and trashed=false"
-        results = service.files().list(q=query, pageSize=100, fields="files(id, name)").execute()
-        files = results.get('files', [])
-        files.sort(key=lambda x: x['name'].lower())
-        return files
-    except Exception as e:
-        st.error(f"Drive List Error: {e}")
-        return []
-
-def download_file_from_drive(file_id):
-    service = get_drive_service()
-    if not service: return None
-    try:
-        request = service.files().get_media(fileId=file_id)
-        file_stream = io.BytesIO()
-        downloader = MediaIoBaseDownload(file_stream, request)
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
-        file_stream.seek(0)
-        return file_stream
-    except Exception as e:
-        st.error(f"Download Error: {e}")
-        return None
-
-# --- 1B. UNTAPPD LOGIC ---
-def search_untappd_item(supplier, product):
-    if "untappd" not in st.secrets: return None
-    creds = st.secrets["untappd"]
-    base_url = creds.get("base_url", "https://business.untappd.com/api/v1")
-    token = creds.get("api_token")
-    
-    query_str = f"{supplier} {product}".replace(" ", "-")
-    safe_q = quote(query_str)
-    url = f"{base_url}/items/search?q={safe_q}"
-    
-    headers = {"Authorization": f"Basic {token}", "Content-Type": "application/json"}
-    
-    try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            data = response.json()
-            items = data.get('items', [])
-            if items:
-                best = items[0] 
-                return {
-                    "untappd_id": best.get("untappd_id"),
-                    "name": best.get("name"),
-                    "brewery": best.get("brewery"),
-                    "abv": best.get("abv"),
-                    "description": best.get("description"),
-                    "label_image_thumb": best.get("label_image_thumb"),
-                    "brewery_location": best.get("brewery_location")
-                }
-    except: pass
-    return None
-
-def batch_untappd_lookup(matrix_df):
-    if matrix_df.empty: return matrix_df, ["Matrix Empty"]
-    
-    cols = ['Untappd_Status', 'Untappd_ID', 'Untappd_Brewery', 'Untappd_Product', 
-            'Untappd_ABV', 'Untappd_Desc', 'Label_Thumb', 'Brewery_Loc']
-    
-    for c in cols:
-        if c not in matrix_df.columns: matrix_df[c] = ""
-            
-    updated_rows = []
-    logs = []
-    prog_bar = st.progress(0)
-    
-    for idx, row in matrix_df.iterrows():
-        prog_bar.progress((idx + 1) / len(matrix_df))
-        
-        current_id = str(row.get('Untappd_ID', '')).strip()
-        if not current_id or current_id == 'nan':
-            res = search_untappd_item(row['Supplier_Name'], row['Product_Name'])
-            if res:
-                logs.append(f"✅ Found: {res['name']}")
-                row['Untappd_Status'] = "✅ Found"
-                row['Untappd_ID'] = res['untappd_id']
-                row['Untappd_Brewery'] = res['brewery']
-                row['Untappd_Product'] = res['name']
-                row['Untappd_ABV'] = res['abv']
-                row['Untappd_Desc'] = res['description']
-                row['Label_Thumb'] = res['label_image_thumb']
-                row['Brewery_Loc'] = res['brewery_location']
-            else:
-                row['Untappd_Status'] = "❌ Not Found"
-                logs.append(f"❌ No match: {row['Product_Name']}")
-        
-        updated_rows.append(row)
-        
-    return pd.DataFrame(updated_rows), logs
-
-# --- 1C. SHOPIFY & CIN7 ---
-def get_cin7_headers():
-    if "cin7" not in st.secrets: return None
-    creds = st.secrets["cin7"]
-    return {
-        "api-auth-accountid": creds.get("account_id"),
-        "api-auth-applicationkey": creds.get("api_key"),
-        "Content-Type": "application/json"
-    }
-
-def get_cin7_base_url():
-    if "cin7" not in st.secrets: return None
-    return st.secrets["cin7"].get("base_url", "https://inventory.dearsystems.com/ExternalApi/v2")
-
-@st.cache_data(ttl=3600) 
-def fetch_all_cin7_suppliers_cached():
-    if "cin7" not in st.secrets: return []
-    creds = st.secrets["cin7"]
-    headers = {
-        'Content-Type': 'application/json',
-        'api-auth-accountid': creds.get("account_id"),
-        'api-auth-applicationkey': creds.get("api_key")
-    }
-    base_url = creds.get("base_url", "https://inventory.dearsystems.com/ExternalApi/v2")
-    all_suppliers = []
-    page = 1
-    try:
-        while True:
-            url = f"{base_url}/supplier?Page={page}&Limit=100"
-            req = Request(url, headers=headers)
-            with urlopen(req) as response:
-                if response.getcode() == 200:
-                    data = json.loads(response.read())
-                    key = "SupplierList" if "SupplierList" in data else "Suppliers"
-                    if key in data and data[key]:
-                        for s in data[key]:
-                            all_suppliers.append({"Name": s["Name"], "ID": s["ID"]})
-                        if len(data[key]) < 100: break
-                        page += 1
-                    else: break
-                else: break
-    except: pass
-    return sorted(all_suppliers, key=lambda x: x['Name'].lower())
-
-def get_cin7_product_id(sku):
-    headers = get_cin7_headers()
-    if not headers: return None
-    url = f"{get_cin7_base_url()}/product"
-    params = {"Sku": sku}
-    try:
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code == 200:
-            data = response.json()
-            if "Products" in data and len(data["Products"]) > 0:
-                return data["Products"][0]["ID"]
-    except: pass
-    return None
-
-def get_cin7_supplier(name):
-    headers = get_cin7_headers()
-    if not headers: return None
-    safe_name = quote(name)
-    url = f"{get_cin7_base_url()}/supplier?Name={safe_name}"
-    try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            data = response.json()
-            if "Suppliers" in data and len(data["Suppliers"]) > 0:
-                return data["Suppliers"][0]
-    except: pass
-    if "&" in name: return get_cin7_supplier(name.replace("&", "and"))
-    return None
-
-def create_cin7_purchase_order(header_df, lines_df, location_choice):
-    headers = get_cin7_headers()
-    if not headers: return False, "Cin7 Secrets missing.", []
-    logs = []
-    
-    supplier_id = None
-    if 'Cin7_Supplier_ID' in header_df.columns and header_df.iloc[0]['Cin7_Supplier_ID']:
-        supplier_id = header_df.iloc[0]['Cin7_Supplier_ID']
-    else:
-        supplier_name = header_df.iloc[0]['Payable_To']
-        supplier_data = get_cin7_supplier(supplier_name)
-        if supplier_data: supplier_id = supplier_data['ID']
-
-    if not supplier_id: return False, "Supplier not linked.", logs
-
-    order_lines = []
-    id_col = 'Cin7_London_ID' if location_choice == 'London' else 'Cin7_Glou_ID'
-    
-    for _, row in lines_df.iterrows():
-        prod_id = row.get(id_col)
-        # --- UPDATE: Check for "✅ Match" ---
-        if row.get('Shopify_Status') == "✅ Match" and pd.notna(prod_id) and str(prod_id).strip():
-            qty = float(row.get('Quantity', 0))
-            price = float(row.get('Item_Price', 0))
-            total = round(qty * price, 2)
-            
-            order_lines.append({
-                "ProductID": prod_id, 
-                "Quantity": qty, 
-                "Price": price, 
-                "Total": total,
-                "TaxRule": "20% (VAT on Expenses)",
-                "Discount": 0,
-                "Tax": 0
-            })
-
-    if not order_lines: return False, "No valid lines found.", logs
-
-    url_create = f"{get_cin7_base_url()}/advanced-purchase"
-    payload_header = {
-        "SupplierID": supplier_id,
-        "Location": location_choice,
-        "Date": pd.to_datetime('today').strftime('%Y-%m-%d'),
-        "TaxRule": "20% (VAT on Expenses)",
-        "Approach": "Stock",
-        "BlindReceipt": False,
-        "PurchaseType": "Advanced",
-        "Status": "ORDERING",
-        "SupplierInvoiceNumber": str(header_df.iloc[0].get('Invoice_Number', ''))
-    }
-    
-    task_id = None
-    try:
-        r1 = requests.post(url_create, headers=headers, json=payload_header)
-        if r1.status_code == 200:
-            task_id = r1.json().get('ID')
-        else: return False, f"Header Error: {r1.text}", logs
-    except Exception as e: return False, f"Header Ex: {e}", logs
-
-    if task_id:
-        url_lines = f"{get_cin7_base_url()}/purchase/order"
-        payload_lines = {
-            "TaskID": task_id,
-            "CombineAdditionalCharges": False,
-            "Memo": "Streamlit Import",
-            "Status": "DRAFT", 
-            "Lines": order_lines,
-            "AdditionalCharges": []
-        }
-        try:
-            r2 = requests.post(url_lines, headers=headers, json=payload_lines)
-            if r2.status_code == 200:
-                return True, f"✅ PO Created! ID: {task_id}", logs
-            else: return False, f"Line Error: {r2.text}", logs
-        except Exception as e: return False, f"Lines Ex: {e}", logs
-            
-    return False, "Unknown Error", logs
-
-def fetch_shopify_products_by_vendor(vendor):
-    if "shopify" not in st.secrets: return []
-    if not vendor or not isinstance(vendor, str): return []
-    
-    creds = st.secrets["shopify"]
-    shop_url = creds.get("shop_url")
-    token = creds.get("access_token")
-    version = creds.get("api_version", "2024-04")
-    endpoint = f"https://{shop_url}/admin/api/{version}/graphql.json"
-    headers = {"X-Shopify-Access-Token": token, "Content-Type": "application/json"}
-    query = """query ($query: String!, $cursor: String) { products(first: 50, query: $query, after: $cursor) { pageInfo { hasNextPage endCursor } edges { node { id title status format_meta: metafield(namespace: "custom", key: "Format") { value } abv_meta: metafield(namespace: "custom", key: "ABV") { value } variants(first: 20) { edges { node { id title sku inventoryQuantity } } } } } } }"""
-    search_vendor = vendor.replace("'", "\\'") 
-    variables = {"query": f"vendor:'{search_vendor}'"} 
-    
-    all_products = []
-    cursor = None
-    has_next = True
-    
-    while has_next:
-        vars_curr = variables.copy()
-        if cursor: vars_curr['cursor'] = cursor
-        try:
-            response = requests.post(endpoint, json={"query": query, "variables": vars_curr}, headers=headers)
-            if response.status_code == 200:
-                data = response.json()
-                if "data" in data and "products" in data["data"]:
-                    p_data = data["data"]["products"]
-                    all_products.extend(p_data["edges"])
-                    has_next = p_data["pageInfo"]["hasNextPage"]
-                    cursor = p_data["pageInfo"]["endCursor"]
-                else: has_next = False
-            else: has_next = False
-        except: has_next = False
-            
-    return all_products
-
-def normalize_vol_string(v_str):
-    if not v_str: return "0"
-    v_str = str(v_str).lower().strip()
-    nums = re.findall(r'\d+\.?\d*', v_str)
-    if not nums: return "0"
-    val = float(nums[0])
-    if "ml" in v_str: val = val / 10
-    if val.is_integer(): return str(int(val))
-    return str(val)
-
-def run_reconciliation_check(lines_df):
-    if lines_df.empty: return lines_df, ["No Lines to check."]
-    logs = []
-    df = lines_df.copy()
-    
-    df['Shopify_Status'] = "Pending"
-    df['Matched_Product'] = ""
-    df['Matched_Variant'] = "" 
-    df['Image'] = ""
-    df['London_SKU'] = ""     
-    df['Cin7_London_ID'] = "" 
-    df['Gloucester_SKU'] = "" 
-    df['Cin7_Glou_ID'] = ""   
-    
-    suppliers = [s for s in df['Supplier_Name'].unique() if isinstance(s, str) and s.strip()]
-    shopify_cache = {}
-    
-    progress_bar = st.progress(0)
-    for i, supplier in enumerate(suppliers):
-        progress_bar.progress((i)/len(suppliers))
-        logs.append(f"🔎 **Fetching Shopify Data:** `{supplier}`")
-        products = fetch_shopify_products_by_vendor(supplier)
-        shopify_cache[supplier] = products
-        logs.append(f"   -> Found {len(products)} products.")
-    progress_bar.progress(1.0)
-
-    results = []
-    for _, row in df.iterrows():
-        status = "❓ Vendor Not Found"
-        london_sku, glou_sku, cin7_l_id, cin7_g_id, img_url = "", "", "", "", ""
-        matched_prod_name, matched_var_name = "", ""
-        
-        supplier = str(row.get('Supplier_Name', ''))
-        inv_prod_name = row['Product_Name']
-        raw_pack = str(row.get('Pack_Size', '')).strip()
-        inv_pack = "1" if raw_pack.lower() in ['none', 'nan', '', '0'] else raw_pack.replace('.0', '')
-        inv_vol = normalize_vol_string(row.get('Volume', ''))
-        inv_fmt = str(row.get('Format', '')).lower()
-        
-        logs.append(f"Checking: **{inv_prod_name}** ({inv_fmt})")
-
-        if supplier in shopify_cache and shopify_cache[supplier]:
-            candidates = shopify_cache[supplier]
-            scored_candidates = []
-            for edge in candidates:
-                prod = edge['node']
-                shop_title_full = prod['title']
-                shop_prod_name_clean = shop_title_full
-                if "/" in shop_title_full:
-                    parts = [p.strip() for p in shop_title_full.split("/")]
-                    if len(parts) >= 2: shop_prod_name_clean = parts[1]
-                score = fuzz.token_sort_ratio(inv_prod_name, shop_prod_name_clean)
-                if inv_prod_name.lower() in shop_prod_name_clean.lower(): score += 10
-                if score > 40: scored_candidates.append((score, prod, shop_prod_name_clean))
-            
-            scored_candidates.sort(key=lambda x: x[0], reverse=True)
-            match_found = False
-            
-            for score, prod, clean_name in scored_candidates:
-                if score < 75: continue 
-                
-                shop_fmt_meta = prod.get('format_meta', {}).get('value', '') or ""
-                shop_title_lower = prod['title'].lower()
-                shop_format_str = f"{shop_fmt_meta} {shop_title_lower}".lower()
-                
-                is_compatible = True
-                if "steel" in inv_fmt:
-                    if "keykeg" in shop_format_str or "poly" in shop_format_str or "dolium" in shop_format_str: is_compatible = False
-                elif "keykeg" in inv_fmt:
-                    if "steel" in shop_format_str or "stainless" in shop_format_str: is_compatible = False
-                elif "cask" in inv_fmt or "firkin" in inv_fmt:
-                    if "keg" in shop_format_str and "cask" not in shop_format_str: is_compatible = False
-                
-                if not is_compatible: continue
-
-                for v_edge in prod['variants']['edges']:
-                    variant = v_edge['node']
-                    v_title = variant['title'].lower()
-                    v_sku = str(variant.get('sku', '')).strip()
-                    pack_ok = False
-                    if inv_pack == "1":
-                        if " x " not in v_title: pack_ok = True
-                    else:
-                        if f"{inv_pack} x" in v_title or f"{inv_pack}x" in v_title: pack_ok = True
-                    vol_ok = False
-                    if inv_vol in v_title: vol_ok = True
-                    if len(inv_vol) == 2 and f"{inv_vol}0" in v_title: vol_ok = True 
-                    if inv_vol == "9" and "firkin" in v_title: vol_ok = True
-                    if (inv_vol == "4" or inv_vol == "4.5") and "pin" in v_title: vol_ok = True
-                    if (inv_vol == "40" or inv_vol == "41") and "firkin" in v_title: vol_ok = True
-                    if (inv_vol == "20" or inv_vol == "21") and "pin" in v_title: vol_ok = True
-                    
-                    if pack_ok and vol_ok:
-                        logs.append(f"   ✅ MATCH: `{variant['title']}` | SKU: `{v_sku}`")
-                        # --- UPDATE: GREEN STATUS ---
-                        status = "✅ Match"
-                        match_found = True
-                        full_title = prod['title']
-                        matched_prod_name = full_title[2:] if full_title.startswith("L-") or full_title.startswith("G-") else full_title
-                        matched_var_name = variant['title']
-                        if prod.get('featuredImage'): img_url = prod['featuredImage']['url']
-                        if v_sku and len(v_sku) > 2:
-                            base_sku = v_sku[2:]
-                            london_sku = f"L-{base_sku}"
-                            glou_sku = f"G-{base_sku}"
-                        break
-                if match_found: break
-            
-            # --- UPDATE: RED STATUS ---
-            if not match_found: 
-                status = "🟥 Check and Upload"
-        
-        if london_sku: cin7_l_id = get_cin7_product_id(london_sku)
-        if glou_sku: cin7_g_id = get_cin7_product_id(glou_sku)
-
-        row['Shopify_Status'] = status
-        row['Matched_Product'] = matched_prod_name
-        row['Matched_Variant'] = matched_var_name
-        row['Image'] = img_url
-        row['London_SKU'] = london_sku
-        row['Cin7_London_ID'] = cin7_l_id
-        row['Gloucester_SKU'] = glou_sku
-        row['Cin7_Glou_ID'] = cin7_g_id
-        results.append(row)
-    
-    return pd.DataFrame(results), logs
-
-def get_master_supplier_list():
-    try:
-        conn = st.connection("gsheets", type=GSheetsConnection)
-        df = conn.read(worksheet="MasterData", ttl=600)
-        return df['Supplier_Master'].dropna().astype(str).tolist()
-    except: return []
-
-def normalize_supplier_names(df, master_list):
-    if df is None or df.empty or not master_list: return df
-    def match_name(name):
-        if not isinstance(name, str): return name
-        match, score = process.extractOne(name, master_list)
-        return match if score >= 88 else name
-    if 'Supplier_Name' in df.columns:
-        df['Supplier_Name'] = df['Supplier_Name'].apply(match_name)
-    return df
-
-def clean_product_names(df):
-    if df is None or df.empty: return df
-    def cleaner(name):
-        if not isinstance(name, str): return name
-        name = name.replace('|', '')
-        name = re.sub(r'\b\d+x\d+cl\b', '', name, flags=re.IGNORECASE)
-        name = re.sub(r'\b\d+g\b', '', name, flags=re.IGNORECASE)
-        return ' '.join(name.split())
-    if 'Product_Name' in df.columns:
-        df['Product_Name'] = df['Product_Name'].apply(cleaner)
-    return df
-
-def create_product_matrix(df):
-    if df is None or df.empty: return pd.DataFrame()
-    df = df.fillna("")
-    # --- UPDATE: Check for "✅ Match" ---
-    if 'Shopify_Status' in df.columns:
-        df = df[df['Shopify_Status'] != "✅ Match"]
-    if df.empty: return pd.DataFrame()
-
-    group_cols = ['Supplier_Name', 'Collaborator', 'Product_Name', 'ABV']
-    grouped = df.groupby(group_cols, sort=False)
-    matrix_rows = []
-    
-    for name, group in grouped:
-        row = {'Supplier_Name': name[0], 'Collaborator': name[1], 'Product_Name': name[2], 'ABV': name[3]}
-        for i, (_, item) in enumerate(group.iterrows()):
-            if i >= 3: break
-            suffix = str(i + 1)
-            row[f'Format{suffix}'] = item['Format']
-            row[f'Pack_Size{suffix}'] = item['Pack_Size']
-            row[f'Volume{suffix}'] = item['Volume']
-            row[f'Item_Price{suffix}'] = item['Item_Price']
-            row[f'Create{suffix}'] = False 
-        matrix_rows.append(row)
-        
-    matrix_df = pd.DataFrame(matrix_rows)
-    base_cols = ['Supplier_Name', 'Collaborator', 'Product_Name', 'ABV']
-    format_cols = []
-    for i in range(1, 4):
-        format_cols.extend([f'Format{i}', f'Pack_Size{i}', f'Volume{i}', f'Item_Price{i}', f'Create{i}'])
-    final_cols = base_cols + [c for c in format_cols if c in matrix_df.columns]
-    return matrix_df[final_cols]
-
+# Drive / Untappd / Shopify / Cin7 -> integrations.py
+# Matching, cleaning & matrix      -> reconciliation.py
+# OCR & AI extraction              -> ocr.py, extraction.py, pipeline.py
+# Background pre-processing        -> ingest.py
 
 # ==========================================
 # 2. SESSION & SIDEBAR
@@ -559,8 +76,13 @@ if 'selected_drive_name' not in st.session_state: st.session_state.selected_driv
 if 'shopify_logs' not in st.session_state: st.session_state.shopify_logs = []
 if 'untappd_logs' not in st.session_state: st.session_state.untappd_logs = []
 if 'cin7_all_suppliers' not in st.session_state: st.session_state.cin7_all_suppliers = fetch_all_cin7_suppliers_cached()
+if 'cin7_index' not in st.session_state: st.session_state.cin7_index = Cin7SupplierIndex(st.session_state.cin7_all_suppliers)
 
 # INIT KEYS FOR REFRESH
+if 'pdf_hash' not in st.session_state: st.session_state.pdf_hash = ""
+if 'invoice_source' not in st.session_state: st.session_state.invoice_source = {}
+if 'po_batch' not in st.session_state: st.session_state.po_batch = []
+if 'extracted_keys' not in st.session_state: st.session_state.extracted_keys = {}
 if 'line_items_key' not in st.session_state: st.session_state.line_items_key = 0
 if 'matrix_key' not in st.session_state: st.session_state.matrix_key = 0
 
@@ -577,7 +99,7 @@ with st.sidebar:
     if st.button("🛠️ List Available Models"):
         if api_key:
             try:
-                client = genai.Client(api_key=api_key)
+                client = get_genai_client(api_key)
                 models = client.models.list()
                 st.write("### Gemini Models Found:")
                 found = False
@@ -594,6 +116,37 @@ with st.sidebar:
 
     st.divider()
     
+    st.subheader("🔬 OCR Profile")
+    ocr_profile = st.selectbox(
+        "Supplier OCR Settings:",
+        options=[AUTO_PROFILE] + sorted(SUPPLIER_RULEBOOK.keys()),
+        help="Auto-detect reads page 1, spots the supplier and switches to its Tesseract settings."
+    )
+
+    extraction_choice = st.selectbox(
+        "Extraction Mode:",
+        options=list(EXTRACTION_MODE_LABELS.keys()),
+        format_func=lambda m: EXTRACTION_MODE_LABELS[m],
+        help="OCR + Text runs Tesseract locally. Direct PDF / Page Images send the document to Gemini. Auto uses the per-supplier setting in knowledge_base.py."
+    )
+
+    model_choice = st.selectbox(
+        "AI Model:",
+        options=[AUTO_TIER] + TIER_ORDER,
+        format_func=lambda t: "Auto (route by size & supplier)" if t == AUTO_TIER else f"{t.title()} ({MODEL_TIERS[t]})",
+        help="Auto starts on the cheapest suitable model and escalates if the line total doesn't match Total_Net."
+    )
+
+    st.divider()
+
+    st.subheader("⚠️ Resolve Missing")
+    max_formats = st.number_input(
+        "Formats per product (Tab 2):", min_value=1, max_value=10, value=MAX_FORMATS,
+        help="How many format columns (Format1..N) each product gets in the Resolve Missing matrix."
+    )
+
+    st.divider()
+    
     st.subheader("🧪 The Lab")
     with st.form("teaching_form"):
         st.caption("Test a new rule here. Press Ctrl+Enter to apply.")
@@ -609,8 +162,41 @@ with st.sidebar:
 # 3. MAIN UI
 # ==========================================
 
+def show_invoice(header_df, lines_df, extracted_keys):
+    """Puts an invoice (fresh or from history) into the session and resets the downstream state."""
+    st.session_state.header_data = header_df
+    st.session_state.line_items = lines_df
+    st.session_state.extracted_keys = extracted_keys
+    # Clear Logs
+    st.session_state.shopify_logs = []
+    st.session_state.untappd_logs = []
+    st.session_state.matrix_data = None
+    # UPDATE KEYS TO FORCE REFRESH
+    st.session_state.line_items_key += 1
+
+def save_current_invoice(meta=None):
+    if not st.session_state.pdf_hash or st.session_state.header_data is None: return
+    try:
+        save_invoice(st.session_state.pdf_hash, st.session_state.header_data, st.session_state.line_items,
+                     meta=meta, **st.session_state.invoice_source)
+    except Exception as e:
+        st.warning(f"Could not save invoice history: {e}")
+
+def record_prices(header_df, lines_df, pdf_hash=""):
+    """Adds an exported invoice to the price history store."""
+    try: append_invoice_lines(header_df, lines_df, pdf_hash)
+    except Exception as e: st.warning(f"Could not update price history: {e}")
+
+@st.cache_data(ttl=600, show_spinner=False)
+def cached_price_summary(search, signature):
+    return product_price_summary(search)
+
+@st.cache_data(ttl=600, show_spinner=False)
+def cached_price_history(product_keys, signature):
+    return price_history(list(product_keys))
+
 st.subheader("1. Select Invoice Source")
-tab_upload, tab_drive = st.tabs(["⬆️ Manual Upload", "☁️ Google Drive"])
+tab_upload, tab_drive, tab_prices = st.tabs(["⬆️ Manual Upload", "☁️ Google Drive", "📈 Price History"])
 
 target_stream = None
 source_name = "Unknown"
@@ -644,14 +230,82 @@ with tab_drive:
 
     if st.session_state.drive_files:
         file_names = [f['name'] for f in st.session_state.drive_files]
-        selected_name = st.selectbox("Select Invoice from Drive List:", options=file_names, index=None, placeholder="Choose a file...")
+        done_by_id, done_by_md5 = processed_drive_files()
+        done_names = {
+            f['name']: done_by_id.get(f['id']) or done_by_md5.get(f.get('md5Checksum'))
+            for f in st.session_state.drive_files
+        }
+
+        def label_drive_file(name):
+            done = done_names.get(name)
+            if not done: return name
+            return f"✅ {name} ({done['supplier']} #{done['invoice_number']}, {done['matched']}/{done['lines']} matched)"
+
+        st.caption(f"{sum(1 for d in done_names.values() if d)} of {len(file_names)} already processed.")
+        selected_name = st.selectbox(
+            "Select Invoice from Drive List:", options=file_names, index=None, placeholder="Choose a file...",
+            format_func=label_drive_file
+        )
         if selected_name:
             file_data = next(f for f in st.session_state.drive_files if f['name'] == selected_name)
             st.session_state.selected_drive_id = file_data['id']
             st.session_state.selected_drive_name = file_data['name']
+            st.session_state.selected_drive_md5 = file_data.get('md5Checksum')
             if not uploaded_file:
                 source_name = selected_name
 
+# --- PRICE HISTORY (Every exported line, Parquet + DuckDB) ---
+with tab_prices:
+    col_p1, col_p2 = st.columns([3, 1])
+    search = col_p1.text_input("Search product or brewery", key="price_search")
+    with col_p2:
+        st.write("")
+        st.write("")
+        if st.button("📥 Import Saved Invoices", help="Adds processed invoices that are not in the price history yet (not only exported ones)."):
+            with st.spinner("Importing..."):
+                n_inv, n_lines = backfill_from_history()
+            st.success(f"Imported {n_lines} line(s) from {n_inv} invoice(s).")
+
+    signature = store_signature()
+    summary = cached_price_summary(search, signature)
+    if summary.empty:
+        st.info("No price history yet. Invoices are added when their PO is exported to Cin7.")
+    else:
+        st.dataframe(summary.drop(columns=['product_key']), use_container_width=True, hide_index=True)
+        labels = {r.product_key: f"{r.Product} - {r.Format} {r.Volume} ({r.Brewery})" for r in summary.itertuples()}
+        picked = st.multiselect("Chart products", options=list(labels), default=list(labels)[:1],
+                                format_func=labels.get, max_selections=6)
+        history = cached_price_history(tuple(picked), signature)
+        if not history.empty:
+            metric = st.radio("Show", ["Item_Price", "Landed_Price", "Landed_Per_L"], horizontal=True,
+                              help="Landed spreads shipping and discounts over the invoice lines by value.")
+            chart = history.assign(Product_Label=history['product_key'].map(labels)).pivot_table(
+                index="Date", columns="Product_Label", values=metric, aggfunc="mean")
+            st.line_chart(chart)
+            st.dataframe(history.drop(columns=['product_key']), use_container_width=True, hide_index=True)
+
+# --- ALREADY PROCESSED? (Offer the saved result instead of OCR + AI again) ---
+saved = None
+if uploaded_file:
+    saved = find_invoice(pdf_hash=pdf_hashes(uploaded_file.getvalue())[0])
+elif st.session_state.selected_drive_id:
+    saved = find_invoice(drive_id=st.session_state.selected_drive_id, pdf_md5=st.session_state.get('selected_drive_md5'))
+if saved:
+    col_s1, col_s2 = st.columns([3, 1])
+    col_s1.info(
+        f"📚 Already processed {saved['processed_at'][:16].replace('T', ' ')}: {saved['supplier']} "
+        f"#{saved['invoice_number']} ({saved['matched']}/{saved['lines']} matched). Load it, or process again below."
+    )
+    if col_s2.button("📂 Load Saved Result"):
+        header_df, lines_df, meta = load_invoice(saved['pdf_hash'])
+        st.session_state.pdf_hash = saved['pdf_hash']
+        st.session_state.invoice_source = {}
+        show_invoice(header_df, lines_df, {i: tuple(k) for i, k in meta.get("extracted_keys", [])})
+        if 'Shopify_Status' in lines_df.columns:   # already checked (e.g. by ingest.py)
+            st.session_state.matrix_data = create_product_matrix(lines_df, max_formats)
+            st.session_state.matrix_key += 1
+        st.rerun()
+
 # --- PROCESS BUTTON ---
 if st.button("🚀 Process Invoice", type="primary"):
     
@@ -669,85 +323,47 @@ if st.button("🚀 Process Invoice", type="primary"):
             with st.status("Processing Document...", expanded=True) as status:
                 
                 # --- NEW CLIENT INIT ---
-                client = genai.Client(api_key=api_key)
+                client = get_genai_client(api_key)
                 
-                st.write("1. Converting PDF to Images (OCR Prep)...")
                 target_stream.seek(0)
-                images = convert_from_bytes(target_stream.read(), dpi=300)
-                
-                st.write(f"2. Extracting Text from {len(images)} pages...")
-                full_text = ""
-                for i, img in enumerate(images):
-                    st.write(f"   - Scanning page {i+1}...")
-                    full_text += pytesseract.image_to_string(img) + "\n"
-
-                st.write("3. Sending Text to AI Model...")
-                injected = f"\n!!! USER OVERRIDE !!!\n{custom_rule}\n" if custom_rule else ""
-
-                prompt = f"""
-                Extract invoice data to JSON.
-                STRUCTURE:
-                {{
-                    "header": {{
-                        "Payable_To": "Supplier Name", "Invoice_Number": "...", "Issue_Date": "...", 
-                        "Payment_Terms": "...", "Due_Date": "...", "Total_Net": 0.00, 
-                        "Total_VAT": 0.00, "Total_Gross": 0.00, "Total_Discount_Amount": 0.00, "Shipping_Charge": 0.00
-                    }},
-                    "line_items": [
-                        {{
-                            "Supplier_Name": "...", "Collaborator": "...", "Product_Name": "...", "ABV": "...", 
-                            "Format": "...", "Pack_Size": "...", "Volume": "...", "Quantity": 1, "Item_Price": 10.00
-                        }}
-                    ]
-                }}
-                SUPPLIER RULEBOOK: {json.dumps(SUPPLIER_RULEBOOK)}
-                GLOBAL RULES: {GLOBAL_RULES_TEXT}
-                {injected}
-                INVOICE TEXT:
-                {full_text}
-                """
-
-                # --- GENERATION CALL (USING 2.5-flash as verified) ---
-                response = client.models.generate_content(
-                    model='gemini-2.5-flash', 
-                    contents=prompt
-                )
-                
-                st.write("4. Parsing Response...")
+                pdf_bytes = target_stream.read()
+                st.session_state.pdf_hash, pdf_md5 = pdf_hashes(pdf_bytes)
+                st.session_state.invoice_source = {
+                    "pdf_md5": pdf_md5, "source_name": source_name,
+                    "drive_id": "" if uploaded_file else (st.session_state.selected_drive_id or ""),
+                }
+                # --- LIVE PREVIEW (Header + lines render as the reply streams in) ---
+                header_slot, lines_slot = st.empty(), st.empty()
+                live_lines = []
+
+                def show_line(line):
+                    live_lines.append(line)
+                    lines_slot.dataframe(pd.DataFrame(live_lines), use_container_width=True)
+
+                def clear_preview():
+                    live_lines.clear()
+                    header_slot.empty(); lines_slot.empty()
+
                 try:
-                    json_text = response.text.strip().replace("```json", "").replace("```", "")
-                    data = json.loads(json_text)
-                except Exception as e:
-                    st.error(f"AI returned invalid JSON: {response.text}")
+                    result = process_pdf(
+                        pdf_bytes, client, extraction_choice, ocr_profile, model_choice, custom_rule,
+                        st.session_state.master_suppliers, st.session_state.pdf_hash,
+                        log=st.write, on_generate=clear_preview, on_line=show_line,
+                        on_header=lambda h: header_slot.dataframe(pd.DataFrame([h]), use_container_width=True),
+                    )
+                except OcrError as e:
+                    st.error(f"OCR failed: {e}")
                     st.stop()
-                
-                st.write("5. Finalizing Data...")
-                
-                st.session_state.header_data = pd.DataFrame([data['header']])
-                
-                # Init Cin7 columns
-                st.session_state.header_data['Cin7_Supplier_ID'] = ""
-                st.session_state.header_data['Cin7_Supplier_Name'] = ""
-                
-                df_lines = pd.DataFrame(data['line_items'])
-                
-                df_lines = clean_product_names(df_lines)
-                if st.session_state.master_suppliers:
-                    df_lines = normalize_supplier_names(df_lines, st.session_state.master_suppliers)
-
-                # Initialize columns so Matrix generation doesn't fail on first run
-                df_lines['Shopify_Status'] = "Pending"
-                cols = ["Supplier_Name", "Collaborator", "Product_Name", "ABV", "Format", "Pack_Size", "Volume", "Item_Price", "Quantity"]
-                existing = [c for c in cols if c in df_lines.columns]
-                st.session_state.line_items = df_lines[existing]
-                
-                # Clear Logs
-                st.session_state.shopify_logs = []
-                st.session_state.untappd_logs = []
-                st.session_state.matrix_data = None
-                
-                # UPDATE KEYS TO FORCE REFRESH
-                st.session_state.line_items_key += 1
+                except ValueError as e:
+                    st.error(f"AI returned invalid JSON: {e}")
+                    st.stop()
+                clear_preview()
+                meta = result["meta"]
+                for note in meta["ocr_notes"]: st.warning(f"OCR: {note}")
+                if not meta["totals_ok"]:
+                    st.warning(f"Totals still don't match after {meta['model']} - check the lines carefully.")
+                show_invoice(result["header"], result["lines"], result["extracted_keys"])
+                save_current_invoice(meta)
                 
                 status.update(label="Processing Complete!", state="complete", expanded=False)
 
@@ -756,6 +372,24 @@ if st.button("🚀 Process Invoice", type="primary"):
     else:
         st.warning("Please upload a file or select one from Google Drive first.")
 
+# --- MODE COMPARISON (Same PDF through every extraction mode) ---
+with st.expander("⚖️ Compare Extraction Modes"):
+    st.caption("Runs OCR + Text, OCR Layout Table, Direct PDF and Page Images on the selected invoice. Accuracy is agreement with the OCR + Text result.")
+    if st.button("Run Comparison"):
+        stream = uploaded_file
+        if not stream and st.session_state.selected_drive_id:
+            stream = download_file_from_drive(st.session_state.selected_drive_id)
+        if stream and api_key:
+            stream.seek(0)
+            with st.spinner("Running all modes..."):
+                rows = compare_extraction_modes(
+                    get_genai_client(api_key), stream.read(),
+                    supplier=None if ocr_profile == AUTO_PROFILE else ocr_profile, custom_rule=custom_rule
+                )
+            st.dataframe(pd.DataFrame(rows), use_container_width=True)
+        else:
+            st.warning("Select an invoice and enter the API key first.")
+
 # ==========================================
 # 4. RESULTS DISPLAY
 # ==========================================
@@ -784,12 +418,13 @@ if st.session_state.header_data is not None:
     with current_tabs[0]:
         st.subheader("1. Review & Edit Lines")
         
-        display_df = st.session_state.line_items.copy()
+        # Shopify images render from the local thumbnail cache; the URL column stays hidden
+        display_df = with_thumbnails(st.session_state.line_items, 'Image', 'Image_Preview')
         if 'Shopify_Status' in display_df.columns:
             display_df.rename(columns={'Shopify_Status': 'Product_Status'}, inplace=True)
 
         ideal_order = [
-            'Product_Status', 'Matched_Product', 'Matched_Variant', 'Image', 
+            'Product_Status', 'Matched_Product', 'Matched_Variant', 'Image_Preview', 
             'Supplier_Name', 'Product_Name', 'ABV', 'Format', 'Pack_Size', 
             'Volume', 'Quantity', 'Item_Price', 'Collaborator', 
             'Shopify_Variant_ID', 'London_SKU', 'Gloucester_SKU'
@@ -801,10 +436,13 @@ if st.session_state.header_data is not None:
         display_df = display_df[final_cols]
         
         column_config = {
-            "Image": st.column_config.ImageColumn("Img"),
+            "Image_Preview": st.column_config.ImageColumn("Img"),
+            "Image": None,
             "Product_Status": st.column_config.TextColumn("Status", disabled=True),
             "Matched_Product": st.column_config.TextColumn("Shopify Match", disabled=True),
             "Matched_Variant": st.column_config.TextColumn("Variant Match", disabled=True),
+            "Price_Check": st.column_config.TextColumn("Price vs History", disabled=True),
+            FINGERPRINT_COL: None,
         }
 
         edited_lines = st.data_editor(
@@ -816,12 +454,12 @@ if st.session_state.header_data is not None:
         )
         
         if edited_lines is not None:
-            saved_df = edited_lines.copy()
+            saved_df = edited_lines.drop(columns=['Image_Preview'], errors='ignore')
             if 'Product_Status' in saved_df.columns:
                 saved_df.rename(columns={'Product_Status': 'Shopify_Status'}, inplace=True)
             st.session_state.line_items = saved_df
 
-        col1, col2 = st.columns([1, 4])
+        col1, col2, col3 = st.columns([1, 1, 3])
         with col1:
             if "shopify" in st.secrets:
                 if st.button("🛒 Check Inventory"):
@@ -829,14 +467,20 @@ if st.session_state.header_data is not None:
                         updated_lines, logs = run_reconciliation_check(st.session_state.line_items)
                         st.session_state.line_items = updated_lines
                         st.session_state.shopify_logs = logs
-                        st.session_state.matrix_data = create_product_matrix(updated_lines)
+                        st.session_state.matrix_data = create_product_matrix(updated_lines, max_formats)
+                        save_current_invoice()
                         st.session_state.line_items_key += 1
                         st.session_state.matrix_key += 1
                         st.success("Check Complete!")
                         st.rerun()
         
         with col2:
-             st.download_button("📥 Download Lines CSV", st.session_state.line_items.to_csv(index=False), "lines.csv")
+            if st.button("📌 Remember Matches", help="Save the ✅ matches so these lines resolve instantly next time."):
+                n = remember_confirmed_matches(st.session_state.line_items, "confirmed", st.session_state.extracted_keys)
+                st.success(f"Remembered {n} match(es).")
+
+        with col3:
+             st.download_button("📥 Download Lines CSV", st.session_state.line_items.drop(columns=[FINGERPRINT_COL], errors='ignore').to_csv(index=False), "lines.csv")
         
         if st.session_state.shopify_logs:
             with st.expander("🕵️ Debug Logs", expanded=False):
@@ -872,9 +516,9 @@ if st.session_state.header_data is not None:
 
             if st.session_state.matrix_data is not None and not st.session_state.matrix_data.empty:
                 
-                disp_matrix = st.session_state.matrix_data.copy()
+                disp_matrix = with_thumbnails(st.session_state.matrix_data, 'Label_Thumb', 'Label_Preview')
                 
-                u_cols = ['Untappd_Status', 'Label_Thumb', 'Untappd_Brewery', 'Untappd_Product', 'Untappd_ABV', 'Untappd_Desc']
+                u_cols = ['Untappd_Status', 'Label_Preview', 'Untappd_Brewery', 'Untappd_Product', 'Untappd_ABV', 'Untappd_Desc']
                 
                 base_cols = ['Supplier_Name', 'Product_Name', 'ABV']
                 rest = [c for c in disp_matrix.columns if c not in u_cols and c not in base_cols]
@@ -884,10 +528,11 @@ if st.session_state.header_data is not None:
                 disp_matrix = disp_matrix[valid_cols]
 
                 column_config = {
-                    "Label_Thumb": st.column_config.ImageColumn("Label", width="small"),
+                    "Label_Preview": st.column_config.ImageColumn("Label", width="small"),
+                    "Label_Thumb": None,
                     "Untappd_Status": st.column_config.TextColumn("Found?"),
                 }
-                for i in range(1, 4):
+                for i in range(1, max_formats + 1):
                     column_config[f"Create{i}"] = st.column_config.CheckboxColumn(f"Create?", default=False)
 
                 edited_matrix = st.data_editor(
@@ -896,12 +541,44 @@ if st.session_state.header_data is not None:
                     width=1500,
                     key=f"matrix_editor_{st.session_state.matrix_key}", 
                     column_config=column_config
-                )
+                ).drop(columns=['Label_Preview'], errors='ignore')
                 
                 if edited_matrix is not None:
                      st.session_state.matrix_data = edited_matrix
 
-                st.download_button("📥 Download To-Do List", edited_matrix.to_csv(index=False), "missing_products.csv")
+                col_m1, col_m2 = st.columns([1, 1])
+                with col_m1:
+                    st.download_button("📥 Download To-Do List", edited_matrix.to_csv(index=False), "missing_products.csv")
+
+                # --- BULK CREATE (One Shopify bulk operation for every ticked format) ---
+                new_products = matrix_to_new_products(edited_matrix, max_formats)
+                with col_m2:
+                    create_clicked = st.button(
+                        f"🛍️ Create {len(new_products)} Ticked Product(s) in Shopify",
+                        disabled=not new_products or "shopify" not in st.secrets,
+                        help="Creates draft products with Format/ABV metafields and the Untappd label, then matches them to the lines."
+                    )
+                if create_clicked:
+                    try:
+                        with st.status("Creating products in Shopify...", expanded=True) as status:
+                            created, errors, c_logs = bulk_create_shopify_products(
+                                new_products, on_status=lambda op: st.write(f"   - {op['status'] if op else 'waiting'}...")
+                            )
+                            for log in c_logs: st.write(log)
+                            for err in errors: st.error(err)
+                            updated_lines, n = apply_created_products(st.session_state.line_items, new_products, created)
+                            st.session_state.line_items = updated_lines
+                            created_ids = {v['id'] for c in created for v in c['variants']}
+                            remember_confirmed_matches(updated_lines[updated_lines['Shopify_Variant_ID'].isin(created_ids)], "created")
+                            st.session_state.matrix_data = create_product_matrix(updated_lines, max_formats)
+                            st.session_state.line_items_key += 1
+                            st.session_state.matrix_key += 1
+                            save_current_invoice()
+                            status.update(label=f"Created {len(created)} product(s), matched {n} line(s).", state="complete")
+                    except Exception as e:
+                        st.error(f"Bulk create failed: {e}")
+                    else:
+                        if not errors: st.rerun()
 
     # --- TAB 3: HEADER / EXPORT ---
     with current_tabs[2]:
@@ -911,13 +588,10 @@ if st.session_state.header_data is not None:
         if not st.session_state.header_data.empty:
              current_payee = st.session_state.header_data.iloc[0]['Payable_To']
         
-        cin7_list_names = [s['Name'] for s in st.session_state.cin7_all_suppliers]
-        default_index = 0
-        if cin7_list_names and current_payee:
-            match, score = process.extractOne(current_payee, cin7_list_names)
-            if score > 60:
-                try: default_index = cin7_list_names.index(match)
-                except ValueError: default_index = 0
+        cin7_index = st.session_state.cin7_index
+        cin7_list_names = cin7_index.names
+        match = cin7_index.best_match(current_payee) if current_payee else None
+        default_index = cin7_index.position(match) if match else 0
 
         col_h1, col_h2 = st.columns([1, 2])
         with col_h1:
@@ -930,10 +604,10 @@ if st.session_state.header_data is not None:
             )
             
             if selected_supplier and not st.session_state.header_data.empty:
-                supp_data = next((s for s in st.session_state.cin7_all_suppliers if s['Name'] == selected_supplier), None)
-                if supp_data:
-                    st.session_state.header_data.at[0, 'Cin7_Supplier_ID'] = supp_data['ID']
-                    st.session_state.header_data.at[0, 'Cin7_Supplier_Name'] = supp_data['Name']
+                supplier_id = cin7_index.supplier_id(selected_supplier)
+                if supplier_id:
+                    st.session_state.header_data.at[0, 'Cin7_Supplier_ID'] = supplier_id
+                    st.session_state.header_data.at[0, 'Cin7_Supplier_Name'] = selected_supplier
         
         with col_h2:
             st.write("") 
@@ -945,21 +619,62 @@ if st.session_state.header_data is not None:
         
         st.divider()
         
-        po_location = st.selectbox("Select Delivery Location:", ["London", "Gloucester"], key="final_po_loc")
+        po_location = st.selectbox("Select Delivery Location:", LOCATIONS + [SPLIT_LOCATION], key="final_po_loc")
+
+        if po_location == SPLIT_LOCATION:
+            split_df = st.session_state.line_items.copy()
+            if 'Location' not in split_df.columns: split_df['Location'] = LOCATIONS[0]
+            split_cols = [c for c in ['Product_Name', 'Format', 'Volume', 'Quantity', 'Location'] if c in split_df.columns]
+            edited_split = st.data_editor(
+                split_df[split_cols], num_rows="fixed", width=1000, key="split_editor",
+                disabled=[c for c in split_cols if c != 'Location'],
+                column_config={"Location": st.column_config.SelectboxColumn("Location", options=LOCATIONS, required=True)}
+            )
+            st.session_state.line_items['Location'] = edited_split['Location']
         
-        if st.button(f"📤 Export PO to Cin7 ({po_location})", type="primary", disabled=not all_matched):
+        col_e1, col_e2 = st.columns([1, 1])
+        with col_e2:
+            if st.button("➕ Add to Export Batch", disabled=not all_matched):
+                name = source_name if source_name != "Unknown" else str(st.session_state.header_data.iloc[0].get('Invoice_Number', 'Invoice'))
+                st.session_state.po_batch.append({
+                    "name": name, "location": po_location, "pdf_hash": st.session_state.pdf_hash,
+                    "header": st.session_state.header_data.copy(), "lines": st.session_state.line_items.copy(),
+                })
+                st.success(f"Added {name} ({po_location}). {len(st.session_state.po_batch)} in batch.")
+
+        if col_e1.button(f"📤 Export PO to Cin7 ({po_location})", type="primary", disabled=not all_matched):
             if not all_matched:
                 st.error("Please resolve all missing products in Tab 2 before exporting.")
+            elif po_location == SPLIT_LOCATION and "cin7" in st.secrets:
+                with st.spinner("Creating Purchase Orders..."):
+                    results = bulk_create_cin7_purchase_orders(
+                        [{"name": source_name, "location": po_location, "pdf_hash": st.session_state.pdf_hash,
+                          "header": st.session_state.header_data, "lines": st.session_state.line_items}],
+                        st.session_state.cin7_all_suppliers
+                    )
+                for r in results:
+                    show = st.info if r.get("already_exported") else st.success if r["ok"] else st.error
+                    show(f"{r['location']}: {r['message']}")
+                # Ledger skips are earlier exports: their matches and prices are already recorded
+                if all(r["ok"] for r in results) and not all(r.get("already_exported") for r in results):
+                    remember_confirmed_matches(st.session_state.line_items, "export", st.session_state.extracted_keys)
+                    record_prices(st.session_state.header_data, st.session_state.line_items, st.session_state.pdf_hash)
             elif "cin7" in st.secrets:
                 with st.spinner("Creating Purchase Order..."):
-                    success, msg, logs = create_cin7_purchase_order(
+                    success, msg, logs, already_exported = create_cin7_purchase_order(
                         st.session_state.header_data, 
                         st.session_state.line_items, 
-                        po_location
+                        po_location,
+                        pdf_hash=st.session_state.pdf_hash
                     )
                     st.session_state.cin7_logs = logs
                     
-                    if success:
+                    if already_exported:
+                        # The ledger caught a repeat: no new PO, nothing to record again
+                        st.info(msg)
+                    elif success:
+                        remember_confirmed_matches(st.session_state.line_items, "export", st.session_state.extracted_keys)
+                        record_prices(st.session_state.header_data, st.session_state.line_items, st.session_state.pdf_hash)
                         task_id = None
                         match = re.search(r'ID: ([a-f0-9\-]+)', msg)
                         if match: task_id = match.group(1)
@@ -974,3 +689,41 @@ if st.session_state.header_data is not None:
                             for log in logs: st.write(log)
             else:
                 st.error("Cin7 Secrets missing.")
+
+        # --- BULK EXPORT (Many invoices, one click) ---
+        if st.session_state.po_batch:
+            st.divider()
+            st.subheader(f"📦 Export Batch ({len(st.session_state.po_batch)})")
+            st.dataframe(pd.DataFrame([{
+                "Invoice": b["name"], "Supplier": b["header"].iloc[0].get('Payable_To', ''),
+                "Invoice_Number": b["header"].iloc[0].get('Invoice_Number', ''), "Location": b["location"],
+                "Lines": len(b["lines"]),
+            } for b in st.session_state.po_batch]), use_container_width=True)
+
+            col_b1, col_b2 = st.columns([1, 1])
+            if col_b1.button("🚀 Export All to Cin7", type="primary"):
+                if "cin7" not in st.secrets:
+                    st.error("Cin7 Secrets missing.")
+                else:
+                    with st.spinner(f"Submitting {len(st.session_state.po_batch)} invoice(s)..."):
+                        results = bulk_create_cin7_purchase_orders(st.session_state.po_batch, st.session_state.cin7_all_suppliers)
+                    # By batch position: two queued invoices can share a file name
+                    done = {r["index"] for r in results if r["ok"]} - {r["index"] for r in results if not r["ok"]}
+                    # Ledger skips were exported before: their matches and prices are already recorded
+                    fresh = {r["index"] for r in results if r["ok"] and not r.get("already_exported")}
+                    for i, b in enumerate(st.session_state.po_batch):
+                        if i not in done & fresh: continue
+                        remember_confirmed_matches(b["lines"], "export")
+                        record_prices(b["header"], b["lines"], b["pdf_hash"])
+                    st.session_state.po_batch = [b for i, b in enumerate(st.session_state.po_batch) if i not in done]
+                    st.dataframe(pd.DataFrame(results).drop(columns=["index", "logs"], errors="ignore"), use_container_width=True)
+                    repeats = sum(bool(r.get("already_exported")) for r in results)
+                    st.success(f"{sum(r['ok'] for r in results) - repeats} of {len(results)} PO(s) created.")
+                    if repeats: st.info(f"{repeats} PO(s) were already exported and were skipped.")
+            if col_b2.button("🗑️ Clear Batch"):
+                st.session_state.po_batch = []
+                st.rerun()
+
+        with st.expander("🧾 Export Ledger"):
+            st.caption("Every PO sent to Cin7. Re-exporting a 'complete' invoice is skipped; 'header_created' resumes with the lines only.")
+            st.dataframe(pd.DataFrame(list_exports()), use_container_width=True)
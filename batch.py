@@ -0,0 +1,274 @@
+"""
+Bulk extraction through the Gemini batch API, for backlogs (quarter-end catch-up, old
+Drive folders). PDFs are OCR'd locally and read by the supplier templates as usual;
+everything that still needs Gemini goes into one batch job per model tier, which costs
+about half the per-call price and usually finishes well within the 24h window.
+
+    python batch.py submit --folder ~/invoices/2023-q4      # or --drive-folder <FOLDER_ID>
+    python batch.py submit --folder ~/invoices --dry-run    # count and size the requests only
+    python batch.py status
+    python batch.py poll --wait                             # collect results until no job is open
+
+Finished results go through the same clean / normalise / totals check as the app and
+land in the invoice history ("Load Saved Result" opens them). Results that fail the
+totals check are resubmitted on the next tier up, like the interactive escalation.
+Uses GOOGLE_API_KEY (and connections.gsheets for Drive) from the app's secrets.
+"""
+import argparse
+import datetime
+import logging
+import os
+import sys
+import time
+
+import streamlit as st
+
+from knowledge_base import MODEL_TIERS, TIER_ORDER
+from storage import (
+    pdf_hashes, find_invoice, save_invoice, record_batch_job, update_batch_job, list_batch_jobs,
+    queued_invoice_hashes, processed_drive_files
+)
+
+log = logging.getLogger("batch")
+
+BATCH_MAX_REQUESTS = 500
+BATCH_INLINE_BYTES = 15 * 1024 * 1024    # the API refuses inline batches over 20MB
+BATCH_POLL_SECONDS = 60
+BATCH_MAX_RESUBMITS = 1                  # for requests lost to a failed / expired job
+DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED", "JOB_STATE_FAILED",
+               "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+def secret(name):
+    try: return st.secrets[name]
+    except Exception: return None
+
+# --- REQUESTS ---
+def batch_request(contents, key):
+    """One inline request: rulebook prefix + invoice text, tagged with the PDF hash."""
+    from extraction import genai_types, build_prompt_prefix
+    types = genai_types()
+    return {
+        "contents": [types.Content(role="user", parts=[types.Part.from_text(text=build_prompt_prefix() + contents)])],
+        "metadata": {"key": key},
+    }
+
+def prepare_pdf(pdf_bytes, source_name, drive_id="", extraction_choice=None, master_suppliers=None, skip=()):
+    """
+    Reads one PDF. Returns ("skipped" | "saved" | "queued", item). Template hits are
+    saved straight away; anything else becomes a batch item (saved prompt + routing).
+    """
+    from extraction import choose_extraction_mode, AUTO_MODE
+    from pipeline import read_invoice, finish_invoice, invoice_meta, TEXT_MODES
+    pdf_hash, pdf_md5 = pdf_hashes(pdf_bytes)
+    if pdf_hash in skip or find_invoice(pdf_hash=pdf_hash): return "skipped", None
+
+    # Batches carry text prompts only; suppliers set to a document mode are OCR'd instead
+    mode, _ = choose_extraction_mode(extraction_choice or AUTO_MODE, pdf_bytes)
+    read = read_invoice(pdf_bytes, mode if mode in TEXT_MODES else "ocr",
+                        log=lambda msg: log.debug("%s: %s", source_name, msg.strip()))
+    if read["data"]:
+        header_df, lines_df, keys = finish_invoice(read["data"], master_suppliers, pdf_hash)
+        save_invoice(pdf_hash, header_df, lines_df, pdf_md5=pdf_md5, source_name=source_name, drive_id=drive_id,
+                     meta=invoice_meta(read, "template", True, keys))
+        return "saved", None
+    return "queued", {
+        "key": pdf_hash, "pdf_md5": pdf_md5, "source_name": source_name, "drive_id": drive_id,
+        "mode": read["mode"], "supplier": read["supplier"], "tier": read["tier"], "why": read["why"],
+        "contents": read["contents"], "prompt_chars": len(read["prompt_text"] or ""),
+        "timings": read["timings"], "ocr_notes": read["ocr_notes"], "page_filter": read["page_filter"],
+        "attempts": [], "resubmits": 0,
+    }
+
+def chunk_items(items):
+    """Splits items into inline batches under the request-count and size limits."""
+    chunk, size = [], 0
+    for item in items:
+        n = len(item["contents"].encode("utf-8")) + 20_000    # + rulebook prefix
+        if chunk and (len(chunk) >= BATCH_MAX_REQUESTS or size + n > BATCH_INLINE_BYTES):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(item)
+        size += n
+    if chunk: yield chunk
+
+def submit_items(client, items):
+    """One job per tier (and size chunk). Returns the job names."""
+    names = []
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M")
+    for tier in TIER_ORDER:
+        for chunk in chunk_items([i for i in items if i["tier"] == tier]):
+            model = MODEL_TIERS[tier]
+            job = client.batches.create(
+                model=model, src=[batch_request(i["contents"], i["key"]) for i in chunk],
+                config={"display_name": f"invoices-{tier}-{stamp}-{len(chunk)}"},
+            )
+            record_batch_job(job.name, tier, model, chunk, state=job_state(job))
+            log.info("Submitted %s: %d invoice(s) on %s", job.name, len(chunk), model)
+            names.append(job.name)
+    return names
+
+# --- RESULTS ---
+def job_state(job):
+    state = job.state
+    return getattr(state, "name", None) or str(state)
+
+def read_response(resp):
+    """(data, ok, reason) for one inlined response."""
+    from extraction import parse_model_json, validate_extraction
+    try:
+        if getattr(resp, "error", None): raise ValueError(getattr(resp.error, "message", None) or str(resp.error))
+        data = parse_model_json(resp.response.text)
+    except Exception as e:
+        return None, False, f"error: {str(e)[:120]}"
+    ok, reason = validate_extraction(data)
+    return data, ok, reason
+
+def save_item(item, data, model, ok, job_name, master_suppliers=None):
+    from pipeline import finish_invoice, invoice_meta
+    header_df, lines_df, keys = finish_invoice(data, master_suppliers, item["key"])
+    read = {"mode": item["mode"], "timings": item["timings"], "prompt_text": None, "ocr_notes": item["ocr_notes"],
+            "page_filter": item.get("page_filter")}
+    meta = invoice_meta(read, model, ok, keys, prompt_chars=item["prompt_chars"], batch=job_name,
+                        batch_attempts=item["attempts"])
+    save_invoice(item["key"], header_df, lines_df, pdf_md5=item["pdf_md5"], source_name=item["source_name"],
+                 drive_id=item["drive_id"], meta=meta)
+
+def collect_job(client, job, master_suppliers=None):
+    """
+    Checks one recorded job. Returns None while it is still running, else a summary;
+    results that fail validation (and requests lost to a failed job) are resubmitted.
+    """
+    remote = client.batches.get(name=job["name"])
+    state = job_state(remote)
+    if state not in DONE_STATES:
+        if state != job["state"]: update_batch_job(job["name"], state)
+        return None
+
+    pending = {item["key"]: item for item in job["items"]}
+    order = list(pending)
+    responses = (getattr(remote.dest, "inlined_responses", None) if remote.dest else None) or []
+    retry, saved, failed = [], 0, []
+    for n, resp in enumerate(responses):
+        # Responses carry the request metadata; fall back to request order
+        key = (getattr(resp, "metadata", None) or {}).get("key") or (order[n] if n < len(order) else None)
+        item = pending.pop(key, None)
+        if item is None: continue
+        data, ok, reason = read_response(resp)
+        item["attempts"].append({"tier": item["tier"], "model": job["model"], "ok": ok, "reason": reason})
+        if data is not None: item["best"] = {"data": data, "model": job["model"]}
+        tier_index = TIER_ORDER.index(item["tier"])
+        if not ok and tier_index + 1 < len(TIER_ORDER):
+            item["tier"] = TIER_ORDER[tier_index + 1]
+            retry.append(item)
+        elif item.get("best"):
+            save_item(item, item["best"]["data"], item["best"]["model"], ok, job["name"], master_suppliers)
+            saved += 1
+        else:
+            failed.append({"source_name": item["source_name"], "reason": reason})
+
+    for item in pending.values():    # no response at all: the job failed, expired or was cancelled
+        if item["resubmits"] < BATCH_MAX_RESUBMITS:
+            item["resubmits"] += 1
+            retry.append(item)
+        else:
+            failed.append({"source_name": item["source_name"], "reason": state})
+
+    resubmitted = submit_items(client, retry) if retry else []
+    summary = {"saved": saved, "retried": len(retry), "failed": failed, "resubmitted_as": resubmitted}
+    update_batch_job(job["name"], state, summary, finished=True)
+    log.info("%s %s: %d saved, %d resubmitted, %d failed", job["name"], state, saved, len(retry), len(failed))
+    return summary
+
+def poll_jobs(client, master_suppliers=None, wait=False, poll_seconds=BATCH_POLL_SECONDS):
+    """Collects every finished job. With wait=True, keeps going until none are open."""
+    while True:
+        open_jobs = list_batch_jobs(open_only=True)
+        for job in open_jobs:
+            try: collect_job(client, job, master_suppliers)
+            except Exception: log.exception("%s: could not collect", job["name"])
+        still_open = list_batch_jobs(open_only=True)
+        if not wait or not still_open: return still_open
+        log.info("%d job(s) still running; next check in %ss", len(still_open), poll_seconds)
+        time.sleep(poll_seconds)
+
+# --- SOURCES ---
+def local_pdfs(folder):
+    for root, _, files in os.walk(folder):
+        for name in sorted(files):
+            if name.lower().endswith(".pdf"):
+                path = os.path.join(root, name)
+                with open(path, "rb") as f: yield f.read(), os.path.relpath(path, folder), ""
+
+def drive_pdfs(folder_id):
+    from integrations import list_files_in_folder, download_file_from_drive
+    done_by_id, done_by_md5 = processed_drive_files()
+    for f in list_files_in_folder(folder_id):
+        if f['id'] in done_by_id or f.get('md5Checksum') in done_by_md5: continue
+        stream = download_file_from_drive(f['id'])
+        if stream is not None: yield stream.read(), f['name'], f['id']
+
+# --- CLI ---
+def cmd_submit(args, client, master_suppliers):
+    skip = queued_invoice_hashes()
+    counts, items = {"skipped": 0, "saved": 0, "queued": 0, "failed": 0}, []
+    sources = local_pdfs(args.folder) if args.folder else drive_pdfs(args.drive_folder)
+    for pdf_bytes, name, drive_id in sources:
+        try:
+            outcome, item = prepare_pdf(pdf_bytes, name, drive_id, args.mode, master_suppliers, skip)
+        except Exception as e:
+            log.warning("%s: %s", name, e)
+            outcome, item = "failed", None
+        counts[outcome] += 1
+        if item:
+            items.append(item)
+            skip.add(item["key"])
+        log.info("%s: %s", name, outcome if not item else f"queued for {MODEL_TIERS[item['tier']]}")
+    chars = sum(i["prompt_chars"] for i in items)
+    log.info("%(skipped)d already processed, %(saved)d read by templates, %(failed)d failed, %(queued)d for Gemini", counts)
+    if not items: return 0
+    log.info("%s invoice chars across %d request(s)", f"{chars:,}", len(items))
+    if args.dry_run: return 0
+    submit_items(client, items)
+    return 0
+
+def cmd_status(args, client, master_suppliers):
+    for job in list_batch_jobs(open_only=not args.all):
+        done = job["summary"] or {}
+        print(f"{job['name']}  {job['model']}  {job['state']}  {len(job['items'])} invoice(s)  created {job['created_at']}"
+              + (f"  saved {done.get('saved', 0)}, retried {done.get('retried', 0)}, failed {len(done.get('failed', []))}" if done else ""))
+    return 0
+
+def cmd_poll(args, client, master_suppliers):
+    still_open = poll_jobs(client, master_suppliers, wait=args.wait, poll_seconds=args.poll_seconds)
+    log.info("%d job(s) still open", len(still_open))
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    submit = sub.add_parser("submit", help="OCR PDFs and submit what needs Gemini as batch jobs.")
+    source = submit.add_mutually_exclusive_group(required=True)
+    source.add_argument("--folder", help="Local folder of PDFs (searched recursively).")
+    source.add_argument("--drive-folder", help="Drive folder ID.")
+    submit.add_argument("--mode", default=None, help="Extraction mode: auto (default), ocr or layout.")
+    submit.add_argument("--dry-run", action="store_true", help="OCR and size the requests without submitting.")
+    status = sub.add_parser("status", help="List batch jobs.")
+    status.add_argument("--all", action="store_true", help="Include finished jobs.")
+    poll = sub.add_parser("poll", help="Collect finished jobs into the invoice history.")
+    poll.add_argument("--wait", action="store_true", help="Keep polling until every job is done.")
+    poll.add_argument("--poll-seconds", type=int, default=BATCH_POLL_SECONDS)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    api_key = secret("GOOGLE_API_KEY") or os.environ.get("GOOGLE_API_KEY")
+    if not api_key:
+        log.error("No GOOGLE_API_KEY in secrets or environment.")
+        return 2
+    from extraction import get_genai_client
+    from integrations import get_master_supplier_list
+    client = get_genai_client(api_key)
+    master_suppliers = get_master_supplier_list() if args.command != "status" else None
+    return {"submit": cmd_submit, "status": cmd_status, "poll": cmd_poll}[args.command](args, client, master_suppliers)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""
+Extraction mode comparison against live Gemini: OCR + Text vs Direct PDF vs Page Images.
+Ground truth is the recorded reply in fixtures/gemini/<invoice>.json.
+
+    GOOGLE_API_KEY=... python benchmarks/compare_modes.py
+    GOOGLE_API_KEY=... python benchmarks/compare_modes.py --modes pdf,images --model gemini-2.5-flash-lite
+    python benchmarks/compare_modes.py --pdf some_invoice.pdf    # any PDF, scored against its OCR result
+
+Results go to results/modes-<git-sha>.json. Use them to fill EXTRACTION_MODES in knowledge_base.py.
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from run import RESULTS_DIR, fixture_invoices, git_version
+from stubs import load_gemini_reply
+
+COLUMNS = ["mode", "ocr_s", "total_s", "lines", "totals_ok", "header_acc", "line_recall", "line_precision", "price_acc"]
+
+def print_rows(name, rows):
+    print(f"\n{name}")
+    print("  " + " ".join(f"{c:>14}" for c in COLUMNS))
+    for row in rows:
+        cells = []
+        for c in COLUMNS:
+            v = row.get(c, "")
+            cells.append(f"{v:>14.2f}" if isinstance(v, float) else f"{str(v):>14}")
+        print("  " + " ".join(cells))
+        if row.get("error"): print(f"  ! {row['error']}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default="ocr,pdf,images")
+    parser.add_argument("--model", default=None, help="Gemini model (default: extraction.DEFAULT_MODEL).")
+    parser.add_argument("--pdf", action="append", help="Extra PDF(s) to compare; scored against the OCR mode.")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args(argv)
+
+    api_key = os.environ.get("GOOGLE_API_KEY")
+    if not api_key:
+        print("GOOGLE_API_KEY is not set; this comparison needs the live API.")
+        return 2
+
+    from google import genai
+    import extraction
+    client = genai.Client(api_key=api_key)
+    modes = tuple(m.strip() for m in args.modes.split(",") if m.strip())
+    model = args.model or extraction.DEFAULT_MODEL
+
+    jobs = [(name, pdf, extraction.parse_model_json(load_gemini_reply(name))) for name, pdf in fixture_invoices()]
+    for path in args.pdf or []:
+        with open(path, "rb") as f:
+            jobs.append((os.path.basename(path), f.read(), None))
+
+    results = {}
+    for name, pdf_bytes, reference in jobs:
+        rows = extraction.compare_extraction_modes(client, pdf_bytes, modes, model, reference=reference)
+        results[name] = rows
+        print_rows(name, rows)
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"modes-{git_version()}.json")
+        report = {
+            "version": git_version(), "model": model,
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "invoices": results,
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nSaved {path}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
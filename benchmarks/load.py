@@ -0,0 +1,299 @@
+"""
+Concurrent-user load test. N simulated buyers each process invoices at the same time,
+the way Streamlit serves several sessions from one process (one thread per session).
+Every external service is local: the stub server (own process, so its CPU is not
+counted) and a FakeGeminiClient per session.
+
+    python benchmarks/load.py                                   # 1,2,5,10 users, 3 invoices each
+    python benchmarks/load.py --users 1,5,20 --invoices 5
+    python benchmarks/load.py --latency 0.2 --rate-limit 20     # slow, throttled services
+    python benchmarks/load.py --gemini-latency 8 --ocr          # real Tesseract, realistic Gemini
+
+Per invoice: download (GET the PDF from the stub's Drive route; the googleapiclient
+client itself is not exercised) -> ocr (Tesseract with --ocr, else the fixture text)
+-> extract (template parser or routed fake Gemini) -> reconcile -> matrix -> export
+(Cin7 PO to London; each run gets its own ledger key).
+
+Reported per concurrency level: throughput, p50/p95 per stage, process CPU (cores busy)
+and peak RSS. The saturation point is the first level whose throughput falls below
+80% of linear scaling from one user.
+Results go to results/load-<git-sha>.json.
+"""
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from urllib.request import urlopen
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from run import RESULTS_DIR, fixture_invoices, git_version, load_pipeline, ocr_available
+from stubs import StubServer, FakeGeminiClient, load_gemini_reply, stub_secrets_toml
+from make_fixtures import INVOICES
+
+STAGES = ["download", "ocr", "extract", "reconcile", "matrix", "export"]
+SATURATION_EFFICIENCY = 0.8
+RSS_SAMPLE_SECONDS = 0.05
+
+# ==========================================
+# STUB PROCESS
+# ==========================================
+
+def _serve(latency, rate_limit, drive, ready, stop):
+    with StubServer(drive=drive, latency=latency, rate_limit=rate_limit) as stub:
+        ready.put(stub.url)
+        stop.wait()
+
+class RemoteStub:
+    """StubServer in a child process. Quacks like StubServer for load_pipeline."""
+    def __init__(self, latency=0.0, rate_limit=None, drive=None):
+        ctx = multiprocessing.get_context("fork")
+        ready, self._stop = ctx.Queue(), ctx.Event()
+        self._proc = ctx.Process(target=_serve, args=(latency, rate_limit, drive or {}, ready, self._stop), daemon=True)
+        self._proc.start()
+        self.url = ready.get(timeout=30)
+
+    def secrets_toml(self):
+        return stub_secrets_toml(self.url)
+
+    def hits(self):
+        with urlopen(f"{self.url}/stub/hits") as r: return json.loads(r.read())
+
+    def close(self):
+        self._stop.set()
+        self._proc.join(timeout=5)
+
+# ==========================================
+# MEASUREMENT
+# ==========================================
+
+def percentile(samples, q):
+    if not samples: return None
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(round(q * (len(s) - 1))))]
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3   # peak, KB on Linux
+
+class RssSampler(threading.Thread):
+    """Peak resident memory of this process while the level runs."""
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = current_rss_mb()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(RSS_SAMPLE_SECONDS):
+            self.peak = max(self.peak, current_rss_mb())
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return self.peak
+
+def cpu_seconds():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+# ==========================================
+# SIMULATED SESSION
+# ==========================================
+
+def process_invoice(pipeline, stub_url, name, job_id, gemini_latency, use_ocr, timings):
+    reconciliation, extraction, ocr, supplier_parsers, integrations = pipeline
+    client = FakeGeminiClient(default=load_gemini_reply(name), latency=gemini_latency)
+
+    t = time.perf_counter()
+    with urlopen(f"{stub_url}/drive/files/{name}") as r: pdf_bytes = r.read()
+    timings["download"].append(time.perf_counter() - t)
+
+    t = time.perf_counter()
+    if use_ocr: text = "\n".join(ocr.ocr_invoice(pdf_bytes)[0])
+    else: text = "\n".join(INVOICES[name])
+    timings["ocr"].append(time.perf_counter() - t)
+
+    t = time.perf_counter()
+    supplier = ocr.detect_supplier(text)
+    data, _ = supplier_parsers.parse_invoice_text(text, supplier)
+    if data is None:
+        tier, _ = extraction.route_model_tier(text, supplier)
+        data, _, _ = extraction.extract_with_escalation(
+            lambda m: extraction.extract_invoice_data(client, text, model=m), tier
+        )
+    header_df, lines_df = extraction.build_invoice_frames(data)
+    timings["extract"].append(time.perf_counter() - t)
+
+    t = time.perf_counter()
+    checked, _ = reconciliation.run_reconciliation_check(lines_df)
+    timings["reconcile"].append(time.perf_counter() - t)
+
+    t = time.perf_counter()
+    reconciliation.create_product_matrix(checked)
+    timings["matrix"].append(time.perf_counter() - t)
+
+    t = time.perf_counter()
+    ok, _, _, _ = integrations.create_cin7_purchase_order(header_df, checked, "London", pdf_hash=job_id)
+    timings["export"].append(time.perf_counter() - t)
+    return ok
+
+def warm_up(pipeline, stub, use_ocr, run_tag):
+    """
+    One untimed pass over each fixture before the first level, so imports, compiled
+    regexes and caches are not charged to the 1-user baseline that saturation() scales from.
+    """
+    scratch = {s: [] for s in STAGES}
+    for name, _ in fixture_invoices():
+        try: process_invoice(pipeline, stub.url, name, f"{run_tag}-warmup-{name}", 0.0, use_ocr, scratch)
+        except Exception as e: print(f"warm-up {name} failed: {e}")
+
+def run_level(pipeline, stub, users, invoices_per_user, gemini_latency, use_ocr, run_tag):
+    names = [n for n, _ in fixture_invoices()]
+    timings = {s: [] for s in STAGES}
+    totals, errors, exported = [], [], [0]
+    lock = threading.Lock()
+    barrier = threading.Barrier(users)
+
+    def session(user):
+        local = {s: [] for s in STAGES}
+        barrier.wait()
+        for i in range(invoices_per_user):
+            name = names[(user + i) % len(names)]
+            t = time.perf_counter()
+            try:
+                ok = process_invoice(pipeline, stub.url, name, f"{run_tag}-{users}-{user}-{i}", gemini_latency, use_ocr, local)
+                with lock:
+                    totals.append(time.perf_counter() - t)
+                    exported[0] += bool(ok)
+            except Exception as e:
+                with lock: errors.append(f"user {user} {name}: {e}")
+        with lock:
+            for s in STAGES: timings[s].extend(local[s])
+
+    hits_before = stub.hits()
+    sampler = RssSampler()
+    sampler.start()
+    cpu0, t0 = cpu_seconds(), time.perf_counter()
+    threads = [threading.Thread(target=session, args=(u,)) for u in range(users)]
+    for th in threads: th.start()
+    for th in threads: th.join()
+    wall, cpu = time.perf_counter() - t0, cpu_seconds() - cpu0
+    peak_rss = sampler.stop()
+    hits_after = stub.hits()
+
+    done = len(totals)
+    return {
+        "users": users,
+        "invoices": done,
+        "exported": exported[0],
+        "errors": errors[:10],
+        "error_count": len(errors),
+        "wall_seconds": wall,
+        "throughput_per_min": 60 * done / wall if wall else 0.0,
+        "invoice_seconds": {"p50": percentile(totals, 0.5), "p95": percentile(totals, 0.95), "max": max(totals, default=None)},
+        "stages": {s: {"p50": percentile(v, 0.5), "p95": percentile(v, 0.95), "max": max(v, default=None)} for s, v in timings.items()},
+        "cpu_cores_busy": cpu / wall if wall else 0.0,
+        "cpu_share": cpu / wall / (os.cpu_count() or 1) if wall else 0.0,
+        "peak_rss_mb": peak_rss,
+        "stub_requests": sum(hits_after.values()) - sum(hits_before.values()),
+        "throttled_429": hits_after.get("429", 0) - hits_before.get("429", 0),
+    }
+
+def saturation(levels):
+    """First level below SATURATION_EFFICIENCY of linear scaling from the first level."""
+    if not levels or not levels[0]["throughput_per_min"]: return None
+    base = levels[0]["throughput_per_min"] / levels[0]["users"]
+    for lvl in levels:
+        lvl["scaling_efficiency"] = lvl["throughput_per_min"] / (base * lvl["users"])
+    for lvl in levels:
+        if lvl["scaling_efficiency"] < SATURATION_EFFICIENCY:
+            return {"users": lvl["users"], "cpu_share": lvl["cpu_share"],
+                    "likely_cause": "cpu" if lvl["cpu_share"] > 0.85 else "waits (GIL, locks, rate limits or stub latency)"}
+    return None
+
+def print_level(lvl):
+    print(f"\n{lvl['users']} user(s): {lvl['invoices']} invoices in {lvl['wall_seconds']:.2f}s  "
+          f"-> {lvl['throughput_per_min']:.1f}/min, CPU {lvl['cpu_cores_busy']:.2f} cores, "
+          f"RSS {lvl['peak_rss_mb']:.0f} MB, 429s {lvl['throttled_429']}, errors {lvl['error_count']}")
+    print(f"  {'stage':<10} {'p50 ms':>10} {'p95 ms':>10}")
+    for s, v in lvl["stages"].items():
+        if v["p50"] is None: continue
+        print(f"  {s:<10} {v['p50'] * 1000:>10.1f} {v['p95'] * 1000:>10.1f}")
+    for e in lvl["errors"][:3]: print(f"  ! {e}")
+
+# ==========================================
+# MAIN
+# ==========================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="1,2,5,10", help="Concurrency levels to run, in order.")
+    parser.add_argument("--invoices", type=int, default=3, help="Invoices per simulated user per level.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to every stub HTTP request.")
+    parser.add_argument("--rate-limit", type=float, default=None, help="Stub requests/second before 429s.")
+    parser.add_argument("--gemini-latency", type=float, default=1.0, help="Seconds per fake Gemini reply.")
+    parser.add_argument("--ocr", action="store_true", help="Run Tesseract on the fixture PDFs (needs poppler/tesseract).")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args(argv)
+
+    levels_wanted = [int(u) for u in args.users.split(",") if u.strip()]
+    use_ocr = args.ocr and ocr_available()
+    if args.ocr and not use_ocr: print("poppler/tesseract not installed; using fixture text for OCR.")
+
+    cwd = os.getcwd()
+    stub = RemoteStub(latency=args.latency, rate_limit=args.rate_limit, drive=dict(fixture_invoices()))
+    run_tag = datetime.datetime.now().strftime("%H%M%S")
+    levels = []
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            pipeline = load_pipeline(stub, workdir)
+            import integrations
+            # Session threads have no ScriptRunContext; st.* calls from them only warn.
+            # A filter, because Streamlit resets logger levels when its config loads.
+            from streamlit.runtime.scriptrunner_utils import script_run_context
+            logging.getLogger(script_run_context.__name__).addFilter(lambda r: r.levelno >= logging.ERROR)
+            pipeline = (*pipeline, integrations)
+            warm_up(pipeline, stub, use_ocr, run_tag)
+            for users in levels_wanted:
+                lvl = run_level(pipeline, stub, users, args.invoices, args.gemini_latency, use_ocr, run_tag)
+                levels.append(lvl)
+                print_level(lvl)
+            os.chdir(cwd)
+    finally:
+        stub.close()
+
+    sat = saturation(levels)
+    if sat: print(f"\nSaturation at {sat['users']} users ({sat['likely_cause']}).")
+    else: print("\nSaturation not reached.")
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"load-{git_version()}.json")
+        report = {
+            "version": git_version(),
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "cpu_count": os.cpu_count(),
+            "config": {"latency": args.latency, "rate_limit": args.rate_limit, "gemini_latency": args.gemini_latency,
+                       "invoices_per_user": args.invoices, "ocr": "tesseract" if use_ocr else "fixture text"},
+            "levels": levels,
+            "saturation": sat,
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nSaved {path}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
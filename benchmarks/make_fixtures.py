@@ -0,0 +1,109 @@
+"""
+Regenerates the sample invoice PDFs in benchmarks/fixtures/invoices.
+The PDFs are plain text renders of real supplier layouts (see SUPPLIER_RULEBOOK),
+so they OCR cleanly and line up with the canned Gemini replies in fixtures/gemini.
+
+Usage: python benchmarks/make_fixtures.py
+"""
+import os
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+INVOICES = {
+    "thornbridge_3_lines": [
+        "Thornbridge Brewery",
+        "Riverside Brewery, Buxton Road, Bakewell DE45 1GS",
+        "INVOICE  SI-204518        Date: 02/09/2024",
+        "Payment Terms: 30 Days   Due: 02/10/2024",
+        "",
+        "Qty Ord  Qty B/O  Qty Del  Code          Description                       Price  Unit   Total",
+        "18.0000 0.0000 18.0000B/JAIP-ECA09-059 Jaipur Ecask - 5.9% ABV 9 Gallon 97.00 ECask 1,746.00",
+        "2.0000 0.0000 2.0000B/JAIP-EKE30-059 Jaipur Ekeg - 5.9% ABV 30 Litre 128.00 EKeg 256.00",
+        "1.0000 0.0000 1.0000B/GRMO-KEG30-005 Green Mountain AF Keg - 0.5% ABV 30 Litre 96.00 Keg 96.00",
+        "",
+        "Net Total 2,098.00   VAT 419.60   Gross Total 2,517.60",
+    ],
+    "beak_2_lines": [
+        "The Beak Brewery Limited",
+        "Unit 6, Lewes BN7 2AH",
+        "Invoice INV-3391   Issue Date 14/08/2024   Due Date 28/08/2024",
+        "",
+        "QTY ITEM UNIT PRICE DISCOUNT VAT LINE PRICE",
+        "3 Aloft 5% DDH pale - 30L SS £135.00 £16.875 / 12.5% 20% £354.38",
+        "2 Parade 4.2% Pale - Firkin £98.00 £0.00 / 0% 20% £196.00",
+        "",
+        "Subtotal £550.38   VAT £110.08   Total £660.46",
+    ],
+}
+
+# Extra pages seen on multi-page invoices, with the page_filter class each must get
+PAGE_SAMPLES = {
+    "terms_and_conditions": ("irrelevant", [
+        "TERMS AND CONDITIONS OF SALE",
+        "1. Payment is due within 30 days of the invoice date unless otherwise agreed in writing.",
+        "2. Prices exclude VAT, which is charged at the prevailing rate.",
+        "3. Retention of title: goods remain our property until the invoice total is paid in full.",
+        "4. Casks and kegs remain our property and must be returned empty within 8 weeks.",
+        "5. Late payment may incur interest under the Late Payment of Commercial Debts Act.",
+    ]),
+    "remittance_slip": ("irrelevant", [
+        "REMITTANCE ADVICE - please detach and return with your payment",
+        "Customer: Bench Taproom Ltd    Account: BEN001",
+        "Invoice No SI-204518   Date 02/09/2024",
+        "Amount due: 1,986.00",
+        "Invoice SI-204518 02/09/2024 1,986.00 0.00 1,986.00",
+        "Sort code 12-34-56   Account 12345678",
+    ]),
+    "totals_with_terms_footer": ("header", [
+        "Sub Total 780.00",
+        "VAT 156.00",
+        "Total 936.00",
+        "All goods are supplied subject to our terms and conditions of sale.",
+    ]),
+    "continuation_lines": ("lines", [
+        "6 Stout Keg 30L 80.00 480.00",
+        "2 Jaipur Ecask 9 Gallon 97.00 194.00",
+    ]),
+}
+
+def _escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def build_text_pdf(lines):
+    """Minimal single-page PDF (Courier 9pt). Latin-1 only, which covers £."""
+    stream = ["BT", "/F1 9 Tf", "11 TL", "36 800 Td"]
+    for line in lines:
+        stream.append(f"({_escape(line)}) '")
+    stream.append("ET")
+    content = "\n".join(stream).encode("latin-1")
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length " + str(len(content)).encode() + b" >>\nstream\n" + content + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>",
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref_at = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for off in offsets:
+        out += f"{off:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_at}\n%%EOF\n".encode()
+    return bytes(out)
+
+def main():
+    inv_dir = os.path.join(FIXTURE_DIR, "invoices")
+    os.makedirs(inv_dir, exist_ok=True)
+    for name, lines in INVOICES.items():
+        path = os.path.join(inv_dir, f"{name}.pdf")
+        with open(path, "wb") as f:
+            f.write(build_text_pdf(lines))
+        print(f"wrote {path}")
+
+if __name__ == "__main__":
+    main()
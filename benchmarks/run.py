@@ -0,0 +1,353 @@
+"""
+Invoice pipeline benchmarks. Replays the recorded fixtures against local stubs
+(no live Gemini / Shopify / Cin7 / Untappd calls) and stores timings per version.
+
+    python benchmarks/run.py                        # full run, saves results/<git-sha>.json
+    python benchmarks/run.py --quick                # smaller sizes, fewer repeats
+    python benchmarks/run.py --compare baseline     # flag regressions vs results/baseline.json
+    python benchmarks/run.py --label baseline       # save under an explicit name
+
+Stages:
+    ocr             seconds per page, raw vs preprocessed profile vs layout (chars sent to Gemini);
+                    skipped without poppler/tesseract
+    reconciliation  run_reconciliation_check vs Shopify catalog size (products per vendor)
+    matrix          create_product_matrix vs number of unmatched lines
+    end_to_end      OCR -> template parser or (fake, routed) Gemini -> frames -> reconciliation -> matrix, per fixture invoice
+    page_filter     chars / tokens each fixture invoice saves with a T&Cs page and a remittance slip
+                    appended; flags any sample page (make_fixtures.PAGE_SAMPLES) put in the wrong class
+    imports         `python -X importtime` cost of the login render and of the app modules; flags any
+                    lazily-loaded dependency (Drive discovery, Gemini, OCR) that gets imported eagerly
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from stubs import StubServer, FakeGeminiClient, load_fixture, load_gemini_reply, synthetic_catalog, FIXTURE_DIR
+from make_fixtures import INVOICES, PAGE_SAMPLES
+
+# What app.py imports before / after the login gate, and what must stay out of both
+LOGIN_IMPORTS = ["streamlit"]
+APP_IMPORTS = ["integrations", "reconciliation", "extraction", "ocr", "layout", "ocr_pool", "page_filter", "storage", "supplier_parsers", "knowledge_base"]
+LAZY_MODULES = ["googleapiclient.discovery", "google.oauth2.service_account", "google.genai", "pytesseract", "pdf2image"]
+
+FULL = {"catalog_sizes": [10, 100, 500, 2000], "line_counts": [10, 100, 500, 2000], "repeat": 5}
+QUICK = {"catalog_sizes": [10, 200], "line_counts": [10, 200], "repeat": 2}
+
+# ==========================================
+# HARNESS
+# ==========================================
+
+def time_call(fn, repeat):
+    """Runs fn `repeat` times. Returns timing stats (seconds) and the last result."""
+    samples, result = [], None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - t0)
+    samples.sort()
+    stats = {
+        "median": statistics.median(samples),
+        "min": samples[0],
+        "p95": samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))],
+        "runs": len(samples),
+    }
+    return stats, result
+
+def git_version():
+    try:
+        sha = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=REPO_ROOT).returncode != 0
+        return f"{sha}-dirty" if dirty else sha
+    except Exception: return "unknown"
+
+def ocr_available():
+    return bool(shutil.which("pdftoppm") and shutil.which("tesseract"))
+
+def quiet_streamlit():
+    # Pipeline helpers call st.progress etc.; outside `streamlit run` that only logs warnings.
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"): logging.getLogger(name).setLevel(logging.ERROR)
+
+def load_pipeline(stub, workdir):
+    """Points st.secrets at the stub server, then imports the app modules."""
+    os.makedirs(os.path.join(workdir, ".streamlit"), exist_ok=True)
+    with open(os.path.join(workdir, ".streamlit", "secrets.toml"), "w") as f:
+        f.write(stub.secrets_toml())
+    os.chdir(workdir)
+    # Fresh learned-match store per run so timings always include fuzzy matching
+    os.environ["INVOICE_DATA_DIR"] = os.path.join(workdir, "data")
+    import reconciliation, extraction, ocr, supplier_parsers
+    quiet_streamlit()
+    return reconciliation, extraction, ocr, supplier_parsers
+
+def fixture_invoices():
+    names = sorted(n for n in INVOICES if os.path.exists(os.path.join(FIXTURE_DIR, "invoices", f"{n}.pdf")))
+    out = []
+    for name in names:
+        with open(os.path.join(FIXTURE_DIR, "invoices", f"{name}.pdf"), "rb") as f:
+            out.append((name, f.read()))
+    return out
+
+def fixture_lines(extraction):
+    """All fixture line items as one frame, as they look after AI extraction."""
+    import pandas as pd
+    frames = []
+    for name in sorted(INVOICES):
+        data = extraction.parse_model_json(load_gemini_reply(name))
+        frames.append(extraction.build_invoice_frames(data)[1])
+    return pd.concat(frames, ignore_index=True)
+
+def synthetic_lines(n):
+    import pandas as pd
+    formats = [("Cask", "", "9 Gallon"), ("Steel Keg", "", "30 Litre"), ("Cans", "24", "44cl"), ("KeyKeg", "", "20 Litre")]
+    rows = []
+    for i in range(n):
+        fmt, pack, vol = formats[i % len(formats)]
+        rows.append({
+            "Supplier_Name": f"Brewery {i % 7}", "Collaborator": "", "Product_Name": f"Beer {i // 3:05d}",
+            "ABV": "4.5%", "Format": fmt, "Pack_Size": pack, "Volume": vol,
+            "Item_Price": 90.0 + (i % 11), "Quantity": 1 + i % 4, "Shopify_Status": "🟥 Check and Upload",
+        })
+    return pd.DataFrame(rows)
+
+# ==========================================
+# STAGES
+# ==========================================
+
+def bench_ocr(ocr, cfg):
+    """
+    Seconds per page with preprocessing off (plain 300dpi RGB, psm 3) vs the default profile,
+    plus the layout mode's word-box pass and the size of the text it sends to Gemini.
+    """
+    if not ocr_available(): return {"skipped": "poppler/tesseract not installed"}
+    import layout
+    raw = ocr.resolve_ocr_profile()
+    raw.update({"dpi": 300, "digital_dpi": 300, "grayscale": False, "binarize": False, "crop": False, "psm": 3})
+    modes = {"raw": raw, "preprocessed": ocr.resolve_ocr_profile()}
+    out = {}
+    for name, pdf_bytes in fixture_invoices():
+        out[name] = {}
+        for mode, profile in modes.items():
+            stats, pages = time_call(lambda: ocr.ocr_pdf(pdf_bytes, profile=profile), cfg["repeat"])
+            per_page = {k: (v / max(len(pages), 1) if k != "runs" else v) for k, v in stats.items()}
+            out[name][mode] = {"pages": len(pages), "chars": sum(len(p) for p in pages), "seconds_per_page": per_page}
+        # Layout mode: the compact header + table text that goes to Gemini instead
+        stats, (compact, _, _, pages) = time_call(lambda: layout.layout_invoice(pdf_bytes), cfg["repeat"])
+        per_page = {k: (v / max(pages, 1) if k != "runs" else v) for k, v in stats.items()}
+        out[name]["layout"] = {"pages": pages, "chars": sum(len(p) for p in compact), "seconds_per_page": per_page}
+    return out
+
+def bench_reconciliation(reconciliation, extraction, stub, cfg):
+    lines = fixture_lines(extraction)
+    recorded = load_fixture("shopify_products.json")
+    vendors = sorted(set(lines["Supplier_Name"]) | set(recorded))
+    out = {}
+    for size in cfg["catalog_sizes"]:
+        stub.shopify = {v: synthetic_catalog(v, size, recorded.get(v)) for v in vendors}
+        stats, (df, _) = time_call(lambda: reconciliation.run_reconciliation_check(lines), cfg["repeat"])
+        out[str(size)] = {"lines": len(lines), "matched": int((df["Shopify_Status"] == "✅ Match").sum()), **stats}
+    stub.shopify = recorded
+    return out
+
+def bench_matrix(reconciliation, cfg):
+    out = {}
+    for n in cfg["line_counts"]:
+        lines = synthetic_lines(n)
+        stats, matrix = time_call(lambda: reconciliation.create_product_matrix(lines), cfg["repeat"])
+        out[str(n)] = {"rows_out": len(matrix), **stats}
+    return out
+
+def bench_end_to_end(reconciliation, extraction, ocr, supplier_parsers, cfg):
+    use_ocr = ocr_available()
+    out = {}
+    for name, pdf_bytes in fixture_invoices():
+        client = FakeGeminiClient(default=load_gemini_reply(name))
+        stage_times = {}
+
+        def run():
+            t = time.perf_counter()
+            if use_ocr: text = "\n".join(ocr.ocr_invoice(pdf_bytes)[0])
+            else: text = "\n".join(INVOICES[name])
+            stage_times["ocr"] = time.perf_counter() - t
+
+            t = time.perf_counter()
+            data, _ = supplier_parsers.parse_invoice_text(text, ocr.detect_supplier(text))
+            stage_times["path"] = "template" if data else "llm"
+            if data is None:
+                tier, _ = extraction.route_model_tier(text, ocr.detect_supplier(text))
+                data, model, _ = extraction.extract_with_escalation(
+                    lambda m: extraction.extract_invoice_data(client, text, model=m), tier
+                )
+                stage_times["path"] = f"llm ({model})"
+            header_df, lines_df = extraction.build_invoice_frames(data)
+            stage_times["extract"] = time.perf_counter() - t
+
+            t = time.perf_counter()
+            checked, _ = reconciliation.run_reconciliation_check(lines_df)
+            stage_times["reconcile"] = time.perf_counter() - t
+
+            t = time.perf_counter()
+            reconciliation.create_product_matrix(checked)
+            stage_times["matrix"] = time.perf_counter() - t
+
+        stats, _ = time_call(run, cfg["repeat"])
+        out[name] = {"ocr": "tesseract" if use_ocr else "skipped (fixture text)", **stats,
+                     "last_run_stages": stage_times}
+    return out
+
+def bench_page_filter(cfg):
+    """Each fixture invoice + the T&Cs and remittance samples through reduce_pages; misclassified samples."""
+    import page_filter
+    extra = ["\n".join(PAGE_SAMPLES[n][1]) for n in ("terms_and_conditions", "remittance_slip")]
+    out = {"misclassified": []}
+    for name, (expected, lines) in PAGE_SAMPLES.items():
+        kind = page_filter.classify_page("\n".join(lines))
+        if kind != expected: out["misclassified"].append(f"{name}: {kind} (expected {expected})")
+    for name in sorted(INVOICES):
+        pages = ["\n".join(INVOICES[name])] + extra
+        stats, (_, report) = time_call(lambda: page_filter.reduce_pages(pages), cfg["repeat"])
+        out[name] = {k: report[k] for k in ("kinds", "dropped_pages", "chars_before", "chars_after", "tokens_saved")}
+        out[name].update(stats)
+    return out
+
+def import_profile(modules):
+    """
+    Runs `python -X importtime -c "import <modules>"` in a fresh interpreter.
+    Returns (seconds, loaded module names); seconds is the cumulative time of `modules`.
+    """
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + ", ".join(modules)],
+        cwd=REPO_ROOT, capture_output=True, text=True,
+    )
+    if out.returncode != 0: raise RuntimeError(out.stderr.strip().splitlines()[-1])
+    total_us, loaded = 0, set()
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line: continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit(): continue   # column header
+        loaded.add(name.strip())
+        if name.strip() in modules and not name.startswith("  "): total_us += int(cumulative)
+    return total_us / 1e6, loaded
+
+def bench_imports(cfg):
+    """Cold import time before the login page and for the app modules after it."""
+    out = {}
+    for name, modules in (("login", LOGIN_IMPORTS), ("app_modules", APP_IMPORTS)):
+        loaded = set()
+        def run():
+            seconds, mods = import_profile(modules)
+            loaded.update(mods)
+            return seconds
+        samples = sorted(run() for _ in range(cfg["repeat"]))
+        out[name] = {
+            "seconds": {"median": statistics.median(samples), "min": samples[0], "runs": len(samples)},
+            "modules": len(loaded),
+            "lazy_violations": [m for m in LAZY_MODULES if m in loaded],
+        }
+    return out
+
+# ==========================================
+# RESULTS
+# ==========================================
+
+def flatten_medians(results, prefix=""):
+    """{'matrix/100': 0.012, ...} for every timed block in the results tree."""
+    flat = {}
+    for k, v in results.items():
+        if not isinstance(v, dict): continue
+        key = f"{prefix}/{k}" if prefix else k
+        if "median" in v: flat[key] = v["median"]
+        else: flat.update(flatten_medians(v, key))
+    return flat
+
+def resolve_results_path(ref):
+    if os.path.exists(ref): return ref
+    return os.path.join(RESULTS_DIR, f"{ref}.json")
+
+def compare(current, baseline, threshold):
+    cur, base = flatten_medians(current["stages"]), flatten_medians(baseline["stages"])
+    regressions = []
+    print(f"\n{'benchmark':<48} {'base':>10} {'now':>10} {'change':>8}")
+    for key in sorted(cur):
+        if key not in base or base[key] <= 0: continue
+        change = cur[key] / base[key] - 1
+        flag = "  <-- REGRESSION" if change > threshold else ""
+        print(f"{key:<48} {base[key]:>10.4f} {cur[key]:>10.4f} {change:>+7.0%}{flag}")
+        if flag: regressions.append(key)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="Small sizes and 2 repeats (smoke run).")
+    parser.add_argument("--stages", default="ocr,reconciliation,matrix,end_to_end,page_filter,imports")
+    parser.add_argument("--label", help="Results file name (default: git short sha).")
+    parser.add_argument("--compare", help="Baseline label or path to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed slowdown before flagging (0.25 = 25%%).")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args(argv)
+
+    cfg = QUICK if args.quick else FULL
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    cwd = os.getcwd()
+
+    with StubServer() as stub, tempfile.TemporaryDirectory() as workdir:
+        reconciliation, extraction, ocr, supplier_parsers = load_pipeline(stub, workdir)
+        results = {}
+        if "ocr" in stages: results["ocr"] = bench_ocr(ocr, cfg)
+        if "reconciliation" in stages: results["reconciliation"] = bench_reconciliation(reconciliation, extraction, stub, cfg)
+        if "matrix" in stages: results["matrix"] = bench_matrix(reconciliation, cfg)
+        if "end_to_end" in stages: results["end_to_end"] = bench_end_to_end(reconciliation, extraction, ocr, supplier_parsers, cfg)
+        if "page_filter" in stages: results["page_filter"] = bench_page_filter(cfg)
+        if "imports" in stages: results["imports"] = bench_imports(cfg)
+        stub_hits = dict(stub.hits)
+        os.chdir(cwd)
+
+    report = {
+        "version": git_version(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": cfg,
+        "stub_requests": stub_hits,
+        "stages": results,
+    }
+    print(json.dumps(report["stages"], indent=2, ensure_ascii=False))
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{args.label or report['version']}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nSaved {path}")
+
+    violations = [f"{k}: {m}" for k, v in results.get("imports", {}).items() for m in v["lazy_violations"]]
+    if violations: print("\nEagerly imported (should load on first use): " + ", ".join(violations))
+    misclassified = results.get("page_filter", {}).get("misclassified", [])
+    if misclassified: print("\nPage filter misclassified: " + "; ".join(misclassified))
+
+    if args.compare:
+        with open(resolve_results_path(args.compare), encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}.")
+            return 1
+    return 1 if violations or misclassified else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
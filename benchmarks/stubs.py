@@ -0,0 +1,311 @@
+"""
+Local stand-ins for the external services, fed from the recorded fixtures.
+
+- StubServer: one HTTP server answering Shopify GraphQL (incl. staged uploads + bulk
+  productCreate), Cin7, Untappd and Drive file download routes.
+- FakeGeminiClient: quacks like genai.Client for models.generate_content.
+"""
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from types import SimpleNamespace
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURE_DIR, name), encoding="utf-8") as f:
+        return json.load(f)
+
+def load_gemini_reply(invoice_name):
+    with open(os.path.join(FIXTURE_DIR, "gemini", f"{invoice_name}.json"), encoding="utf-8") as f:
+        return f.read()
+
+def synthetic_catalog(vendor, size, seed_products=None):
+    """Pads a vendor's recorded products with generated ones up to `size` products."""
+    products = list(seed_products or [])
+    i = 0
+    while len(products) < size:
+        i += 1
+        products.append({"node": {
+            "id": f"gid://shopify/Product/S{i}", "title": f"{vendor} / Filler Beer {i:05d} / Cask",
+            "status": "ACTIVE", "format_meta": {"value": "Cask"}, "abv_meta": {"value": "4.5"},
+            "variants": {"edges": [
+                {"node": {"id": f"gid://shopify/ProductVariant/S{i}", "title": "Firkin 9 Gallon",
+                          "sku": f"L-FILL{i:05d}", "inventoryQuantity": 0}}
+            ]}}})
+    return products[:size]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "InvoiceStub/1.0"
+
+    def log_message(self, *args): pass
+
+    def _send(self, payload, code=200, content_type="application/json"):
+        if isinstance(payload, bytes): body = payload
+        else: body = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _gate(self):
+        """Applies the configured latency / rate limit. Returns False if the request was throttled."""
+        stub = self.server.stub
+        stub.count(urlparse(self.path).path)
+        if stub.latency: time.sleep(stub.latency)
+        if stub.rate_limit and not stub.take_token():
+            stub.count("429")
+            self._send({"errors": "Too Many Requests"}, code=429)
+            return False
+        return True
+
+    def do_GET(self):
+        if self.path == "/stub/hits": return self._send(dict(self.server.stub.hits))   # ungated, uncounted
+        if not self._gate(): return
+        stub = self.server.stub
+        url = urlparse(self.path)
+        qs = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        if url.path == "/cin7/product":
+            prod_id = stub.cin7["products"].get(qs.get("Sku", ""))
+            return self._send({"Products": [{"ID": prod_id, "SKU": qs.get("Sku")}] if prod_id else []})
+
+        if url.path == "/cin7/supplier":
+            suppliers = stub.cin7["suppliers"]
+            if "Name" in qs:
+                return self._send({"Suppliers": [s for s in suppliers if s["Name"] == qs["Name"]]})
+            page, limit = int(qs.get("Page", 1)), int(qs.get("Limit", 100))
+            return self._send({"SupplierList": suppliers[(page - 1) * limit: page * limit]})
+
+        if url.path.startswith("/bulk-results/"):
+            return self._send(stub.bulk_results.get(url.path.rsplit("/", 1)[-1], ""), content_type="text/jsonl")
+
+        if url.path.startswith("/drive/files/"):
+            pdf = stub.drive.get(url.path.rsplit("/", 1)[-1])
+            if pdf is None: return self._send({"error": "file not found"}, code=404)
+            return self._send(pdf, content_type="application/pdf")
+
+        if url.path == "/untappd/items/search":
+            q = qs.get("q", "").replace("-", " ").lower()
+            items = [i for i in stub.untappd["items"] if i["name"].lower() in q]
+            return self._send({"items": items})
+
+        self._send({"error": f"no stub for GET {url.path}"}, code=404)
+
+    def do_POST(self):
+        if not self._gate(): return
+        stub = self.server.stub
+        url = urlparse(self.path)
+
+        if url.path == "/staged-upload":
+            raw = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8", "ignore")
+            # Multipart body: keep the JSONL part (lines that parse as JSON objects)
+            stub.staged = [json.loads(l) for l in raw.splitlines() if l.startswith("{")]
+            return self._send({}, code=201)
+
+        body = self._read_json()
+
+        if url.path.endswith("/graphql.json") and "stagedUploadsCreate" in body.get("query", ""):
+            return self._send({"data": {"stagedUploadsCreate": {"userErrors": [], "stagedTargets": [{
+                "url": f"{stub.url}/staged-upload", "resourceUrl": None,
+                "parameters": [{"name": "key", "value": "tmp/stub/products.jsonl"}]}]}}})
+
+        if url.path.endswith("/graphql.json") and "bulkOperationRunMutation" in body.get("query", ""):
+            op_id = stub.run_bulk_product_create()
+            return self._send({"data": {"bulkOperationRunMutation": {
+                "bulkOperation": {"id": op_id, "status": "CREATED"}, "userErrors": []}}})
+
+        if url.path.endswith("/graphql.json") and "currentBulkOperation" in body.get("query", ""):
+            op_id = stub.last_bulk_id
+            return self._send({"data": {"currentBulkOperation": op_id and {
+                "id": op_id, "status": "COMPLETED", "errorCode": None, "partialDataUrl": None,
+                "objectCount": str(len(stub.staged)), "url": f"{stub.url}/bulk-results/{op_id.rsplit('/', 1)[-1]}"}}})
+
+        if url.path.endswith("/graphql.json"):
+            m = re.search(r"vendor:'(.*)'", body.get("variables", {}).get("query", ""))
+            vendor = m.group(1).replace("\\'", "'") if m else ""
+            edges = stub.shopify.get(vendor, [])
+            return self._send({"data": {"products": {
+                "pageInfo": {"hasNextPage": False, "endCursor": None}, "edges": edges}}})
+
+        if url.path == "/cin7/advanced-purchase":
+            return self._send({"ID": str(uuid.uuid4())})
+
+        if url.path == "/cin7/purchase/order":
+            return self._send({"TaskID": body.get("TaskID"), "Lines": body.get("Lines", [])})
+
+        self._send({"error": f"no stub for POST {url.path}"}, code=404)
+
+
+def stub_secrets_toml(url):
+    return (
+        f'[shopify]\nshop_url = "{url}"\naccess_token = "stub"\n\n'
+        f'[cin7]\nbase_url = "{url}/cin7"\naccount_id = "stub"\napi_key = "stub"\n\n'
+        f'[untappd]\nbase_url = "{url}/untappd"\napi_token = "stub"\n'
+    )
+
+class StubServer:
+    """
+    Threaded HTTP server on 127.0.0.1 serving the recorded fixtures.
+    `latency` (seconds) is added to every request; `rate_limit` (req/s) returns 429 when exceeded
+    (counted under hits["429"]). `drive` maps file IDs to PDF bytes for GET /drive/files/<id>.
+    """
+    def __init__(self, shopify=None, cin7=None, untappd=None, drive=None, latency=0.0, rate_limit=None):
+        self.shopify = shopify if shopify is not None else load_fixture("shopify_products.json")
+        self.cin7 = cin7 if cin7 is not None else load_fixture("cin7.json")
+        self.untappd = untappd if untappd is not None else load_fixture("untappd.json")
+        self.drive = drive or {}
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.hits = {}
+        self.staged = []
+        self.bulk_results = {}
+        self.last_bulk_id = None
+        self._lock = threading.Lock()
+        self._tokens = float(rate_limit or 0)
+        self._last_refill = time.monotonic()
+        self._httpd = None
+        self._thread = None
+
+    def count(self, path):
+        with self._lock: self.hits[path] = self.hits.get(path, 0) + 1
+
+    def take_token(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._last_refill) * self.rate_limit)
+            self._last_refill = now
+            if self._tokens < 1: return False
+            self._tokens -= 1
+            return True
+
+    def run_bulk_product_create(self):
+        """Applies the staged productCreate lines to the catalog; stores the result JSONL."""
+        n = len(self.bulk_results) + 1
+        out = []
+        for i, line in enumerate(self.staged):
+            p = line["input"]
+            pid = f"gid://shopify/Product/B{n}-{i}"
+            variants = [{"node": {"id": f"gid://shopify/ProductVariant/B{n}-{i}-{j}", "title": v["options"][0],
+                                  "sku": v.get("sku", ""), "inventoryQuantity": 0}}
+                        for j, v in enumerate(p.get("variants", []))]
+            meta = {m["key"]: m["value"] for m in p.get("metafields", [])}
+            node = {"id": pid, "title": p["title"], "status": p.get("status", "DRAFT"), "vendor": p["vendor"],
+                    "format_meta": {"value": meta.get("Format")}, "abv_meta": {"value": meta.get("ABV")},
+                    "variants": {"edges": variants}}
+            self.shopify.setdefault(p["vendor"], []).append({"node": node})
+            out.append(json.dumps({"data": {"productCreate": {"product": node, "userErrors": []}}, "__lineNumber": i}))
+        self.bulk_results[str(n)] = "\n".join(out)
+        self.last_bulk_id = f"gid://shopify/BulkOperation/{n}"
+        return self.last_bulk_id
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def secrets_toml(self):
+        """Secrets block pointing the app's integrations at this server."""
+        return stub_secrets_toml(self.url)
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.stub = self
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+
+    def __enter__(self): return self.start()
+    def __exit__(self, *exc): self.stop()
+
+
+class _FakeResponse:
+    def __init__(self, text): self.text = text
+
+class _FakeModels:
+    def __init__(self, client): self._client = client
+
+    def generate_content(self, model, contents, config=None):
+        self._client.calls.append(model)
+        if self._client.latency: time.sleep(self._client.latency)
+        return _FakeResponse(self._client.reply_for(contents))
+
+    def generate_content_stream(self, model, contents, config=None, chunk_size=64):
+        """Same reply, in chunks; `latency` is spread across them like token generation."""
+        self._client.calls.append(model)
+        text = self._client.reply_for(contents)
+        chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)] or [""]
+        for chunk in chunks:
+            if self._client.latency: time.sleep(self._client.latency / len(chunks))
+            yield _FakeResponse(chunk)
+
+class _FakeBatches:
+    """
+    Batch API: a job answers every inline request with the canned reply once it has been
+    polled `polls_to_finish` times. Set `fail_next` to make the next job end in `fail_next`
+    (e.g. "JOB_STATE_EXPIRED") with no responses.
+    """
+    def __init__(self, client, polls_to_finish=2):
+        self._client = client
+        self.polls_to_finish = polls_to_finish
+        self.fail_next = None
+        self.jobs = {}
+
+    def create(self, model, src, config=None):
+        name = f"batches/fake-{len(self.jobs) + 1}"
+        self.jobs[name] = {"model": model, "src": list(src), "polls": 0, "fail": self.fail_next}
+        self.fail_next = None
+        self._client.calls.append(f"batch:{model}")
+        return SimpleNamespace(name=name, state=SimpleNamespace(name="JOB_STATE_PENDING"), dest=None)
+
+    def get(self, name):
+        job = self.jobs[name]
+        job["polls"] += 1
+        if job["polls"] < self.polls_to_finish:
+            return SimpleNamespace(name=name, state=SimpleNamespace(name="JOB_STATE_RUNNING"), dest=None)
+        if job["fail"]:
+            return SimpleNamespace(name=name, state=SimpleNamespace(name=job["fail"]), dest=None)
+        responses = []
+        for req in job["src"]:
+            try: resp, error = _FakeResponse(self._client.reply_for(req["contents"])), None
+            except ValueError as e: resp, error = None, SimpleNamespace(message=str(e))
+            responses.append(SimpleNamespace(response=resp, metadata=req.get("metadata"), error=error))
+        return SimpleNamespace(name=name, state=SimpleNamespace(name="JOB_STATE_SUCCEEDED"),
+                               dest=SimpleNamespace(inlined_responses=responses))
+
+class FakeGeminiClient:
+    """
+    Returns canned replies. `replies` maps a marker string (e.g. the invoice number)
+    to reply text; the first marker found in the prompt wins, else `default`.
+    """
+    def __init__(self, replies=None, default=None, latency=0.0):
+        self.replies = replies or {}
+        self.default = default
+        self.latency = latency
+        self.calls = []
+        self.models = _FakeModels(self)
+        self.batches = _FakeBatches(self)
+
+    def reply_for(self, contents):
+        text = contents if isinstance(contents, str) else json.dumps(contents, default=str)
+        for marker, reply in self.replies.items():
+            if marker in text: return reply
+        if self.default is None: raise ValueError("FakeGeminiClient: no canned reply for prompt")
+        return self.default
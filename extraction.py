@@ -0,0 +1,437 @@
+import pandas as pd
+import json
+import hashlib
+import datetime
+import io
+import re
+import time
+import threading
+from thefuzz import fuzz
+
+from knowledge_base import (
+    GLOBAL_RULES_TEXT, SUPPLIER_RULEBOOK, DEFAULT_EXTRACTION_MODE, EXTRACTION_MODES,
+    MODEL_TIERS, TIER_ORDER, TIER_SIZE_LIMITS, DEFAULT_DIFFICULTY, SUPPLIER_DIFFICULTY
+)
+from reconciliation import normalize_supplier_names
+from rule_engine import normalize_lines
+from supplier_parsers import check_totals, to_number
+
+# ==========================================
+# AI EXTRACTION (OCR Text -> Header + Lines)
+# ==========================================
+
+DEFAULT_MODEL = 'gemini-2.5-flash'
+
+# google.genai takes longer to import than the rest of the app put together, so it
+# loads on the first extraction call rather than on every rerun.
+def genai_types():
+    from google.genai import types
+    return types
+
+def get_genai_client(api_key):
+    from google import genai
+    return genai.Client(api_key=api_key)
+
+LINE_COLUMNS = ["Supplier_Name", "Collaborator", "Product_Name", "ABV", "Format", "Pack_Size", "Volume", "Item_Price", "Quantity"]
+
+# --- PROMPT (Stable prefix + per-invoice suffix) ---
+def build_prompt_prefix():
+    """Everything that only changes when knowledge_base.py changes."""
+    return f"""
+    Extract invoice data to JSON.
+    STRUCTURE:
+    {{
+        "header": {{
+            "Payable_To": "Supplier Name", "Invoice_Number": "...", "Issue_Date": "...",
+            "Payment_Terms": "...", "Due_Date": "...", "Total_Net": 0.00,
+            "Total_VAT": 0.00, "Total_Gross": 0.00, "Total_Discount_Amount": 0.00, "Shipping_Charge": 0.00
+        }},
+        "line_items": [
+            {{
+                "Supplier_Name": "...", "Collaborator": "...", "Product_Name": "...", "ABV": "...",
+                "Format": "...", "Pack_Size": "...", "Volume": "...", "Quantity": 1, "Item_Price": 10.00
+            }}
+        ]
+    }}
+    SUPPLIER RULEBOOK: {json.dumps(SUPPLIER_RULEBOOK)}
+    GLOBAL RULES: {GLOBAL_RULES_TEXT}
+    """
+
+def build_prompt_suffix(full_text, custom_rule=""):
+    injected = f"\n!!! USER OVERRIDE !!!\n{custom_rule}\n" if custom_rule else ""
+    return f"""
+    {injected}
+    INVOICE TEXT:
+    {full_text}
+    """
+
+def build_document_suffix(custom_rule=""):
+    injected = f"\n!!! USER OVERRIDE !!!\n{custom_rule}\n" if custom_rule else ""
+    return f"""
+    {injected}
+    INVOICE: the attached document (read every page).
+    """
+
+def build_extraction_prompt(full_text, custom_rule=""):
+    return build_prompt_prefix() + build_prompt_suffix(full_text, custom_rule)
+
+# --- CONTEXT CACHE (Rulebook prefix stored server-side) ---
+CACHE_PREFIX = "invoice-rulebook"
+CACHE_TTL_SECONDS = 3600
+CACHE_REFRESH_MARGIN = datetime.timedelta(minutes=2)
+
+_cache_lock = threading.Lock()
+_cache_names = {}    # (model, display_name) -> (cache name, expire_time)
+
+def prefix_cache_key(prefix):
+    """display_name for the cache; a knowledge_base edit changes the hash and so the cache."""
+    return f"{CACHE_PREFIX}-{hashlib.sha256(prefix.encode()).hexdigest()[:16]}"
+
+def _still_valid(expire_time):
+    if expire_time is None: return True
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return expire_time - CACHE_REFRESH_MARGIN > now
+
+def get_rulebook_cache(client, model, prefix):
+    """
+    Name of a live cached-content entry holding `prefix` for `model`, creating it if needed.
+    Returns None if caching isn't available (old SDK, prefix below the model minimum, API error).
+    """
+    if not hasattr(client, "caches"): return None
+    display_name = prefix_cache_key(prefix)
+    key = (model, display_name)
+    with _cache_lock:
+        known = _cache_names.get(key)
+        if known and _still_valid(known[1]): return known[0]
+        try:
+            stale = []
+            for c in client.caches.list():
+                if not (c.display_name or "").startswith(CACHE_PREFIX) or not (c.model or "").endswith(model): continue
+                if c.display_name == display_name and _still_valid(c.expire_time):
+                    _cache_names[key] = (c.name, c.expire_time)
+                    return c.name
+                stale.append(c.name)
+            cache = client.caches.create(
+                model=model,
+                config=genai_types().CreateCachedContentConfig(
+                    display_name=display_name, contents=[prefix], ttl=f"{CACHE_TTL_SECONDS}s"
+                ),
+            )
+            _cache_names[key] = (cache.name, cache.expire_time)
+            # Old rulebook versions for this model are no longer useful
+            for name in stale:
+                try: client.caches.delete(name=name)
+                except Exception: pass
+            return cache.name
+        except Exception:
+            # Back off for a while rather than retrying on every invoice
+            _cache_names[key] = (None, datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=10))
+            return None
+
+def forget_rulebook_cache(model=None):
+    with _cache_lock:
+        for key in [k for k in _cache_names if model is None or k[0] == model]:
+            _cache_names.pop(key, None)
+
+# --- GENERATION ---
+def parse_model_json(text):
+    """Strips markdown fences from the model reply. Raises ValueError on bad JSON."""
+    json_text = text.strip().replace("```json", "").replace("```", "")
+    return json.loads(json_text)
+
+def generate_with_rulebook(client, model, contents, use_cache=True):
+    """
+    Sends the rulebook prefix + `contents` (a string, or a list of parts ending in text).
+    The prefix comes from the context cache when one is available.
+    """
+    prefix = build_prompt_prefix()
+    cache_name = get_rulebook_cache(client, model, prefix) if use_cache else None
+    if cache_name:
+        try:
+            response = client.models.generate_content(
+                model=model, contents=contents,
+                config=genai_types().GenerateContentConfig(cached_content=cache_name),
+            )
+            return response.text
+        except Exception:
+            # Expired or deleted under us: drop it and send the full prompt this time
+            forget_rulebook_cache(model)
+    if isinstance(contents, str): full = prefix + contents
+    else: full = [prefix] + list(contents)
+    response = client.models.generate_content(model=model, contents=full)
+    return response.text
+
+def extract_invoice_data(client, full_text, custom_rule="", model=DEFAULT_MODEL, use_cache=True):
+    return generate_with_rulebook(client, model, build_prompt_suffix(full_text, custom_rule), use_cache)
+
+# --- STREAMING (Header + line items as soon as each object closes) ---
+class IncrementalInvoiceParser:
+    """
+    Feed it reply chunks; returns ("header", dict) / ("line", dict) events as the
+    header object and each line_items object complete. Tolerates the ```json fence.
+    """
+    def __init__(self):
+        self.buf = ""
+        self.pos = 0
+        self.stack = []          # [bracket, key_in_parent, start, last_key]
+        self.in_string = False
+        self.escape = False
+        self.string_start = 0
+        self.last_string = None
+
+    def feed(self, chunk):
+        events = []
+        self.buf += chunk
+        buf = self.buf
+        for i in range(self.pos, len(buf)):
+            ch = buf[i]
+            if self.in_string:
+                if self.escape: self.escape = False
+                elif ch == "\\": self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    self.last_string = buf[self.string_start:i]
+                continue
+            if not self.stack and ch != "{": continue
+            if ch == '"':
+                self.in_string, self.string_start = True, i + 1
+            elif ch == ":" and self.stack:
+                self.stack[-1][3] = self.last_string
+            elif ch in "{[":
+                parent_key = self.stack[-1][3] if self.stack and self.stack[-1][0] == "{" else None
+                if self.stack and self.stack[-1][0] == "[": parent_key = self.stack[-1][1]
+                self.stack.append([ch, parent_key, i, None])
+            elif ch in "}]" and self.stack:
+                bracket, key, start, _ = self.stack.pop()
+                if bracket != "{": continue
+                if len(self.stack) == 1 and key == "header":
+                    events.append(("header", self._load(buf[start:i + 1])))
+                elif len(self.stack) == 2 and self.stack[-1][0] == "[" and key == "line_items":
+                    events.append(("line", self._load(buf[start:i + 1])))
+        self.pos = len(buf)
+        return [e for e in events if e[1] is not None]
+
+    @staticmethod
+    def _load(text):
+        try: return json.loads(text)
+        except ValueError: return None
+
+def stream_with_rulebook(client, model, contents, use_cache=True):
+    """Like generate_with_rulebook, but yields reply text chunks."""
+    prefix = build_prompt_prefix()
+    cache_name = get_rulebook_cache(client, model, prefix) if use_cache else None
+    if cache_name:
+        started = False
+        try:
+            for chunk in client.models.generate_content_stream(
+                model=model, contents=contents,
+                config=genai_types().GenerateContentConfig(cached_content=cache_name),
+            ):
+                started = True
+                yield chunk.text or ""
+            return
+        except Exception:
+            # Only safe to retry if nothing has been shown yet
+            if started: raise
+            forget_rulebook_cache(model)
+    if isinstance(contents, str): full = prefix + contents
+    else: full = [prefix] + list(contents)
+    for chunk in client.models.generate_content_stream(model=model, contents=full):
+        yield chunk.text or ""
+
+def stream_invoice_reply(client, model, contents, on_header=None, on_line=None, use_cache=True):
+    """
+    Streams the extraction for `contents` (a prompt suffix or document parts), calling
+    on_header(dict) / on_line(dict) as objects complete. Returns the full reply text.
+    """
+    parser, chunks = IncrementalInvoiceParser(), []
+    for text in stream_with_rulebook(client, model, contents, use_cache):
+        chunks.append(text)
+        for kind, obj in parser.feed(text):
+            if kind == "header" and on_header: on_header(obj)
+            elif kind == "line" and on_line: on_line(obj)
+    return "".join(chunks)
+
+# --- DIRECT DOCUMENT MODES (No local OCR) ---
+AUTO_MODE = "auto"
+EXTRACTION_MODE_LABELS = {
+    AUTO_MODE: "Auto (per supplier)",
+    "ocr": "OCR + Text",
+    "layout": "OCR Layout Table",
+    "pdf": "Direct PDF",
+    "images": "Page Images",
+}
+IMAGE_MODE_DPI = 150
+IMAGE_MODE_MAX_SIDE = 1600
+
+def page_image_parts(pdf_bytes, dpi=IMAGE_MODE_DPI, max_side=IMAGE_MODE_MAX_SIDE):
+    from ocr import pdf_to_images, resolve_ocr_profile
+    parts = []
+    for img in pdf_to_images(pdf_bytes, dpi=dpi, profile=resolve_ocr_profile()):
+        img.thumbnail((max_side, max_side))
+        buf = io.BytesIO()
+        img.convert("L").save(buf, format="JPEG", quality=80)
+        parts.append(genai_types().Part.from_bytes(data=buf.getvalue(), mime_type="image/jpeg"))
+    return parts
+
+def build_document_contents(pdf_bytes, custom_rule="", mode="pdf"):
+    if mode == "images": parts = page_image_parts(pdf_bytes)
+    else: parts = [genai_types().Part.from_bytes(data=pdf_bytes, mime_type="application/pdf")]
+    return parts + [build_document_suffix(custom_rule)]
+
+def extract_invoice_from_document(client, pdf_bytes, custom_rule="", model=DEFAULT_MODEL, mode="pdf", use_cache=True):
+    """Same schema & rulebook as the OCR path, but Gemini reads the PDF (or page images) itself."""
+    return generate_with_rulebook(client, model, build_document_contents(pdf_bytes, custom_rule, mode), use_cache)
+
+def choose_extraction_mode(choice, pdf_bytes=None, supplier=None):
+    """(mode, supplier). AUTO_MODE looks the supplier up in EXTRACTION_MODES via the PDF text layer."""
+    if choice != AUTO_MODE: return choice, supplier
+    if not supplier and pdf_bytes:
+        from ocr import detect_supplier, pdf_text_layer
+        supplier = detect_supplier(pdf_text_layer(pdf_bytes))
+    return EXTRACTION_MODES.get(supplier, DEFAULT_EXTRACTION_MODE), supplier
+
+# --- MODEL ROUTING (Cheapest tier first, escalate on failed validation) ---
+AUTO_TIER = "auto"
+# OCR rows that end in a money amount: a rough count of line items (plus a few totals)
+MONEY_ROW_RE = re.compile(r"\d[\d,]*\.\d{2}\s*$", re.MULTILINE)
+
+def estimate_line_count(text):
+    return len(MONEY_ROW_RE.findall(text or ""))
+
+def route_model_tier(text="", supplier=None, pages=1):
+    """(tier, reason) from OCR text size, estimated lines and the supplier's difficulty."""
+    difficulty = SUPPLIER_DIFFICULTY.get(supplier, DEFAULT_DIFFICULTY)
+    scale = 2 if difficulty == "easy" else 1
+    # Document modes have no text: assume a dense page
+    chars = len(text) if text else pages * 3000
+    lines = estimate_line_count(text) if text else pages * 25
+
+    tier = TIER_ORDER[-1]
+    for name in TIER_ORDER[:-1]:
+        limits = TIER_SIZE_LIMITS[name]
+        if chars <= limits["chars"] * scale and lines <= limits["lines"] * scale:
+            tier = name
+            break
+    if difficulty == "hard" and TIER_ORDER.index(tier) < TIER_ORDER.index("flash"):
+        tier = "flash"
+    return tier, f"{chars} chars, ~{lines} rows, {difficulty}"
+
+def validate_extraction(data):
+    """(ok, reason). The templates' totals check; a reply with no Total_Net is not escalated."""
+    if not data.get("line_items"): return False, "no line items"
+    return check_totals(data, require_net=False)
+
+def extract_with_escalation(generate, start_tier, on_attempt=None):
+    """
+    Calls generate(model) -> reply text from `start_tier` upwards until the parsed result
+    validates. Returns (data, model, attempts); data is the strongest tier's parse when
+    nothing validates. Raises ValueError if no tier returned usable JSON.
+    """
+    attempts, best = [], None
+    for tier in TIER_ORDER[TIER_ORDER.index(start_tier):]:
+        model = MODEL_TIERS[tier]
+        t0 = time.perf_counter()
+        try:
+            data = parse_model_json(generate(model))
+            ok, reason = validate_extraction(data)
+            best = (data, model)
+        except Exception as e:
+            ok, reason = False, f"error: {str(e)[:120]}"
+        attempt = {"tier": tier, "model": model, "seconds": time.perf_counter() - t0, "ok": ok, "reason": reason}
+        attempts.append(attempt)
+        if on_attempt: on_attempt(attempt)
+        if ok: break
+    if best is None: raise ValueError(f"No model returned valid JSON ({attempts[-1]['reason']})")
+    return best[0], best[1], attempts
+
+# --- MODE COMPARISON ---
+HEADER_CHECK_FIELDS = ["Invoice_Number", "Total_Net", "Total_VAT", "Total_Gross"]
+
+def _same_value(a, b):
+    na, nb = to_number(a), to_number(b)
+    if na is not None and nb is not None: return abs(na - nb) < 0.015
+    return str(a or "").strip().lower() == str(b or "").strip().lower()
+
+def score_extraction(data, reference):
+    """Field-level agreement of `data` with `reference` (ground truth or another mode's output)."""
+    header, ref_header = data.get("header", {}), reference.get("header", {})
+    header_hits = sum(_same_value(header.get(f), ref_header.get(f)) for f in HEADER_CHECK_FIELDS)
+
+    lines, ref_lines = list(data.get("line_items", [])), reference.get("line_items", [])
+    matched, price_hits = 0, 0
+    for ref in ref_lines:
+        best, best_score = None, 0
+        for i, line in enumerate(lines):
+            if not _same_value(line.get("Quantity"), ref.get("Quantity")): continue
+            score = fuzz.token_sort_ratio(str(line.get("Product_Name", "")), str(ref.get("Product_Name", "")))
+            if str(line.get("Format", "")).lower() == str(ref.get("Format", "")).lower(): score += 5
+            if score > best_score: best, best_score = i, score
+        if best is None or best_score < 85: continue
+        matched += 1
+        if _same_value(lines[best].get("Item_Price"), ref.get("Item_Price")): price_hits += 1
+        lines.pop(best)
+
+    return {
+        "header_acc": header_hits / len(HEADER_CHECK_FIELDS),
+        "line_recall": matched / len(ref_lines) if ref_lines else 1.0,
+        "line_precision": matched / len(data.get("line_items", [])) if data.get("line_items") else 0.0,
+        "price_acc": price_hits / matched if matched else 0.0,
+    }
+
+def compare_extraction_modes(client, pdf_bytes, modes=("ocr", "layout", "pdf", "images"), model=DEFAULT_MODEL,
+                             reference=None, supplier=None, custom_rule=""):
+    """
+    Runs each mode on one PDF. Returns one dict per mode with timings, totals check and
+    accuracy vs `reference` (defaults to the OCR result, i.e. agreement with today's path).
+    """
+    from ocr import AUTO_PROFILE
+    from ocr_pool import pooled_ocr_invoice, pooled_layout_invoice
+    rows, outputs = [], {}
+    for mode in modes:
+        row = {"mode": EXTRACTION_MODE_LABELS.get(mode, mode), "ocr_s": 0.0}
+        t0 = time.perf_counter()
+        try:
+            if mode == "ocr":
+                texts, _, _ = pooled_ocr_invoice(pdf_bytes, supplier or AUTO_PROFILE)
+                row["ocr_s"] = time.perf_counter() - t0
+                reply = extract_invoice_data(client, "\n".join(texts), custom_rule, model)
+                row["prompt_chars"] = sum(len(t) for t in texts)
+            elif mode == "layout":
+                texts, _, _, _ = pooled_layout_invoice(pdf_bytes, supplier or AUTO_PROFILE)
+                row["ocr_s"] = time.perf_counter() - t0
+                reply = extract_invoice_data(client, "\n".join(texts), custom_rule, model)
+                row["prompt_chars"] = sum(len(t) for t in texts)
+            else:
+                reply = extract_invoice_from_document(client, pdf_bytes, custom_rule, model, mode=mode)
+            data = parse_model_json(reply)
+            outputs[mode] = data
+            row["total_s"] = time.perf_counter() - t0
+            row["lines"] = len(data.get("line_items", []))
+            row["totals_ok"], _ = check_totals(data)
+        except Exception as e:
+            row["total_s"] = time.perf_counter() - t0
+            row["error"] = str(e)[:200]
+        rows.append(row)
+
+    ref = reference or outputs.get("ocr")
+    for mode, row in zip(modes, rows):
+        if ref and mode in outputs: row.update(score_extraction(outputs[mode], ref))
+    return rows
+
+def build_invoice_frames(data, master_suppliers=None):
+    """Turns the parsed JSON into the (header_df, lines_df) pair the UI edits."""
+    header_df = pd.DataFrame([data['header']])
+    # Init Cin7 columns
+    header_df['Cin7_Supplier_ID'] = ""
+    header_df['Cin7_Supplier_Name'] = ""
+
+    df_lines = pd.DataFrame(data['line_items'])
+    df_lines = normalize_lines(df_lines)
+    if master_suppliers:
+        df_lines = normalize_supplier_names(df_lines, master_suppliers)
+
+    # Initialize columns so Matrix generation doesn't fail on first run
+    df_lines['Shopify_Status'] = "Pending"
+    existing = [c for c in LINE_COLUMNS if c in df_lines.columns]
+    return header_df, df_lines[existing]
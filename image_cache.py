@@ -0,0 +1,164 @@
+import io
+import os
+import base64
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+
+import pandas as pd
+
+from storage import connect, data_path, now_iso
+
+# ==========================================
+# IMAGE CACHE (Remote label / product images -> local thumbnails)
+# ==========================================
+# Each URL is downloaded once, shrunk to a small JPEG and stored under data/images/
+# by the hash of the thumbnail bytes (the same label on cask, keg and can variants is
+# stored once). Tables get data: URIs, so reruns never wait on the Shopify/Untappd CDNs.
+
+IMAGE_DB = "images.sqlite"
+IMAGE_DIR = "images"
+THUMB_SIZE = 96                       # px, longest side; the table cells are ~40px
+THUMB_QUALITY = 80
+IMAGE_CACHE_MAX_BYTES = 50 * 1024 * 1024
+FETCH_TIMEOUT = 5
+FETCH_WORKERS = 8
+MAX_SOURCE_BYTES = 10 * 1024 * 1024   # refuse anything bigger than a sane label image
+MEMO_LIMIT = 5000
+
+_memo_lock = threading.Lock()
+_memo = {}    # url -> data URI (or the url itself when it could not be cached)
+
+def _init_images(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS image_cache (
+            url TEXT PRIMARY KEY, content_hash TEXT NOT NULL, size INTEGER NOT NULL, last_used TEXT
+        )""")
+
+def blob_path(content_hash):
+    folder = data_path(IMAGE_DIR)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{content_hash}.jpg")
+
+def make_thumbnail(raw, size=THUMB_SIZE):
+    """JPEG bytes no larger than size x size. Transparent labels go on white."""
+    from PIL import Image
+    img = Image.open(io.BytesIO(raw))
+    img.thumbnail((size, size))
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        bg = Image.new("RGB", img.size, "white")
+        bg.paste(img, mask=img.split()[-1])
+        img = bg
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, format="JPEG", quality=THUMB_QUALITY, optimize=True)
+    return buf.getvalue()
+
+def fetch_image(url, timeout=FETCH_TIMEOUT):
+    req = Request(url, headers={"User-Agent": "invoice-parser-image-cache"})
+    with urlopen(req, timeout=timeout) as r:
+        raw = r.read(MAX_SOURCE_BYTES + 1)
+    if len(raw) > MAX_SOURCE_BYTES: raise ValueError("image too large")
+    return raw
+
+def to_data_uri(thumb):
+    return "data:image/jpeg;base64," + base64.b64encode(thumb).decode("ascii")
+
+def _read_cached(urls):
+    """{url: thumbnail bytes} for urls already on disk; touches last_used."""
+    found = {}
+    with connect(IMAGE_DB) as conn:
+        _init_images(conn)
+        for i in range(0, len(urls), 500):
+            chunk = urls[i:i + 500]
+            rows = conn.execute(
+                f"SELECT url, content_hash FROM image_cache WHERE url IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            for r in rows:
+                try:
+                    with open(blob_path(r["content_hash"]), "rb") as f: found[r["url"]] = f.read()
+                except OSError: pass    # blob evicted or deleted; refetch
+        if found:
+            stamp = now_iso()
+            conn.executemany("UPDATE image_cache SET last_used = ? WHERE url = ?", [(stamp, u) for u in found])
+    return found
+
+def _store(thumb):
+    content_hash = hashlib.sha256(thumb).hexdigest()
+    path = blob_path(content_hash)
+    if not os.path.exists(path):
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f: f.write(thumb)
+        os.replace(tmp, path)
+    return content_hash
+
+def _download(url):
+    try: return url, make_thumbnail(fetch_image(url))
+    except Exception: return url, None
+
+def evict_images(max_bytes=IMAGE_CACHE_MAX_BYTES):
+    """Drops least recently used entries until the blobs fit in max_bytes. Returns files removed."""
+    removed = 0
+    with connect(IMAGE_DB) as conn:
+        _init_images(conn)
+        rows = conn.execute(
+            "SELECT content_hash, MAX(size) AS size, MAX(last_used) AS last_used FROM image_cache "
+            "GROUP BY content_hash ORDER BY last_used"
+        ).fetchall()
+        total = sum(r["size"] for r in rows)
+        for r in rows:
+            if total <= max_bytes: break
+            conn.execute("DELETE FROM image_cache WHERE content_hash = ?", (r["content_hash"],))
+            try:
+                os.remove(blob_path(r["content_hash"]))
+                removed += 1
+            except OSError: pass
+            total -= r["size"]
+    return removed
+
+def cached_thumbnails(urls, max_workers=FETCH_WORKERS):
+    """
+    {url: data URI} for every http(s) url. Memory first, then disk, then one concurrent
+    download per missing url. A url that cannot be fetched maps to itself, so the
+    browser still tries it directly.
+    """
+    wanted = {str(u).strip() for u in urls if isinstance(u, str) and u.strip().lower().startswith(("http://", "https://"))}
+    with _memo_lock:
+        out = {u: _memo[u] for u in wanted if u in _memo}
+    missing = sorted(wanted - set(out))
+    if not missing: return out
+
+    fresh = {u: to_data_uri(t) for u, t in _read_cached(missing).items()}
+    to_fetch = [u for u in missing if u not in fresh]
+    if to_fetch:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(to_fetch))) as pool:
+            downloaded = list(pool.map(_download, to_fetch))
+        stamp, rows = now_iso(), []
+        for url, thumb in downloaded:
+            if thumb is None:
+                fresh[url] = url
+                continue
+            rows.append((url, _store(thumb), len(thumb), stamp))
+            fresh[url] = to_data_uri(thumb)
+        if rows:
+            with connect(IMAGE_DB) as conn:
+                _init_images(conn)
+                conn.executemany("INSERT OR REPLACE INTO image_cache (url, content_hash, size, last_used) VALUES (?, ?, ?, ?)", rows)
+            evict_images()
+
+    with _memo_lock:
+        if len(_memo) + len(fresh) > MEMO_LIMIT: _memo.clear()
+        _memo.update(fresh)
+    out.update(fresh)
+    return out
+
+def with_thumbnails(df, src_col, dst_col):
+    """Copy of df with dst_col holding cached thumbnails for the image URLs in src_col."""
+    out = df.copy()
+    if src_col not in out.columns:
+        out[dst_col] = ""
+        return out
+    uris = cached_thumbnails(out[src_col].tolist())
+    out[dst_col] = [uris.get(str(u).strip(), "") if pd.notna(u) else "" for u in out[src_col]]
+    return out
@@ -0,0 +1,207 @@
+"""
+Background ingester: runs new invoices through OCR / Gemini / Check Inventory before
+anyone opens them, and saves the result to the invoice history. In the app the file then
+shows as "Already processed" and "Load Saved Result" opens it with nothing to wait for.
+
+    python ingest.py                                   # watch data/inbox
+    python ingest.py --inbox /srv/invoices --drive-folder <FOLDER_ID> --poll-seconds 300
+    python ingest.py --once                            # process what is there now, then exit
+
+Uses the app's secrets (.streamlit/secrets.toml in the working directory): GOOGLE_API_KEY
+(or the env var), shopify / cin7 for the inventory check, connections.gsheets for Drive and
+the master supplier list. The inbox is watched with inotify when `inotify_simple` is
+installed, otherwise rescanned every --scan-seconds. Finished PDFs move to inbox/done/,
+failures to inbox/failed/ next to a .error.txt.
+"""
+import argparse
+import logging
+import os
+import shutil
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+from storage import data_path, now_iso, pdf_hashes, find_invoice, save_invoice, processed_drive_files
+
+log = logging.getLogger("ingest")
+
+STABLE_SECONDS = 1.0     # a PDF must stop growing for this long before it is read
+DONE_DIR, FAILED_DIR = "done", "failed"
+
+def secret(name):
+    try: return st.secrets[name]
+    except Exception: return None
+
+class Ingester:
+    """Runs PDFs through the pipeline on a small thread pool; one job per PDF hash at a time."""
+    def __init__(self, client, workers=2, check=True, master_suppliers=None, extraction_choice=None):
+        self.client = client
+        self.extraction_choice = extraction_choice
+        self.check = check
+        self.master_suppliers = master_suppliers or []
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+        self.lock = threading.Lock()
+        self.in_flight = set()
+
+    def submit(self, pdf_bytes, source_name, drive_id="", on_done=None):
+        return self.pool.submit(self._run, pdf_bytes, source_name, drive_id, on_done or (lambda ok, err: None))
+
+    def _run(self, pdf_bytes, source_name, drive_id, on_done):
+        pdf_hash, pdf_md5 = pdf_hashes(pdf_bytes)
+        with self.lock:
+            duplicate = pdf_hash in self.in_flight
+            if not duplicate: self.in_flight.add(pdf_hash)
+        if duplicate:
+            log.info("%s: same PDF already being processed, skipping", source_name)
+            on_done(True, None)
+            return "duplicate"
+        try:
+            if find_invoice(pdf_hash=pdf_hash):
+                log.info("%s: already processed, skipping", source_name)
+                on_done(True, None)
+                return "skipped"
+            self.process(pdf_bytes, pdf_hash, pdf_md5, source_name, drive_id)
+            on_done(True, None)
+            return "processed"
+        except Exception as e:
+            log.exception("%s: failed", source_name)
+            on_done(False, e)
+            return "failed"
+        finally:
+            with self.lock: self.in_flight.discard(pdf_hash)
+
+    def process(self, pdf_bytes, pdf_hash, pdf_md5, source_name, drive_id=""):
+        from pipeline import process_pdf
+        from extraction import AUTO_MODE
+        from reconciliation import run_reconciliation_check
+        t0 = time.perf_counter()
+        result = process_pdf(
+            pdf_bytes, self.client, extraction_choice=self.extraction_choice or AUTO_MODE,
+            master_suppliers=self.master_suppliers, pdf_hash=pdf_hash,
+            log=lambda msg: log.info("%s: %s", source_name, msg.strip()),
+        )
+        lines, meta = result["lines"], dict(result["meta"])
+        if self.check and secret("shopify"):
+            lines, _ = run_reconciliation_check(lines)
+            meta["checked"] = True
+        meta.update({"ingested_at": now_iso(), "ingest_seconds": round(time.perf_counter() - t0, 2)})
+        save_invoice(pdf_hash, result["header"], lines, pdf_md5=pdf_md5, source_name=source_name,
+                     drive_id=drive_id, meta=meta)
+        matched = int((lines['Shopify_Status'] == "✅ Match").sum()) if 'Shopify_Status' in lines.columns else 0
+        log.info("%s: ready (%d lines, %d matched, %.1fs)", source_name, len(lines), matched, meta["ingest_seconds"])
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+# --- LOCAL INBOX ---
+def wait_until_stable(path, timeout=60):
+    """True once the file size stops changing (the copy into the inbox has finished)."""
+    last, since, deadline = -1, time.monotonic(), time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try: size = os.path.getsize(path)
+        except OSError: return False
+        if size != last: last, since = size, time.monotonic()
+        elif size > 0 and time.monotonic() - since >= STABLE_SECONDS: return True
+        time.sleep(0.2)
+    return False
+
+def file_inbox(inbox, name, ok, err):
+    target = os.path.join(inbox, DONE_DIR if ok else FAILED_DIR)
+    os.makedirs(target, exist_ok=True)
+    try:
+        shutil.move(os.path.join(inbox, name), os.path.join(target, name))
+        if err:
+            with open(os.path.join(target, f"{name}.error.txt"), "w", encoding="utf-8") as f: f.write(str(err))
+    except OSError as e:
+        log.warning("%s: could not move out of the inbox: %s", name, e)
+
+def ingest_inbox_file(ingester, inbox, name, seen):
+    path = os.path.join(inbox, name)
+    if not name.lower().endswith(".pdf") or name in seen or not os.path.isfile(path): return
+    if not wait_until_stable(path): return
+    seen.add(name)
+    with open(path, "rb") as f: pdf_bytes = f.read()
+
+    def done(ok, err):
+        file_inbox(inbox, name, ok, err)
+        seen.discard(name)
+    ingester.submit(pdf_bytes, name, on_done=done)
+
+def watch_inbox(ingester, inbox, stop, scan_seconds=5, once=False):
+    seen = set()
+    for name in sorted(os.listdir(inbox)): ingest_inbox_file(ingester, inbox, name, seen)
+    if once: return
+    try:
+        from inotify_simple import INotify, flags
+    except ImportError:
+        log.info("Watching %s (rescan every %ss; pip install inotify_simple for instant pickup)", inbox, scan_seconds)
+        while not stop.wait(scan_seconds):
+            for name in sorted(os.listdir(inbox)): ingest_inbox_file(ingester, inbox, name, seen)
+        return
+    log.info("Watching %s (inotify)", inbox)
+    with INotify() as ino:
+        ino.add_watch(inbox, flags.CLOSE_WRITE | flags.MOVED_TO)
+        while not stop.is_set():
+            for event in ino.read(timeout=1000):
+                ingest_inbox_file(ingester, inbox, event.name, seen)
+
+# --- GOOGLE DRIVE ---
+def poll_drive(ingester, folder_id, stop, poll_seconds=300, once=False):
+    from integrations import list_files_in_folder, download_file_from_drive
+    if not once: log.info("Polling Drive folder %s every %ss", folder_id, poll_seconds)
+    while True:
+        done_by_id, done_by_md5 = processed_drive_files()
+        for f in list_files_in_folder(folder_id):
+            if stop.is_set(): break
+            if f['id'] in done_by_id or f.get('md5Checksum') in done_by_md5: continue
+            stream = download_file_from_drive(f['id'])
+            if stream is None: continue
+            ingester.submit(stream.read(), f['name'], drive_id=f['id']).result()   # one download in flight
+        if once or stop.wait(poll_seconds): break
+
+def main(argv=None):
+    from extraction import EXTRACTION_MODE_LABELS, AUTO_MODE
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--inbox", default=None, help="Folder to watch (default: data/inbox).")
+    parser.add_argument("--drive-folder", default=None, help="Also poll this Drive folder ID.")
+    parser.add_argument("--poll-seconds", type=int, default=300)
+    parser.add_argument("--scan-seconds", type=int, default=5, help="Inbox rescan interval without inotify.")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--mode", default=None, choices=list(EXTRACTION_MODE_LABELS),
+                        help=f"Extraction mode (default {AUTO_MODE}): " + ", ".join(
+                            f"{k} = {v}" for k, v in EXTRACTION_MODE_LABELS.items()))
+    parser.add_argument("--no-check", action="store_true", help="Skip Check Inventory (extraction only).")
+    parser.add_argument("--once", action="store_true", help="Process the current inbox / Drive listing and exit.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    api_key = secret("GOOGLE_API_KEY") or os.environ.get("GOOGLE_API_KEY")
+    if not api_key:
+        log.error("No GOOGLE_API_KEY in secrets or environment.")
+        return 2
+    from extraction import get_genai_client
+    from integrations import get_master_supplier_list
+    ingester = Ingester(get_genai_client(api_key), workers=args.workers, check=not args.no_check,
+                        master_suppliers=get_master_supplier_list(), extraction_choice=args.mode)
+
+    inbox = args.inbox or data_path("inbox")
+    os.makedirs(inbox, exist_ok=True)
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM): signal.signal(sig, lambda *_: stop.set())
+
+    watchers = [threading.Thread(target=watch_inbox, args=(ingester, inbox, stop, args.scan_seconds, args.once), daemon=True)]
+    if args.drive_folder:
+        watchers.append(threading.Thread(
+            target=poll_drive, args=(ingester, args.drive_folder, stop, args.poll_seconds, args.once), daemon=True
+        ))
+    for w in watchers: w.start()
+    while any(w.is_alive() for w in watchers): time.sleep(0.5)
+    ingester.shutdown()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
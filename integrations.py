@@ -0,0 +1,656 @@
+import streamlit as st
+import pandas as pd
+import json
+import io
+import re
+import time
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+from thefuzz import process
+
+from storage import claim_export, record_export
+
+# ==========================================
+# EXTERNAL SERVICES (Drive, Untappd, Shopify, Cin7, Sheets)
+# ==========================================
+
+# Google clients are slow to import (API discovery pulls in most of googleapiclient),
+# so they load on first use instead of on every Streamlit rerun / login render.
+def google_drive_api():
+    """(service_account, build, MediaIoBaseDownload), imported on first Drive call."""
+    from google.oauth2 import service_account
+    from googleapiclient.discovery import build
+    from googleapiclient.http import MediaIoBaseDownload
+    return service_account, build, MediaIoBaseDownload
+
+def gsheets_connection_type():
+    from streamlit_gsheets import GSheetsConnection
+    return GSheetsConnection
+
+# --- 1A. GOOGLE DRIVE ---
+def get_drive_service():
+    if "connections" in st.secrets and "gsheets" in st.secrets["connections"]:
+        service_account, build, _ = google_drive_api()
+        creds_dict = st.secrets["connections"]["gsheets"]
+        creds = service_account.Credentials.from_service_account_info(
+            creds_dict, scopes=['https://www.googleapis.com/auth/drive.readonly']
+        )
+        return build('drive', 'v3', credentials=creds)
+    return None
+
+def list_files_in_folder(folder_id):
+    service = get_drive_service()
+    if not service: return []
+    try:
+        query = f"'{folder_id}' in parents and mimeType='application/pdf' and trashed=false"
+        results = service.files().list(q=query, pageSize=100, fields="files(id, name, md5Checksum)").execute()
+        files = results.get('files', [])
+        files.sort(key=lambda x: x['name'].lower())
+        return files
+    except Exception as e:
+        st.error(f"Drive List Error: {e}")
+        return []
+
+def download_file_from_drive(file_id):
+    service = get_drive_service()
+    if not service: return None
+    try:
+        request = service.files().get_media(fileId=file_id)
+        file_stream = io.BytesIO()
+        _, _, MediaIoBaseDownload = google_drive_api()
+        downloader = MediaIoBaseDownload(file_stream, request)
+        done = False
+        while not done:
+            _, done = downloader.next_chunk()
+        file_stream.seek(0)
+        return file_stream
+    except Exception as e:
+        st.error(f"Download Error: {e}")
+        return None
+
+# --- 1B. UNTAPPD LOGIC ---
+def search_untappd_item(supplier, product):
+    if "untappd" not in st.secrets: return None
+    creds = st.secrets["untappd"]
+    base_url = creds.get("base_url", "https://business.untappd.com/api/v1")
+    token = creds.get("api_token")
+    
+    query_str = f"{supplier} {product}".replace(" ", "-")
+    safe_q = quote(query_str)
+    url = f"{base_url}/items/search?q={safe_q}"
+    
+    headers = {"Authorization": f"Basic {token}", "Content-Type": "application/json"}
+    
+    try:
+        response = requests.get(url, headers=headers)
+        if response.status_code == 200:
+            data = response.json()
+            items = data.get('items', [])
+            if items:
+                best = items[0] 
+                return {
+                    "untappd_id": best.get("untappd_id"),
+                    "name": best.get("name"),
+                    "brewery": best.get("brewery"),
+                    "abv": best.get("abv"),
+                    "description": best.get("description"),
+                    "label_image_thumb": best.get("label_image_thumb"),
+                    "brewery_location": best.get("brewery_location")
+                }
+    except: pass
+    return None
+
+UNTAPPD_COLS = ['Untappd_Status', 'Untappd_ID', 'Untappd_Brewery', 'Untappd_Product', 
+                'Untappd_ABV', 'Untappd_Desc', 'Label_Thumb', 'Brewery_Loc']
+UNTAPPD_FIELDS = {'Untappd_ID': 'untappd_id', 'Untappd_Brewery': 'brewery', 'Untappd_Product': 'name',
+                  'Untappd_ABV': 'abv', 'Untappd_Desc': 'description', 'Label_Thumb': 'label_image_thumb',
+                  'Brewery_Loc': 'brewery_location'}
+
+def batch_untappd_lookup(matrix_df):
+    if matrix_df.empty: return matrix_df, ["Matrix Empty"]
+    
+    matrix_df = matrix_df.copy()
+    for c in UNTAPPD_COLS:
+        if c not in matrix_df.columns: matrix_df[c] = ""
+            
+    # Only rows without an ID; each Supplier/Product pair is searched once
+    current_ids = matrix_df['Untappd_ID'].astype(str).str.strip()
+    todo = matrix_df[(current_ids == "") | (current_ids == "nan")]
+    pairs = list(dict.fromkeys(zip(todo['Supplier_Name'], todo['Product_Name'])))
+    
+    logs = []
+    found = {}
+    prog_bar = st.progress(0)
+    for i, (supplier, product) in enumerate(pairs):
+        prog_bar.progress((i + 1) / len(pairs))
+        res = search_untappd_item(supplier, product)
+        found[(supplier, product)] = res
+        if res: logs.append(f"✅ Found: {res['name']}")
+        else: logs.append(f"❌ No match: {product}")
+    
+    if todo.empty: return matrix_df, logs
+    
+    hits = [found[p] for p in zip(todo['Supplier_Name'], todo['Product_Name'])]
+    updates = pd.DataFrame(
+        [{col: (res or {}).get(key, "") for col, key in UNTAPPD_FIELDS.items()} for res in hits],
+        index=todo.index
+    )
+    updates['Untappd_Status'] = ["✅ Found" if res else "❌ Not Found" for res in hits]
+    # Not-found rows only get a status; their other Untappd columns stay as they were
+    missed = updates['Untappd_Status'] == "❌ Not Found"
+    updates.loc[missed, list(UNTAPPD_FIELDS)] = todo.loc[missed, list(UNTAPPD_FIELDS)]
+    matrix_df[UNTAPPD_COLS] = matrix_df[UNTAPPD_COLS].astype(object)
+    matrix_df.loc[updates.index, UNTAPPD_COLS] = updates[UNTAPPD_COLS]
+        
+    return matrix_df, logs
+
+# --- 1C. SHOPIFY & CIN7 ---
+def get_cin7_headers():
+    if "cin7" not in st.secrets: return None
+    creds = st.secrets["cin7"]
+    return {
+        "api-auth-accountid": creds.get("account_id"),
+        "api-auth-applicationkey": creds.get("api_key"),
+        "Content-Type": "application/json"
+    }
+
+def get_cin7_base_url():
+    if "cin7" not in st.secrets: return None
+    return st.secrets["cin7"].get("base_url", "https://inventory.dearsystems.com/ExternalApi/v2")
+
+@st.cache_data(ttl=3600) 
+def fetch_all_cin7_suppliers_cached():
+    if "cin7" not in st.secrets: return []
+    creds = st.secrets["cin7"]
+    headers = {
+        'Content-Type': 'application/json',
+        'api-auth-accountid': creds.get("account_id"),
+        'api-auth-applicationkey': creds.get("api_key")
+    }
+    base_url = creds.get("base_url", "https://inventory.dearsystems.com/ExternalApi/v2")
+    all_suppliers = []
+    page = 1
+    try:
+        while True:
+            url = f"{base_url}/supplier?Page={page}&Limit=100"
+            req = Request(url, headers=headers)
+            with urlopen(req) as response:
+                if response.getcode() == 200:
+                    data = json.loads(response.read())
+                    key = "SupplierList" if "SupplierList" in data else "Suppliers"
+                    if key in data and data[key]:
+                        for s in data[key]:
+                            all_suppliers.append({"Name": s["Name"], "ID": s["ID"]})
+                        if len(data[key]) < 100: break
+                        page += 1
+                    else: break
+                else: break
+    except: pass
+    return sorted(all_suppliers, key=lambda x: x['Name'].lower())
+
+# --- Cin7 supplier index (Tab 3 selectbox default + name -> ID) ---
+SUPPLIER_NAME_NOISE = {"the", "ltd", "limited", "plc", "llp", "co", "company"}
+SUPPLIER_MATCH_MIN_SCORE = 60
+SUPPLIER_MATCH_SURE_SCORE = 90    # a candidate this good skips the full-list pass
+SUPPLIER_MATCH_CANDIDATES = 50
+SUPPLIER_COMMON_TOKEN_SHARE = 0.02   # tokens on more names than this ("brewery") don't pick candidates
+
+def normalize_supplier_name(name):
+    tokens = re.findall(r"[a-z0-9]+", str(name or "").lower())
+    return " ".join(t for t in tokens if t not in SUPPLIER_NAME_NOISE)
+
+class Cin7SupplierIndex:
+    """
+    The Cin7 supplier list indexed once per load: name -> ID / list position, normalised
+    name -> name, and token -> names. best_match only fuzzy-scores names that share a
+    token with the payee, and remembers the answer per payee.
+    """
+    def __init__(self, suppliers=None):
+        self.names = [s['Name'] for s in (suppliers or [])]
+        self.ids = {s['Name']: s['ID'] for s in (suppliers or [])}
+        self.positions, self.normalized, self.tokens = {}, {}, {}
+        for i, name in enumerate(self.names):
+            self.positions.setdefault(name, i)
+            norm = normalize_supplier_name(name)
+            self.normalized.setdefault(norm, name)
+            for tok in set(norm.split()):
+                self.tokens.setdefault(tok, []).append(name)
+        self.defaults = {}
+
+    def supplier_id(self, name):
+        return self.ids.get(name)
+
+    def position(self, name):
+        return self.positions.get(name, 0)
+
+    def candidates(self, norm):
+        # Rare shared tokens count for more; near-universal ones are ignored
+        common = max(SUPPLIER_MATCH_CANDIDATES, len(self.names) * SUPPLIER_COMMON_TOKEN_SHARE)
+        weights = {}
+        for tok in set(norm.split()):
+            postings = self.tokens.get(tok, ())
+            if len(postings) > common: continue
+            for name in postings:
+                weights[name] = weights.get(name, 0.0) + 1.0 / len(postings)
+        return sorted(weights, key=weights.get, reverse=True)[:SUPPLIER_MATCH_CANDIDATES]
+
+    def best_match(self, payee):
+        """Closest supplier name for the invoice payee, or None below SUPPLIER_MATCH_MIN_SCORE."""
+        key = str(payee or "").strip()
+        if not key or not self.names: return None
+        if key not in self.defaults: self.defaults[key] = self._match(key)
+        return self.defaults[key]
+
+    def _match(self, payee):
+        if payee in self.ids: return payee
+        norm = normalize_supplier_name(payee)
+        if norm in self.normalized: return self.normalized[norm]
+        pool = self.candidates(norm)
+        found = process.extractOne(payee, pool) if pool else None
+        # Full-list scoring only when no candidate is convincing (e.g. a misspelt payee)
+        if not found or found[1] < SUPPLIER_MATCH_SURE_SCORE:
+            full = process.extractOne(payee, self.names)
+            if full and (not found or full[1] > found[1]): found = full
+        return found[0] if found and found[1] > SUPPLIER_MATCH_MIN_SCORE else None
+
+def get_cin7_product_id(sku):
+    headers = get_cin7_headers()
+    if not headers: return None
+    url = f"{get_cin7_base_url()}/product"
+    params = {"Sku": sku}
+    try:
+        response = requests.get(url, headers=headers, params=params)
+        if response.status_code == 200:
+            data = response.json()
+            if "Products" in data and len(data["Products"]) > 0:
+                return data["Products"][0]["ID"]
+    except: pass
+    return None
+
+def get_cin7_supplier(name):
+    headers = get_cin7_headers()
+    if not headers: return None
+    safe_name = quote(name)
+    url = f"{get_cin7_base_url()}/supplier?Name={safe_name}"
+    try:
+        response = requests.get(url, headers=headers)
+        if response.status_code == 200:
+            data = response.json()
+            if "Suppliers" in data and len(data["Suppliers"]) > 0:
+                return data["Suppliers"][0]
+    except: pass
+    if "&" in name: return get_cin7_supplier(name.replace("&", "and"))
+    return None
+
+# --- CIN7 PURCHASE ORDERS (Single + bulk) ---
+CIN7_CALLS_PER_MINUTE = 60     # Cin7 Core API limit per account
+CIN7_PO_WORKERS = 4
+CIN7_TAX_RULE = "20% (VAT on Expenses)"
+LOCATIONS = ["London", "Gloucester"]
+SPLIT_LOCATION = "Split by line"
+
+class RateLimiter:
+    """Spaces calls evenly across threads (at most `per_minute` starts per minute)."""
+    def __init__(self, per_minute=CIN7_CALLS_PER_MINUTE):
+        self.interval = 60.0 / per_minute
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now: time.sleep(slot - now)
+
+class Cin7LookupCache:
+    """Supplier name -> ID and SKU -> product ID, shared by every PO in a bulk export."""
+    def __init__(self, suppliers=None, limiter=None):
+        self.lock = threading.Lock()
+        self.limiter = limiter
+        self.suppliers = {s['Name'].lower(): s['ID'] for s in (suppliers or [])}
+        self.products = {}
+
+    def supplier_id(self, name):
+        key = str(name or "").strip().lower()
+        if not key: return None
+        with self.lock:
+            if key in self.suppliers: return self.suppliers[key]
+        if self.limiter: self.limiter.wait()
+        data = get_cin7_supplier(name)
+        with self.lock:
+            self.suppliers[key] = data['ID'] if data else None
+            return self.suppliers[key]
+
+    def product_id(self, sku):
+        if not sku: return None
+        with self.lock:
+            if sku in self.products: return self.products[sku]
+        if self.limiter: self.limiter.wait()
+        pid = get_cin7_product_id(sku)
+        with self.lock:
+            self.products[sku] = pid
+            return pid
+
+def resolve_cin7_supplier_id(header_df, cache=None):
+    if 'Cin7_Supplier_ID' in header_df.columns and header_df.iloc[0]['Cin7_Supplier_ID']:
+        return header_df.iloc[0]['Cin7_Supplier_ID']
+    supplier_name = header_df.iloc[0]['Payable_To']
+    if cache: return cache.supplier_id(supplier_name)
+    supplier_data = get_cin7_supplier(supplier_name)
+    return supplier_data['ID'] if supplier_data else None
+
+def build_cin7_order_lines(lines_df, location_choice, cache=None):
+    order_lines = []
+    id_col = 'Cin7_London_ID' if location_choice == 'London' else 'Cin7_Glou_ID'
+    sku_col = 'London_SKU' if location_choice == 'London' else 'Gloucester_SKU'
+    
+    for _, row in lines_df.iterrows():
+        # --- UPDATE: Check for "✅ Match" ---
+        if row.get('Shopify_Status') != "✅ Match": continue
+        prod_id = row.get(id_col)
+        if (pd.isna(prod_id) or not str(prod_id).strip()) and cache:
+            prod_id = cache.product_id(row.get(sku_col))
+        if pd.notna(prod_id) and str(prod_id).strip():
+            qty = float(row.get('Quantity', 0))
+            price = float(row.get('Item_Price', 0))
+            total = round(qty * price, 2)
+            
+            order_lines.append({
+                "ProductID": prod_id, 
+                "Quantity": qty, 
+                "Price": price, 
+                "Total": total,
+                "TaxRule": CIN7_TAX_RULE,
+                "Discount": 0,
+                "Tax": 0
+            })
+    return order_lines
+
+def post_cin7_po_header(headers, base_url, supplier_id, location_choice, invoice_number, limiter=None):
+    """advanced-purchase task. Returns (task_id or None, error msg)."""
+    payload_header = {
+        "SupplierID": supplier_id,
+        "Location": location_choice,
+        "Date": pd.to_datetime('today').strftime('%Y-%m-%d'),
+        "TaxRule": CIN7_TAX_RULE,
+        "Approach": "Stock",
+        "BlindReceipt": False,
+        "PurchaseType": "Advanced",
+        "Status": "ORDERING",
+        "SupplierInvoiceNumber": str(invoice_number)
+    }
+    try:
+        if limiter: limiter.wait()
+        r1 = requests.post(f"{base_url}/advanced-purchase", headers=headers, json=payload_header)
+        if r1.status_code == 200:
+            task_id = r1.json().get('ID')
+            return task_id, "" if task_id else "Unknown Error"
+        return None, f"Header Error: {r1.text}"
+    except Exception as e: return None, f"Header Ex: {e}"
+
+def post_cin7_po_lines(headers, base_url, task_id, order_lines, limiter=None):
+    """purchase/order lines for an existing task. Returns (success, msg)."""
+    payload_lines = {
+        "TaskID": task_id,
+        "CombineAdditionalCharges": False,
+        "Memo": "Streamlit Import",
+        "Status": "DRAFT",
+        "Lines": order_lines,
+        "AdditionalCharges": []
+    }
+    try:
+        if limiter: limiter.wait()
+        r2 = requests.post(f"{base_url}/purchase/order", headers=headers, json=payload_lines)
+        if r2.status_code == 200:
+            return True, f"✅ PO Created! ID: {task_id}"
+        else: return False, f"Line Error: {r2.text}"
+    except Exception as e: return False, f"Lines Ex: {e}"
+
+def create_cin7_purchase_order(header_df, lines_df, location_choice, cache=None, limiter=None, pdf_hash=""):
+    """
+    One PO, at most once: the export ledger (storage.py) is checked before any POST.
+    Returns (success, message, logs, already_exported). Already exported -> success and
+    already_exported without calls, so callers skip their post-export steps; header created
+    but lines failed -> lines are re-posted to the same task instead of creating a second one.
+    """
+    headers = get_cin7_headers()
+    if not headers: return False, "Cin7 Secrets missing.", [], False
+    logs = []
+
+    supplier_id = resolve_cin7_supplier_id(header_df, cache)
+    if not supplier_id: return False, "Supplier not linked.", logs, False
+
+    invoice_number = str(header_df.iloc[0].get('Invoice_Number', ''))
+    key = (str(supplier_id), invoice_number, pdf_hash or "", location_choice)
+    claimed, entry = claim_export(key)
+    if not claimed:
+        if entry["status"] == "complete":
+            return True, f"⏭️ Already exported! ID: {entry['task_id']}", [f"Ledger: exported {entry['updated_at']}"], True
+        return False, "Export already in progress for this invoice.", logs, False
+
+    order_lines = build_cin7_order_lines(lines_df, location_choice, cache)
+    if not order_lines:
+        record_export(key, "failed", message="No valid lines found.")
+        return False, "No valid lines found.", logs, False
+
+    base_url = get_cin7_base_url()
+    task_id = entry.get("task_id")
+    if task_id:
+        logs.append(f"Ledger: resuming task {task_id} (header already created)")
+    else:
+        task_id, err = post_cin7_po_header(headers, base_url, supplier_id, location_choice, invoice_number, limiter)
+        if not task_id:
+            record_export(key, "failed", message=err)
+            return False, err, logs, False
+    # In flight until the lines POST returns; "header_created" marks a resumable failure
+    record_export(key, "submitting_lines", task_id=task_id)
+
+    success, msg = post_cin7_po_lines(headers, base_url, task_id, order_lines, limiter)
+    record_export(key, "complete" if success else "header_created", message=msg, lines=len(order_lines))
+    logs.append(f"{location_choice}: {len(order_lines)} lines, task {task_id}")
+    return success, msg, logs, False
+
+def split_by_location(lines_df, location_choice):
+    """[(location, lines)]: one PO per location. SPLIT_LOCATION uses each line's 'Location' column."""
+    if location_choice != SPLIT_LOCATION: return [(location_choice, lines_df)]
+    if 'Location' not in lines_df.columns: return [(LOCATIONS[0], lines_df)]
+    locs = lines_df['Location'].fillna(LOCATIONS[0]).replace("", LOCATIONS[0])
+    return [(loc, lines_df[locs == loc]) for loc in LOCATIONS if (locs == loc).any()]
+
+def bulk_create_cin7_purchase_orders(invoices, suppliers=None, max_workers=CIN7_PO_WORKERS, on_result=None):
+    """
+    invoices: [{"name", "header", "lines", "location"}]. Each invoice/location pair becomes
+    one PO, submitted through a shared rate limit and lookup cache. Returns one result
+    dict per PO, in submission order; "index" is the invoice's position in `invoices`
+    (names need not be unique), "already_exported" marks a ledger skip.
+    """
+    if not get_cin7_headers():
+        return [{"index": i, "invoice": inv["name"], "ok": False, "already_exported": False, "message": "Cin7 Secrets missing."}
+                for i, inv in enumerate(invoices)]
+    limiter = RateLimiter()
+    cache = Cin7LookupCache(suppliers, limiter)
+    jobs = [(i, inv, loc, lines) for i, inv in enumerate(invoices)
+            for loc, lines in split_by_location(inv["lines"], inv["location"])]
+    # Warm the supplier cache once per supplier, so parallel POs don't repeat the same lookup
+    for inv in invoices: resolve_cin7_supplier_id(inv["header"], cache)
+
+    def run(job):
+        index, inv, loc, lines = job
+        t0 = time.perf_counter()
+        try:
+            ok, msg, logs, skipped = create_cin7_purchase_order(inv["header"], lines, loc, cache, limiter, inv.get("pdf_hash", ""))
+        except Exception as e:
+            ok, msg, logs, skipped = False, f"Ex: {e}", [], False
+        result = {
+            "index": index, "invoice": inv["name"], "location": loc,
+            "supplier": inv["header"].iloc[0].get('Payable_To', ''),
+            "invoice_number": inv["header"].iloc[0].get('Invoice_Number', ''),
+            "ok": ok, "already_exported": skipped, "message": msg, "seconds": round(time.perf_counter() - t0, 2), "logs": logs,
+        }
+        if on_result: on_result(result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(run, jobs))
+
+def get_shopify_endpoint():
+    """(graphql endpoint, headers) from secrets, or (None, None)."""
+    if "shopify" not in st.secrets: return None, None
+    creds = st.secrets["shopify"]
+    shop_url = creds.get("shop_url")
+    token = creds.get("access_token")
+    version = creds.get("api_version", "2024-04")
+    base = shop_url if str(shop_url).startswith("http") else f"https://{shop_url}"
+    endpoint = f"{base}/admin/api/{version}/graphql.json"
+    headers = {"X-Shopify-Access-Token": token, "Content-Type": "application/json"}
+    return endpoint, headers
+
+def fetch_shopify_products_by_vendor(vendor):
+    if "shopify" not in st.secrets: return []
+    if not vendor or not isinstance(vendor, str): return []
+    
+    endpoint, headers = get_shopify_endpoint()
+    query = """query ($query: String!, $cursor: String) { products(first: 50, query: $query, after: $cursor) { pageInfo { hasNextPage endCursor } edges { node { id title status format_meta: metafield(namespace: "custom", key: "Format") { value } abv_meta: metafield(namespace: "custom", key: "ABV") { value } variants(first: 20) { edges { node { id title sku inventoryQuantity } } } } } } }"""
+    search_vendor = vendor.replace("'", "\\'") 
+    variables = {"query": f"vendor:'{search_vendor}'"} 
+    
+    all_products = []
+    cursor = None
+    has_next = True
+    
+    while has_next:
+        vars_curr = variables.copy()
+        if cursor: vars_curr['cursor'] = cursor
+        try:
+            response = requests.post(endpoint, json={"query": query, "variables": vars_curr}, headers=headers)
+            if response.status_code == 200:
+                data = response.json()
+                if "data" in data and "products" in data["data"]:
+                    p_data = data["data"]["products"]
+                    all_products.extend(p_data["edges"])
+                    has_next = p_data["pageInfo"]["hasNextPage"]
+                    cursor = p_data["pageInfo"]["endCursor"]
+                else: has_next = False
+            else: has_next = False
+        except: has_next = False
+            
+    return all_products
+
+# --- 1D. GOOGLE SHEETS ---
+def get_master_supplier_list():
+    try:
+        conn = st.connection("gsheets", type=gsheets_connection_type())
+        df = conn.read(worksheet="MasterData", ttl=600)
+        return df['Supplier_Master'].dropna().astype(str).tolist()
+    except: return []
+
+# --- 1E. SHOPIFY BULK PRODUCT CREATION (Staged JSONL + bulkOperationRunMutation) ---
+BULK_POLL_SECONDS = 2
+BULK_TIMEOUT_SECONDS = 600
+STAGED_UPLOAD_MUTATION = """mutation { stagedUploadsCreate(input: [{ resource: BULK_MUTATION_VARIABLES, filename: "products.jsonl", mimeType: "text/jsonl", httpMethod: POST }]) { stagedTargets { url resourceUrl parameters { name value } } userErrors { field message } } }"""
+PRODUCT_CREATE_MUTATION = """mutation call($input: ProductInput!, $media: [CreateMediaInput!]) { productCreate(input: $input, media: $media) { product { id title vendor variants(first: 10) { edges { node { id title sku } } } } userErrors { field message } } }"""
+BULK_RUN_MUTATION = """mutation ($mutation: String!, $path: String!) { bulkOperationRunMutation(mutation: $mutation, stagedUploadPath: $path) { bulkOperation { id status } userErrors { field message } } }"""
+BULK_STATUS_QUERY = """query { currentBulkOperation(type: MUTATION) { id status errorCode objectCount url partialDataUrl } }"""
+
+def shopify_graphql(query, variables=None):
+    endpoint, headers = get_shopify_endpoint()
+    if not endpoint: raise RuntimeError("Shopify Secrets missing.")
+    r = requests.post(endpoint, json={"query": query, "variables": variables or {}}, headers=headers, timeout=60)
+    r.raise_for_status()
+    data = r.json()
+    if data.get("errors"): raise RuntimeError(f"Shopify: {data['errors']}")
+    return data["data"]
+
+def make_base_sku(supplier, product, fmt, volume, pack=""):
+    """SKU stem in the catalog's style (no location prefix): THJAIPCASK9, BKALOFTSTEEL30, ...CANS24X44."""
+    def letters(text, n): return "".join(re.findall(r"[A-Za-z0-9]", str(text))).upper()[:n]
+    fmt_word = letters(str(fmt).split()[0] if str(fmt).split() else "", 6)
+    vol = (re.findall(r"\d+(?:\.\d+)?", str(volume)) or [""])[0].replace(".", "")
+    size = f"{pack}X{vol}" if pack else vol
+    supplier = re.sub(r"^the\s+", "", str(supplier), flags=re.IGNORECASE)
+    return f"{letters(supplier, 2)}{letters(product, 5)}{fmt_word}{size}"
+
+def build_product_inputs(new_products, status="DRAFT"):
+    """Bulk-mutation variables (one dict per JSONL line) for reconciliation.matrix_to_new_products rows."""
+    lines = []
+    for p in new_products:
+        variant_title = p["Volume"] if str(p["Pack_Size"]) in ("", "1") else f"{p['Pack_Size']} x {p['Volume']}"
+        product_input = {
+            "title": f"{p['Supplier_Name']} / {p['Product_Name']} / {p['Format']}",
+            "vendor": p["Supplier_Name"],
+            "productType": p["Format"],
+            "status": status,
+            "descriptionHtml": p.get("Description", ""),
+            "options": ["Size"],
+            "metafields": [
+                {"namespace": "custom", "key": "Format", "type": "single_line_text_field", "value": str(p["Format"])},
+                {"namespace": "custom", "key": "ABV", "type": "single_line_text_field", "value": str(p["ABV"])},
+            ],
+            "variants": [{
+                "options": [variant_title],
+                "sku": f"L-{p['Base_SKU']}",
+                "inventoryItem": {"cost": p["Item_Price"]} if p.get("Item_Price") not in (None, "") else {},
+            }],
+        }
+        media = [{"originalSource": p["Image"], "mediaContentType": "IMAGE", "alt": p["Product_Name"]}] if p.get("Image") else []
+        lines.append({"input": product_input, "media": media})
+    return lines
+
+def upload_bulk_jsonl(lines):
+    """Stages the JSONL file. Returns the stagedUploadPath for bulkOperationRunMutation."""
+    target = shopify_graphql(STAGED_UPLOAD_MUTATION)["stagedUploadsCreate"]["stagedTargets"][0]
+    params = {p["name"]: p["value"] for p in target["parameters"]}
+    payload = "\n".join(json.dumps(l) for l in lines).encode()
+    r = requests.post(target["url"], data=params, files={"file": ("products.jsonl", payload, "text/jsonl")}, timeout=120)
+    r.raise_for_status()
+    return params.get("key") or target.get("resourceUrl")
+
+def wait_for_bulk_operation(poll_seconds=BULK_POLL_SECONDS, timeout=BULK_TIMEOUT_SECONDS, on_status=None):
+    deadline = time.monotonic() + timeout
+    while True:
+        op = shopify_graphql(BULK_STATUS_QUERY)["currentBulkOperation"]
+        if on_status: on_status(op)
+        if op and op["status"] in ("COMPLETED", "FAILED", "CANCELED", "EXPIRED"): return op
+        if time.monotonic() > deadline: raise TimeoutError("Shopify bulk operation still running")
+        time.sleep(poll_seconds)
+
+def bulk_create_shopify_products(new_products, status="DRAFT", on_status=None):
+    """
+    Creates every product in one bulk operation. Returns (created, errors, logs):
+    created[i] = {"index", "product_id", "title", "variants": [{id, title, sku}]} where
+    index points back into new_products.
+    """
+    logs = []
+    if not new_products: return [], [], ["Nothing to create."]
+    lines = build_product_inputs(new_products, status)
+    path = upload_bulk_jsonl(lines)
+    logs.append(f"Staged {len(lines)} products.")
+    run = shopify_graphql(BULK_RUN_MUTATION, {"mutation": PRODUCT_CREATE_MUTATION, "path": path})["bulkOperationRunMutation"]
+    if run["userErrors"]: return [], [e["message"] for e in run["userErrors"]], logs
+    logs.append(f"Bulk operation {run['bulkOperation']['id']} started.")
+
+    op = wait_for_bulk_operation(on_status=on_status)
+    logs.append(f"Bulk operation {op['status']} ({op.get('objectCount')} objects).")
+    result_url = op.get("url") or op.get("partialDataUrl")
+    if not result_url: return [], [f"Bulk operation {op['status']}: {op.get('errorCode')}"], logs
+
+    created, errors = [], []
+    for raw in requests.get(result_url, timeout=120).text.splitlines():
+        if not raw.strip(): continue
+        row = json.loads(raw)
+        index = row.get("__lineNumber", len(created) + len(errors))
+        result = row.get("data", {}).get("productCreate", {})
+        if result.get("userErrors"):
+            errors.append(f"{new_products[index]['Product_Name']}: {'; '.join(e['message'] for e in result['userErrors'])}")
+            continue
+        product = result.get("product")
+        if not product: continue
+        created.append({
+            "index": index, "product_id": product["id"], "title": product["title"],
+            "variants": [e["node"] for e in product["variants"]["edges"]],
+        })
+    return created, errors, logs
@@ -232,3 +232,90 @@ SUPPLIER_RULEBOOK = {
    - Payable To: "German Drinks Company Limited".
    """
 }
+
+# ==========================================
+# 4. OCR PROFILES (Keyed by SUPPLIER_RULEBOOK names)
+# ==========================================
+# psm: Tesseract page segmentation (3 = auto, 4 = single column, 6 = uniform block/table rows)
+# oem: 1 = LSTM engine only
+# dpi: used for scanned PDFs; digital_dpi for PDFs with an embedded text layer (clean renders)
+# crop_box: optional (left, top, right, bottom) fractions of the page to keep
+DEFAULT_OCR_PROFILE = {
+    "dpi": 300,
+    "digital_dpi": 200,
+    "grayscale": True,
+    "binarize": True,
+    "crop": True,
+    "crop_box": None,
+    "psm": 3,
+    "oem": 1,
+    "lang": "eng",
+    "whitelist": None,
+}
+
+OCR_PROFILES = {
+   # Fixed-width rows: "18.0000 0.0000 18.0000B/JAIP-ECA09-059 Jaipur Ecask ..."
+   "Thornbridge Brewery": {"psm": 6},
+
+   # QTY ITEM UNIT PRICE DISCOUNT VAT LINE PRICE table
+   "The Beak Brewery Limited": {"psm": 6},
+
+   "James Clay and Sons": {"psm": 6, "digital_dpi": 250},
+
+   "Neon Raptor": {"psm": 4},
+
+   "North Riding Brewery": {"psm": 4},
+
+   "German Drinks Company Limited": {"psm": 4, "lang": "eng+deu"},
+}
+
+# ==========================================
+# 5. EXTRACTION MODES (Keyed by SUPPLIER_RULEBOOK names)
+# ==========================================
+# "ocr"    = poppler + Tesseract, then text to Gemini (default)
+# "layout" = poppler + Tesseract word boxes, then a header block + "|" delimited line table
+#            to Gemini (addresses, bank details and T&Cs are left out)
+# "pdf"    = PDF bytes straight to Gemini
+# "images" = downscaled page images straight to Gemini
+# Move a supplier off "ocr" once the mode comparison shows OCR adds nothing for it.
+DEFAULT_EXTRACTION_MODE = "ocr"
+
+EXTRACTION_MODES = {
+}
+
+# ==========================================
+# 6. MODEL ROUTING (Keyed by SUPPLIER_RULEBOOK names)
+# ==========================================
+# Invoices start on the cheapest tier their size allows and only move up when the
+# result fails validation (lines don't add up to Total_Net, bad JSON, no lines).
+MODEL_TIERS = {
+    "lite": "gemini-2.5-flash-lite",
+    "flash": "gemini-2.5-flash",
+    "pro": "gemini-2.5-pro",
+}
+TIER_ORDER = ["lite", "flash", "pro"]
+
+# Upper limits (OCR characters, estimated line items) for each tier before size alone moves it up
+TIER_SIZE_LIMITS = {
+    "lite": {"chars": 4000, "lines": 8},
+    "flash": {"chars": 40000, "lines": 80},
+}
+
+# easy   = size limits doubled (short, clean layouts)
+# normal = size limits as above (default)
+# hard   = never below flash (arithmetic in the rules, merged rows, statements)
+DEFAULT_DIFFICULTY = "normal"
+
+SUPPLIER_DIFFICULTY = {
+   "Pilton Cider Ltd": "easy",
+   "Trenchmore LLP": "easy",
+   "Crafty AF Ltd": "easy",
+
+   "Thornbridge Brewery": "hard",
+   "The Beak Brewery Limited": "hard",
+   "Little Mercies Limited": "hard",
+   "Simple Things Fermentations": "hard",
+   "James Clay and Sons": "hard",
+   "North Riding Brewery": "hard",
+   "Neon Raptor": "hard",
+}
@@ -0,0 +1,220 @@
+import re
+from statistics import median
+
+from ocr import (
+    tesseract_api, tesseract_config, preprocess_image, pdf_to_images, resolve_ocr_profile,
+    detect_supplier, PAGE_SETTINGS, AUTO_PROFILE
+)
+
+# ==========================================
+# LAYOUT OCR (Word boxes -> compact table text)
+# ==========================================
+# image_to_string flattens a page, so QTY / ITEM / UNIT PRICE / DISCOUNT alignment is
+# lost and addresses, bank details and T&Cs all go to Gemini. Here Tesseract's word
+# boxes are regrouped into visual rows, the line-item table is found by its column
+# titles, and each page becomes a short header block, a "|" delimited table and the
+# totals rows. Pages with no recognisable table fall back to their plain text.
+
+# Column titles; a row with at least TABLE_HEADER_MIN_HITS of them starts the table
+TABLE_HEADER_WORDS = {
+    "qty", "quantity", "qnty", "item", "items", "description", "product", "code", "sku", "unit", "units",
+    "price", "rate", "each", "discount", "disc", "vat", "amount", "net", "line", "total", "pack", "size", "abv",
+}
+TABLE_HEADER_MIN_HITS = 3
+# Rows that end the table (and are kept as the totals block)
+TOTALS_RE = re.compile(
+    r"\b(sub[\s-]*total|net\s+total|total\s+net|total\s+vat|vat\s+total|invoice\s+total|total\s+due|"
+    r"amount\s+due|balance(\s+due)?|total|carriage|delivery\s+charge|shipping|discount)\b", re.IGNORECASE
+)
+# Header rows worth keeping above the table
+HEADER_KEEP_RE = re.compile(
+    r"\b(invoice|inv\b|date|due|terms|order|ref|reference|account|customer|deliver|ship|payable)", re.IGNORECASE
+)
+# Never sent: payment details and small print
+DROP_RE = re.compile(r"\b(sort\s*code|iban|swift|bic|account\s*(no|number)|bank|registered|company\s*no|terms\s+and\s+conditions)\b", re.IGNORECASE)
+MONEY_RE = re.compile(r"\d[\d,]*\.\d{2}\b")
+
+TOP_ROWS = 3            # supplier name / address lines at the top of page 1
+MAX_HEADER_ROWS = 12
+MIN_WORD_CONF = 10      # Tesseract confidence (0-100); lower is usually speckle
+
+# --- WORD BOXES -> ROWS ---
+def page_words(img, profile):
+    """Tesseract word boxes for a page: dicts with text, left, top, width, height."""
+    pytesseract = tesseract_api()
+    data = pytesseract.image_to_data(
+        preprocess_image(img, profile), lang=profile["lang"], config=tesseract_config(profile),
+        output_type=pytesseract.Output.DICT
+    )
+    words = []
+    for i, text in enumerate(data["text"]):
+        text = (text or "").strip()
+        if not text or float(data["conf"][i]) < MIN_WORD_CONF: continue
+        words.append({"text": text, "left": data["left"][i], "top": data["top"][i],
+                      "width": data["width"][i], "height": data["height"][i]})
+    return words
+
+def group_rows(words):
+    """
+    Words -> visual rows (lists sorted left to right), top to bottom. Grouped by vertical
+    centre rather than Tesseract's line numbers, which restart in every layout block and
+    so split a table row into one "line" per column.
+    """
+    if not words: return []
+    tol = median(w["height"] for w in words) * 0.5
+    rows = []
+    for w in sorted(words, key=lambda w: w["top"] + w["height"] / 2):
+        centre = w["top"] + w["height"] / 2
+        if rows and abs(centre - rows[-1]["centre"]) <= tol:
+            row = rows[-1]
+            row["words"].append(w)
+            row["centre"] += (centre - row["centre"]) / len(row["words"])
+        else:
+            rows.append({"centre": centre, "words": [w]})
+    return [sorted(r["words"], key=lambda w: w["left"]) for r in rows]
+
+def row_text(row):
+    return " ".join(w["text"] for w in row)
+
+# --- TABLE COLUMNS ---
+def is_table_header(row):
+    hits = {re.sub(r"[^a-z]", "", w["text"].lower()) for w in row} & TABLE_HEADER_WORDS
+    return len(hits) >= TABLE_HEADER_MIN_HITS and not MONEY_RE.search(row_text(row))
+
+def header_columns(row):
+    """Merges the title row's words into column titles ("UNIT" + "PRICE") by horizontal gap."""
+    gap = median(w["height"] for w in row) * 0.8
+    cols = []
+    for w in row:
+        if cols and w["left"] - cols[-1]["right"] <= gap:
+            cols[-1]["title"] += " " + w["text"]
+            cols[-1]["right"] = w["left"] + w["width"]
+        else:
+            cols.append({"title": w["text"], "left": w["left"], "right": w["left"] + w["width"]})
+    return cols
+
+def column_bounds(cols, body_rows):
+    """
+    Split points between adjacent columns: the x in the gap between two titles that the
+    fewest body words cross, so long descriptions stay in their column.
+    """
+    spans = [(w["left"], w["left"] + w["width"]) for row in body_rows for w in row]
+    bounds = []
+    for a, b in zip(cols, cols[1:]):
+        lo, hi = int(a["right"]), int(b["left"])
+        if hi <= lo:
+            bounds.append((a["right"] + b["left"]) / 2)
+            continue
+        xs = list(range(lo, hi + 1, max((hi - lo) // 40, 1)))
+        crossing = [sum(1 for l, r in spans if l < x < r) for x in xs]
+        # Middle of the widest run of least-crossed x: the whitespace channel between columns
+        least, runs, run = min(crossing), [], []
+        for x, c in zip(xs, crossing):
+            if c == least: run.append(x)
+            elif run: runs, run = runs + [run], []
+        if run: runs.append(run)
+        widest = max(runs, key=len)
+        bounds.append((widest[0] + widest[-1]) / 2)
+    return bounds
+
+def straddles(row, bounds):
+    return any(w["left"] < b < w["left"] + w["width"] for w in row for b in bounds)
+
+def split_cells(row, bounds):
+    cells = [[] for _ in range(len(bounds) + 1)]
+    for w in row:
+        centre = w["left"] + w["width"] / 2
+        cells[sum(1 for b in bounds if centre > b)].append(w["text"])
+    return [" ".join(c) for c in cells]
+
+def is_totals_row(row, cells):
+    # Totals start the row or sit under the number columns; a "Delivery charge" line item has its own qty
+    text = row_text(row)
+    return bool(TOTALS_RE.match(text) or (TOTALS_RE.search(text) and not cells[0].strip()))
+
+# --- PAGE -> COMPACT TEXT ---
+def layout_page(rows, table=None, first_page=True):
+    """
+    (compact_text, table) for one page of rows. `table` carries the column titles and
+    bounds from the previous page so continuation pages without titles still split.
+    """
+    start = next((i for i, r in enumerate(rows) if is_table_header(r)), None)
+    if start is not None:
+        cols = header_columns(rows[start])
+        body_from = start + 1
+        table = {"titles": [c["title"] for c in cols], "cols": cols}
+        table["bounds"] = column_bounds(cols, rows[body_from:])
+        # Body not aligned under the titles (single-spaced text, skewed scan): keep rows whole
+        priced = [r for r in rows[body_from:] if MONEY_RE.search(row_text(r))]
+        if priced and sum(straddles(r, table["bounds"]) for r in priced) * 3 > len(priced):
+            table["bounds"] = []
+    elif table is not None:
+        body_from = 0
+    else:
+        return "\n".join(row_text(r) for r in rows), None
+
+    header = [row_text(r) for r in rows[:start or 0]]
+    keep = [t for i, t in enumerate(header)
+            if not DROP_RE.search(t) and ((first_page and i < TOP_ROWS) or HEADER_KEEP_RE.search(t))]
+
+    body, totals = [], []
+    for row in rows[body_from:]:
+        text = row_text(row)
+        if DROP_RE.search(text): continue
+        cells = split_cells(row, table["bounds"])
+        if totals or is_totals_row(row, cells):
+            if MONEY_RE.search(text): totals.append(text)
+            continue
+        filled = [i for i, c in enumerate(cells) if c]
+        if body and len(filled) == 1 and not MONEY_RE.search(text):
+            # Wrapped description: fold into the row above
+            i = filled[0]
+            body[-1][i] = f"{body[-1][i]} {cells[i]}".strip()
+            continue
+        if start is None and not MONEY_RE.search(text): continue   # continuation page chatter
+        body.append(cells)
+
+    out = []
+    if keep: out += ["HEADER:"] + keep[:MAX_HEADER_ROWS]
+    if table["bounds"]: out += ["TABLE (| delimited):", " | ".join(table["titles"])]
+    else: out += ["TABLE:", " ".join(table["titles"])]
+    out += [" | ".join(c) for c in body]
+    if totals: out += ["TOTALS:"] + totals
+    return "\n".join(out), table
+
+def layout_pages(images, profile, on_page=None, first_rows=None, on_text=None):
+    """Returns (compact_texts, plain_texts), one of each per page image."""
+    compact, plain, table = [], [], None
+    for i, img in enumerate(images):
+        if i == 0 and first_rows is not None: rows = first_rows
+        else:
+            if on_page: on_page(i, len(images))
+            rows = group_rows(page_words(img, profile))
+        text, table = layout_page(rows, table, first_page=(i == 0))
+        compact.append(text)
+        plain.append("\n".join(row_text(r) for r in rows))
+        if on_text: on_text(i, compact[-1], plain[-1])
+    return compact, plain
+
+def layout_invoice(pdf_bytes, supplier=AUTO_PROFILE, on_page=None, on_text=None, max_dpi=None, last_page=None,
+                   on_supplier=None):
+    """
+    Layout-aware counterpart of ocr_invoice. Returns (compact_texts, plain_texts,
+    supplier_or_None, page_count); plain_texts keep every row for the template parsers.
+    """
+    auto = supplier == AUTO_PROFILE or not supplier
+    profile = resolve_ocr_profile(None if auto else supplier)
+    images = pdf_to_images(pdf_bytes, profile=profile, max_dpi=max_dpi, last_page=last_page)
+    if not images: return [], [], None, 0
+    if not auto and on_supplier: on_supplier(supplier)
+    first_rows = None
+    if auto:
+        if on_page: on_page(0, len(images))
+        first_rows = group_rows(page_words(images[0], profile))
+        supplier = detect_supplier("\n".join(row_text(r) for r in first_rows))
+        if supplier and on_supplier: on_supplier(supplier)
+        detected = resolve_ocr_profile(supplier)
+        if supplier and any(detected[k] != profile[k] for k in PAGE_SETTINGS): first_rows = None
+        profile = detected
+    compact, plain = layout_pages(images, profile, on_page, first_rows, on_text)
+    return compact, plain, supplier, len(images)
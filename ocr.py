@@ -0,0 +1,166 @@
+import subprocess
+from thefuzz import fuzz
+
+from knowledge_base import DEFAULT_OCR_PROFILE, OCR_PROFILES, SUPPLIER_RULEBOOK
+
+# ==========================================
+# OCR (PDF -> Images -> Preprocess -> Text)
+# ==========================================
+
+AUTO_PROFILE = "Auto-detect"
+# Settings that change Tesseract output for an already rendered page
+PAGE_SETTINGS = ("psm", "oem", "lang", "whitelist", "crop_box", "grayscale", "binarize", "crop")
+
+# pytesseract drags in pandas/numpy and pdf2image its own helpers; both load on the
+# first page rendered, not when the app imports this module.
+def pdf2image_api():
+    """(convert_from_bytes, pdfinfo_from_bytes), imported on first use."""
+    from pdf2image import convert_from_bytes, pdfinfo_from_bytes
+    return convert_from_bytes, pdfinfo_from_bytes
+
+def tesseract_api():
+    import pytesseract
+    return pytesseract
+
+def resolve_ocr_profile(supplier=None):
+    """DEFAULT_OCR_PROFILE overlaid with the supplier's entry in OCR_PROFILES."""
+    profile = dict(DEFAULT_OCR_PROFILE)
+    profile.update(OCR_PROFILES.get(supplier, {}))
+    return profile
+
+def detect_supplier(text):
+    """Best SUPPLIER_RULEBOOK key mentioned in the (first page) OCR text, or None."""
+    if not text: return None
+    head = text[:2000].lower()
+    best, best_score = None, 0
+    for name in SUPPLIER_RULEBOOK:
+        score = fuzz.partial_ratio(name.lower(), head)
+        if score > best_score: best, best_score = name, score
+    return best if best_score >= 90 else None
+
+def is_digital_pdf(pdf_bytes):
+    # Rendered invoices carry fonts; pure scans are image-only. Compressed object
+    # streams can hide /Font, which just falls back to the scan DPI.
+    return b"/Font" in pdf_bytes
+
+def pdf_text_layer(pdf_bytes, last_page=1, timeout=10):
+    """Embedded text via poppler's pdftotext (no OCR). Empty for scans or if poppler is missing."""
+    try:
+        out = subprocess.run(
+            ["pdftotext", "-layout", "-f", "1", "-l", str(last_page), "-", "-"],
+            input=pdf_bytes, capture_output=True, timeout=timeout
+        )
+        return out.stdout.decode("utf-8", errors="ignore") if out.returncode == 0 else ""
+    except Exception:
+        return ""
+
+def pdf_page_count(pdf_bytes):
+    try: return int(pdf2image_api()[1](pdf_bytes).get("Pages", 1))
+    except Exception: return 1
+
+def tesseract_config(profile):
+    config = f"--oem {profile['oem']} --psm {profile['psm']}"
+    if profile.get("whitelist"):
+        config += f" -c tessedit_char_whitelist={profile['whitelist']}"
+    return config
+
+# --- PREPROCESSING ---
+def otsu_threshold(gray_img):
+    hist = gray_img.histogram()[:256]
+    total = sum(hist)
+    sum_all = sum(i * h for i, h in enumerate(hist))
+    sum_bg, weight_bg, best_t, best_var = 0.0, 0, 127, 0.0
+    for t in range(256):
+        weight_bg += hist[t]
+        if weight_bg == 0: continue
+        weight_fg = total - weight_bg
+        if weight_fg == 0: break
+        sum_bg += t * hist[t]
+        mean_bg = sum_bg / weight_bg
+        mean_fg = (sum_all - sum_bg) / weight_fg
+        var = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+        if var > best_var: best_t, best_var = t, var
+    return best_t
+
+def binarize(gray_img):
+    t = otsu_threshold(gray_img)
+    return gray_img.point(lambda p: 255 if p > t else 0)
+
+def crop_to_content(img, pad=12):
+    """Trims blank margins around the ink. Expects white background."""
+    from PIL import ImageOps
+    bbox = ImageOps.invert(img.convert("L")).getbbox()
+    if not bbox: return img
+    left, top, right, bottom = bbox
+    return img.crop((max(left - pad, 0), max(top - pad, 0), min(right + pad, img.width), min(bottom + pad, img.height)))
+
+def apply_crop_box(img, crop_box):
+    left, top, right, bottom = crop_box
+    return img.crop((int(left * img.width), int(top * img.height), int(right * img.width), int(bottom * img.height)))
+
+def preprocess_image(img, profile):
+    if profile.get("crop_box"): img = apply_crop_box(img, profile["crop_box"])
+    if profile.get("grayscale") or profile.get("binarize"): img = img.convert("L")
+    if profile.get("binarize"): img = binarize(img)
+    if profile.get("crop"): img = crop_to_content(img)
+    return img
+
+# --- PIPELINE ---
+def pdf_to_images(pdf_bytes, dpi=None, profile=None, max_dpi=None, last_page=None):
+    """Page images. max_dpi / last_page are the OCR worker's pixel and page guards."""
+    profile = profile or resolve_ocr_profile()
+    if dpi is None:
+        dpi = profile["digital_dpi"] if is_digital_pdf(pdf_bytes) else profile["dpi"]
+    if max_dpi: dpi = min(dpi, max_dpi)
+    convert_from_bytes, _ = pdf2image_api()
+    return convert_from_bytes(pdf_bytes, dpi=dpi, grayscale=bool(profile.get("grayscale")), last_page=last_page)
+
+def ocr_image(img, profile):
+    return tesseract_api().image_to_string(preprocess_image(img, profile), lang=profile["lang"], config=tesseract_config(profile))
+
+def ocr_pages(images, on_page=None, profile=None):
+    """Runs Tesseract over each page image. Returns one text block per page."""
+    profile = profile or resolve_ocr_profile()
+    texts = []
+    for i, img in enumerate(images):
+        if on_page: on_page(i, len(images))
+        texts.append(ocr_image(img, profile))
+    return texts
+
+def ocr_pdf(pdf_bytes, dpi=None, on_page=None, profile=None):
+    images = pdf_to_images(pdf_bytes, dpi=dpi, profile=profile)
+    return ocr_pages(images, on_page=on_page, profile=profile)
+
+def ocr_invoice(pdf_bytes, supplier=AUTO_PROFILE, on_page=None, on_text=None, max_dpi=None, last_page=None,
+                on_supplier=None):
+    """
+    OCR with the supplier's profile. With AUTO_PROFILE, page 1 is read with the default
+    profile, the supplier is detected from it, and page 1 is only re-read if that
+    supplier's Tesseract settings differ. Returns (page_texts, supplier_or_None, page_count).
+    `on_text(i, text)` gets each page as soon as it is read, `on_supplier(name)` the
+    supplier as soon as it is known.
+    """
+    auto = supplier == AUTO_PROFILE or not supplier
+    profile = resolve_ocr_profile(None if auto else supplier)
+    images = pdf_to_images(pdf_bytes, profile=profile, max_dpi=max_dpi, last_page=last_page)
+    if not images: return [], None, 0
+    if not auto and on_supplier: on_supplier(supplier)
+
+    texts = []
+    if auto:
+        if on_page: on_page(0, len(images))
+        first = ocr_image(images[0], profile)
+        supplier = detect_supplier(first)
+        if supplier and on_supplier: on_supplier(supplier)
+        detected = resolve_ocr_profile(supplier)
+        if supplier and any(detected[k] != profile[k] for k in PAGE_SETTINGS):
+            first = ocr_image(images[0], detected)
+        profile = detected
+        texts.append(first)
+        if on_text: on_text(0, first)
+
+    for i in range(len(texts), len(images)):
+        if on_page: on_page(i, len(images))
+        texts.append(ocr_image(images[i], profile))
+        if on_text: on_text(i, texts[-1])
+    return texts, supplier, len(images)
@@ -0,0 +1,212 @@
+import os
+import re
+import time
+import queue
+import signal
+import threading
+import multiprocessing as mp
+
+from ocr import AUTO_PROFILE
+
+# ==========================================
+# OCR WORKER POOL (poppler + Tesseract outside the server process)
+# ==========================================
+# Rendering and Tesseract run in a few long-lived child processes shared by every
+# session on the server. Each child has an address-space cap, each job a wall-clock
+# limit and a per-page stall limit, and the PDF's page count and page size are checked
+# before anything is rendered. A child that times out, crashes or runs out of memory is
+# killed (with its pdftoppm / tesseract processes) and replaced; the pages it finished
+# still come back with the error. The text-layer probe for trailing T&Cs pages
+# (page_filter.ocr_page_limit) runs in the worker too.
+
+OCR_WORKERS = 2
+OCR_WORKER_MEMORY_MB = 2048        # RLIMIT_AS per worker; pdftoppm / tesseract inherit it
+OCR_WORKER_MAX_JOBS = 25           # recycle a worker after this many invoices
+OCR_JOB_TIMEOUT = 300              # seconds for a whole invoice
+OCR_PAGE_TIMEOUT = 90              # seconds without progress before a job counts as hung
+OCR_INFO_TIMEOUT = 20              # pdfinfo on a malformed file
+OCR_MAX_PAGES = 30                 # later pages are skipped and reported
+OCR_MAX_PAGE_PIXELS = 12_000_000   # ~A4 at 350dpi; bigger pages render at a lower dpi
+OCR_MIN_DPI = 100                  # a page that needs less than this is refused
+POINTS_PER_INCH = 72
+
+class OcrError(Exception):
+    """OCR failed or was stopped. `pages` / `plain` hold the pages read before that."""
+    def __init__(self, message, pages=None, plain=None, supplier=None):
+        super().__init__(message)
+        self.pages, self.plain, self.supplier = pages or [], plain or [], supplier
+
+# --- WORKER PROCESS ---
+def _limit_worker(memory_mb):
+    # One thread each for Tesseract / BLAS: the pool is the parallelism, and idle thread
+    # stacks would count against the address-space cap
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    os.environ["OPENBLAS_NUM_THREADS"] = "1"
+    try:
+        import resource
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        os.setpgrp()    # so a kill also reaches pdftoppm / tesseract
+    except (ImportError, ValueError, OSError):
+        pass            # no rlimits on this platform: timeouts and page guards still apply
+
+def page_guards(pdf_bytes):
+    """(last_page, max_dpi, notes) from pdfinfo alone, before any page is rendered."""
+    from ocr import pdf2image_api, resolve_ocr_profile
+    info = pdf2image_api()[1](pdf_bytes, timeout=OCR_INFO_TIMEOUT)
+    pages = int(info.get("Pages", 1))
+    last_page, max_dpi, notes = None, None, []
+    if pages > OCR_MAX_PAGES:
+        last_page = OCR_MAX_PAGES
+        notes.append(f"only the first {OCR_MAX_PAGES} of {pages} pages were read")
+    m = re.match(r"\s*([\d.]+) x ([\d.]+)", str(info.get("Page size", "")))
+    if m:
+        sq_inches = float(m.group(1)) * float(m.group(2)) / POINTS_PER_INCH ** 2
+        max_dpi = int((OCR_MAX_PAGE_PIXELS / sq_inches) ** 0.5) if sq_inches else None
+        if max_dpi and max_dpi < OCR_MIN_DPI:
+            raise ValueError(f"pages are too large to OCR ({m.group(1)} x {m.group(2)} pts)")
+        if max_dpi and max_dpi < resolve_ocr_profile()["dpi"]:
+            notes.append(f"large pages rendered at {max_dpi} dpi")
+    return last_page, max_dpi, notes
+
+def _run_job(conn, pdf_bytes, supplier, layout, trim_trailing=False):
+    from ocr import ocr_invoice
+    from layout import layout_invoice
+    from page_filter import ocr_page_limit
+    try:
+        last_page, max_dpi, notes = page_guards(pdf_bytes)
+        for note in notes: conn.send(("note", note))
+        if trim_trailing:
+            wanted, skipped = ocr_page_limit(pdf_bytes)
+            if wanted and (last_page is None or wanted < last_page):
+                conn.send(("skipped", [p for p in skipped if last_page is None or p <= last_page]))
+                last_page = wanted
+        on_page = lambda i, n: conn.send(("page", i, n))
+        # Sent as soon as page 1 is read, so a job that fails later still knows its supplier
+        on_supplier = lambda name: conn.send(("supplier", name))
+        if layout:
+            _, _, found, count = layout_invoice(
+                pdf_bytes, supplier, on_page, on_text=lambda i, c, p: conn.send(("text", i, c, p)),
+                max_dpi=max_dpi, last_page=last_page, on_supplier=on_supplier
+            )
+        else:
+            _, found, count = ocr_invoice(
+                pdf_bytes, supplier, on_page, on_text=lambda i, t: conn.send(("text", i, t, t)),
+                max_dpi=max_dpi, last_page=last_page, on_supplier=on_supplier
+            )
+        conn.send(("done", found, count))
+    except MemoryError:
+        conn.send(("error", f"ran out of memory (worker limit {OCR_WORKER_MEMORY_MB} MB)"))
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+
+def _worker_main(conn, memory_mb):
+    _limit_worker(memory_mb)
+    while True:
+        try: job = conn.recv()
+        except (EOFError, OSError): return
+        if job is None: return
+        _run_job(conn, *job)
+
+# --- POOL (server side) ---
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child = ctx.Pipe()
+        self.proc = ctx.Process(target=_worker_main, args=(child, OCR_WORKER_MEMORY_MB), name="ocr-worker", daemon=True)
+        self.proc.start()
+        child.close()
+        self.jobs = 0
+
+    def kill(self):
+        try: os.killpg(self.proc.pid, signal.SIGKILL)
+        except (OSError, AttributeError): self.proc.kill()
+        self.proc.join(5)
+        self.conn.close()
+
+class OcrPool:
+    """A fixed number of worker slots; a worker is started on first use and replaced after a failure."""
+    def __init__(self, workers=OCR_WORKERS):
+        self.ctx = mp.get_context("spawn")    # never fork the threaded server
+        self.slots = queue.Queue()
+        for _ in range(workers): self.slots.put(None)
+
+    def run(self, pdf_bytes, supplier=AUTO_PROFILE, layout=False, on_page=None, on_note=None,
+            trim_trailing=False, on_skipped=None):
+        """
+        (texts, plain_texts, supplier_or_None, page_count). With `trim_trailing`, trailing
+        irrelevant pages of a digital PDF are not rendered and `on_skipped(pages)` gets their
+        1-based numbers. Raises OcrError, with any pages read.
+        """
+        if self.slots.empty() and on_note: on_note("waiting for a free OCR worker")
+        worker = self.slots.get()
+        try:
+            if worker is None or not worker.proc.is_alive(): worker = _Worker(self.ctx)
+        except Exception:
+            self.slots.put(None)
+            raise
+        healthy = False
+        try:
+            result = self._run(worker, (pdf_bytes, supplier, layout, trim_trailing), on_page, on_note, on_skipped)
+            healthy = True
+            return result
+        finally:
+            worker.jobs += 1
+            if healthy and worker.jobs < OCR_WORKER_MAX_JOBS: self.slots.put(worker)
+            else:
+                worker.kill()
+                self.slots.put(None)
+
+    def _run(self, worker, job, on_page, on_note, on_skipped):
+        worker.conn.send(job)
+        texts, plain, found, page = {}, {}, None, (0, 0)
+        deadline = time.monotonic() + OCR_JOB_TIMEOUT
+
+        def failed(reason):
+            done = sorted(texts)
+            where = f" on page {page[0] + 1} of {page[1]}" if page[1] else ""
+            return OcrError(f"{reason}{where}", [texts[i] for i in done], [plain[i] for i in done], found)
+
+        while True:
+            wait = min(OCR_PAGE_TIMEOUT, deadline - time.monotonic())
+            if wait <= 0: raise failed(f"timed out after {OCR_JOB_TIMEOUT}s")
+            if not worker.conn.poll(wait):
+                raise failed(f"timed out after {OCR_JOB_TIMEOUT}s" if time.monotonic() >= deadline
+                             else f"no progress for {OCR_PAGE_TIMEOUT}s")
+            try: msg = worker.conn.recv()
+            except (EOFError, OSError):
+                worker.proc.join(1)
+                raise failed(f"OCR worker stopped unexpectedly (exit code {worker.proc.exitcode})")
+            kind = msg[0]
+            if kind == "page":
+                page = (msg[1], msg[2])
+                if on_page: on_page(*page)
+            elif kind == "text": texts[msg[1]], plain[msg[1]] = msg[2], msg[3]
+            elif kind == "supplier": found = msg[1]
+            elif kind == "note" and on_note: on_note(msg[1])
+            elif kind == "skipped" and on_skipped: on_skipped(msg[1])
+            elif kind == "error": raise failed(msg[1])
+            elif kind == "done":
+                done = sorted(texts)
+                return [texts[i] for i in done], [plain[i] for i in done], msg[1], msg[2]
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_ocr_pool():
+    """The server-wide pool, shared by every session."""
+    global _pool
+    with _pool_lock:
+        if _pool is None: _pool = OcrPool()
+    return _pool
+
+def pooled_ocr_invoice(pdf_bytes, supplier=AUTO_PROFILE, on_page=None, on_note=None,
+                       trim_trailing=False, on_skipped=None):
+    """ocr_invoice in a worker. Returns (page_texts, supplier_or_None, page_count); raises OcrError."""
+    texts, _, found, count = get_ocr_pool().run(pdf_bytes, supplier, False, on_page, on_note,
+                                                trim_trailing, on_skipped)
+    return texts, found, count
+
+def pooled_layout_invoice(pdf_bytes, supplier=AUTO_PROFILE, on_page=None, on_note=None,
+                          trim_trailing=False, on_skipped=None):
+    """layout_invoice in a worker. Returns (compact_texts, plain_texts, supplier_or_None, page_count)."""
+    return get_ocr_pool().run(pdf_bytes, supplier, True, on_page, on_note, trim_trailing, on_skipped)
@@ -0,0 +1,137 @@
+import re
+
+from ocr import is_digital_pdf, pdf_text_layer
+
+# ==========================================
+# PAGE FILTER (OCR pages -> only what Gemini needs)
+# ==========================================
+# Multi-page invoices carry remittance slips, T&Cs pages and the same letterhead,
+# VAT number and bank details on every page. Pages are classed by cheap heuristics
+# (rows with prices / quantities, header and boilerplate words): irrelevant pages are
+# dropped, and non-price lines repeated across pages are kept only where they first
+# appear. Page 1 is always kept. Trailing irrelevant pages of a digital PDF are found
+# from its text layer (in the OCR worker, see ocr_pool) and never rendered.
+
+PAGE_LINES, PAGE_HEADER, PAGE_OTHER, PAGE_IRRELEVANT = "lines", "header", "other", "irrelevant"
+
+MONEY_RE = re.compile(r"\d[\d,]*\.\d{2}\b")
+# A quantity first and a price later, e.g. "18 Jaipur Ecask 97.00 1,746.00"
+QTY_PRICE_RE = re.compile(r"^\s*\d+(?:\.\d+)?\b.*\d[\d,]*\.\d{2}\b")
+HEADER_CUES_RE = re.compile(
+    r"\b(invoice|inv\s*no|tax\s*point|issue\s*date|due\s*date|sub[\s-]*total|net\s*total|total|vat|amount\s*due|balance)\b",
+    re.IGNORECASE
+)
+BOILERPLATE_RE = re.compile(
+    r"\b(terms\s*(and|&)\s*conditions|conditions\s*of\s*sale|remittance\s*advice|please\s*detach|"
+    r"retention\s*of\s*title|data\s*protection|privacy\s*notice|returns\s*policy)\b", re.IGNORECASE
+)
+# A real totals row on a T&Cs / remittance page: "Sub Total 780.00", "Invoice total £936.00"
+TOTALS_ROW_RE = re.compile(
+    r"\b(sub[\s-]*total|net\s*total|total\s*net|invoice\s*total|gross\s*total)\b[^\n]*?\d[\d,]*\.\d{2}\b",
+    re.IGNORECASE
+)
+WORD_RE = re.compile(r"[A-Za-z]{3,}")
+# Layout mode section markers, "|" table rows and sizes ("50L", "24x33cl") are never
+# treated as repeats: the same product in another size is a different line item
+PROTECTED_RE = re.compile(r"\||^[A-Z][A-Z ()|]*:$|\d+(?:\.\d+)?\s*(?:cl|ml|l|x)\b", re.IGNORECASE)
+# The only parts of a line allowed to differ between pages
+PAGE_NO_RE = re.compile(r"\bpage\s*\d+(?:\s*(?:of|/)\s*\d+)?\b", re.IGNORECASE)
+DATE_RE = re.compile(r"\b\d{1,4}[/.-]\d{1,2}[/.-]\d{2,4}\b")
+
+MIN_REPEAT_CHARS = 4
+MIN_PAGE_CHARS = 40      # shorter pages with nothing recognisable are blank / footer only
+TOKEN_CHARS = 4          # rough chars per Gemini token, for reporting only
+PRE_OCR_MAX_PAGES = 200
+
+def is_item_row(line):
+    return bool(QTY_PRICE_RE.search(line) or len(MONEY_RE.findall(line)) >= 2)
+
+def item_rows(text):
+    return sum(1 for line in text.splitlines() if is_item_row(line))
+
+def product_rows(text):
+    # Stricter than item_rows: a quantity, a description and a price. A remittance slip's
+    # "Invoice 4412 ... 1,986.00 0.00 1,986.00" rows don't count
+    return sum(1 for line in text.splitlines() if QTY_PRICE_RE.search(line) and WORD_RE.search(line))
+
+def classify_page(text):
+    """
+    PAGE_LINES (has priced rows), PAGE_HEADER (invoice details / totals), PAGE_IRRELEVANT
+    or PAGE_OTHER (kept). T&Cs pages and remittance slips mention invoices, VAT and amounts
+    due, so they are irrelevant unless they carry product rows or a real totals row (a
+    totals page with a T&Cs footer). Other pages are irrelevant only when nearly empty.
+    """
+    if BOILERPLATE_RE.search(text):
+        if product_rows(text): return PAGE_LINES
+        return PAGE_HEADER if TOTALS_ROW_RE.search(text) else PAGE_IRRELEVANT
+    if item_rows(text): return PAGE_LINES
+    if HEADER_CUES_RE.search(text) or MONEY_RE.search(text): return PAGE_HEADER
+    return PAGE_IRRELEVANT if len(text.strip()) < MIN_PAGE_CHARS else PAGE_OTHER
+
+def repeat_key(line):
+    """Lines compared exactly apart from case, spacing, page numbers and dates; None = never a repeat."""
+    line = line.strip()
+    if len(line) < MIN_REPEAT_CHARS or MONEY_RE.search(line) or PROTECTED_RE.search(line): return None
+    line = DATE_RE.sub("<date>", PAGE_NO_RE.sub("<page>", line))
+    return re.sub(r"\s+", " ", line.lower())
+
+def strip_repeated_lines(pages):
+    """
+    (pages, removed): lines seen on an earlier page are dropped from later ones, except
+    a line straight after a priced row, which may be a wrapped description.
+    """
+    if len(pages) < 2: return pages, 0
+    seen, out, removed = set(), [], 0
+    for text in pages:
+        kept, keys, after_item = [], set(), False
+        for line in text.splitlines():
+            key = repeat_key(line)
+            if key and key in seen and not after_item:
+                removed += 1
+                continue
+            kept.append(line)
+            after_item = is_item_row(line)
+            if key: keys.add(key)
+        seen |= keys
+        out.append("\n".join(kept))
+    return out, removed
+
+def reduce_pages(pages, skipped_before_ocr=()):
+    """
+    (kept_texts, report) for the per-page OCR texts going to Gemini. The report holds
+    page kinds, dropped pages (1-based), repeated lines removed, chars and tokens saved.
+    """
+    kinds = [classify_page(t) for t in pages]
+    keep = [i for i, kind in enumerate(kinds) if i == 0 or kind != PAGE_IRRELEVANT]
+    kept, repeats = strip_repeated_lines([pages[i] for i in keep])
+    before = sum(len(t) for t in pages)
+    after = sum(len(t) for t in kept)
+    report = {
+        "kinds": kinds, "dropped_pages": [i + 1 for i in range(len(pages)) if i not in keep],
+        "skipped_before_ocr": list(skipped_before_ocr), "repeated_lines": repeats,
+        "chars_before": before, "chars_after": after, "tokens_saved": (before - after) // TOKEN_CHARS,
+    }
+    return kept, report
+
+def describe_reduction(report):
+    parts = []
+    if report["skipped_before_ocr"]: parts.append(f"skipped page(s) {', '.join(map(str, report['skipped_before_ocr']))} before OCR")
+    if report["dropped_pages"]: parts.append(f"dropped page(s) {', '.join(map(str, report['dropped_pages']))}")
+    if report["repeated_lines"]: parts.append(f"{report['repeated_lines']} repeated line(s)")
+    saved = f"{report['chars_before']:,} -> {report['chars_after']:,} chars, ~{report['tokens_saved']:,} tokens saved"
+    return f"{'; '.join(parts)} ({saved})" if parts else f"nothing to drop ({saved})"
+
+def ocr_page_limit(pdf_bytes):
+    """
+    (last_page, skipped) before OCR: the last page worth rendering, judged from the text
+    layer, and the 1-based pages after it. (None, []) for scans or when every page counts.
+    Runs pdftotext on the untrusted PDF, so it is called from the OCR worker job.
+    """
+    if not is_digital_pdf(pdf_bytes): return None, []
+    pages = pdf_text_layer(pdf_bytes, last_page=PRE_OCR_MAX_PAGES).split("\f")
+    if pages and not pages[-1].strip(): pages = pages[:-1]    # pdftotext ends every page with \f
+    if not 2 <= len(pages) < PRE_OCR_MAX_PAGES or not all(p.strip() for p in pages): return None, []
+    last = len(pages)
+    while last > 1 and classify_page(pages[last - 1]) == PAGE_IRRELEVANT: last -= 1
+    if last == len(pages): return None, []
+    return last, list(range(last + 1, len(pages) + 1))
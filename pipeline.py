@@ -0,0 +1,156 @@
+import time
+
+from ocr import pdf_page_count, AUTO_PROFILE
+from ocr_pool import pooled_ocr_invoice, pooled_layout_invoice, OcrError
+from knowledge_base import MODEL_TIERS
+from extraction import (
+    build_prompt_suffix, build_document_contents, stream_invoice_reply, build_invoice_frames,
+    choose_extraction_mode, EXTRACTION_MODE_LABELS, AUTO_MODE, route_model_tier, extract_with_escalation, AUTO_TIER
+)
+from reconciliation import match_key
+from supplier_parsers import parse_invoice_text
+from analytics import price_flags
+from page_filter import reduce_pages, describe_reduction
+
+# ==========================================
+# INVOICE PIPELINE (PDF -> header + lines, no UI)
+# ==========================================
+# Shared by the Process button in app.py, the background ingester (ingest.py) and bulk
+# batch extraction (batch.py). Progress goes through callbacks so the app can render it
+# and the command-line tools can log it.
+
+TEXT_MODES = ("ocr", "layout")
+
+def _noop(*args, **kwargs): pass
+
+def read_invoice(pdf_bytes, extraction_choice=AUTO_MODE, ocr_profile=AUTO_PROFILE, custom_rule="", log=_noop):
+    """
+    Everything before the Gemini call: mode choice, OCR, the supplier template, prompt
+    contents and the routed tier. Returns a dict with mode, supplier, data (the template
+    result, or None when Gemini is needed), contents, prompt_text (text modes), tier,
+    why, timings and ocr_notes. Raises OcrError when OCR fails before reading a page.
+    """
+    t_start = time.perf_counter()
+    timings, ocr_notes = {}, []
+    mode, doc_supplier = choose_extraction_mode(
+        extraction_choice, pdf_bytes, None if ocr_profile == AUTO_PROFILE else ocr_profile
+    )
+    read = {"mode": mode, "supplier": doc_supplier, "data": None, "contents": None, "prompt_text": None,
+            "tier": None, "why": "", "timings": timings, "ocr_notes": ocr_notes, "page_filter": None}
+
+    if mode in TEXT_MODES:
+        log("1. Converting PDF to Images (OCR Prep)...")
+        on_page = lambda i, n: log(f"   - Scanning page {i+1} of {n}...")
+
+        def on_note(note):
+            ocr_notes.append(note)
+            log(f"   - ⚠️ {note}")
+
+        # Trailing T&Cs / remittance pages of a digital PDF are never rendered
+        skipped = []
+        log("2. Extracting Text and Table Layout..." if mode == "layout" else "2. Extracting Text...")
+        try:
+            if mode == "layout":
+                prompt_texts, page_texts, ocr_supplier, _ = pooled_layout_invoice(
+                    pdf_bytes, ocr_profile, on_page, on_note, trim_trailing=True, on_skipped=skipped.extend
+                )
+            else:
+                page_texts, ocr_supplier, _ = pooled_ocr_invoice(
+                    pdf_bytes, ocr_profile, on_page, on_note, trim_trailing=True, on_skipped=skipped.extend
+                )
+                prompt_texts = page_texts
+        except OcrError as e:
+            if not e.pages: raise
+            on_note(f"OCR stopped ({e}); continuing with the {len(e.pages)} page(s) read")
+            prompt_texts, page_texts, ocr_supplier = e.pages, e.plain, e.supplier
+        timings["ocr"] = round(time.perf_counter() - t_start, 2)
+        if ocr_supplier: log(f"   - OCR profile: {ocr_supplier}")
+        full_text = "\n".join(page_texts) + "\n"
+        if mode == "layout":
+            compact = sum(len(t) for t in prompt_texts)
+            log(f"   - Layout text: {compact:,} chars vs {len(full_text):,} plain "
+                f"({1 - compact / max(len(full_text), 1):.0%} smaller)")
+        # --- PAGE FILTER (Irrelevant pages and repeated letterhead stay out of the prompt) ---
+        prompt_texts, read["page_filter"] = reduce_pages(prompt_texts, skipped)
+        log(f"   - Page filter: {describe_reduction(read['page_filter'])}")
+        prompt_text = "\n".join(prompt_texts) + "\n"
+        read.update(supplier=ocr_supplier, prompt_text=prompt_text)
+
+        # --- SUPPLIER TEMPLATE (No AI call when the layout is known) ---
+        if not custom_rule:
+            data, parse_note = parse_invoice_text(full_text, ocr_supplier)
+            if data:
+                log(f"3. Parsed with template: {parse_note}")
+                read["data"] = data
+                return read
+            log(f"   - Template skipped: {parse_note}")
+        read["contents"] = build_prompt_suffix(prompt_text, custom_rule)
+        read["tier"], read["why"] = route_model_tier(prompt_text, ocr_supplier)
+    else:
+        log(f"1-2. Skipping OCR ({EXTRACTION_MODE_LABELS[mode]})...")
+        read["contents"] = build_document_contents(pdf_bytes, custom_rule, mode)
+        read["tier"], read["why"] = route_model_tier(supplier=doc_supplier, pages=pdf_page_count(pdf_bytes))
+    return read
+
+def finish_invoice(data, master_suppliers=None, pdf_hash="", log=_noop):
+    """Parsed JSON -> (header_df, lines_df, extracted_keys), with the price history check."""
+    log("5. Finalizing Data...")
+    header_df, lines_df = build_invoice_frames(data, master_suppliers)
+    # As-extracted match keys, so editor corrections are learned for the raw spelling too
+    extracted_keys = {i: match_key(r) for i, r in zip(lines_df.index, lines_df.to_dict('records'))}
+    try:
+        flags = price_flags(header_df, lines_df, pdf_hash)
+        if flags.astype(bool).any():
+            lines_df['Price_Check'] = flags
+            log(f"   - ⚠️ {int(flags.astype(bool).sum())} price(s) differ from history")
+    except Exception as e:
+        log(f"   - Price history check skipped: {e}")
+    return header_df, lines_df, extracted_keys
+
+def invoice_meta(read, model, totals_ok, extracted_keys, **extra):
+    """The meta dict saved with an invoice in the history store."""
+    page_filter = read.get("page_filter") or {}
+    return {"mode": read["mode"], "model": model, "timings": read["timings"], "totals_ok": totals_ok,
+            "prompt_chars": len(read["prompt_text"]) if read["prompt_text"] else None, "ocr_notes": read["ocr_notes"],
+            "tokens_saved": page_filter.get("tokens_saved"), "dropped_pages": page_filter.get("dropped_pages"),
+            "extracted_keys": [[i, list(k)] for i, k in extracted_keys.items()], **extra}
+
+def process_pdf(pdf_bytes, client, extraction_choice=AUTO_MODE, ocr_profile=AUTO_PROFILE, model_choice=AUTO_TIER,
+                custom_rule="", master_suppliers=None, pdf_hash="",
+                log=_noop, on_header=None, on_line=None, on_generate=_noop):
+    """
+    OCR / template parser / routed Gemini -> frames. Returns a dict with header, lines,
+    extracted_keys and meta (mode, model, timings, totals_ok). `on_generate()` runs before
+    every Gemini attempt so a live preview can be cleared. Raises ValueError when no model
+    returns usable JSON, OcrError when OCR fails before reading a single page.
+    """
+    t_start = time.perf_counter()
+    read = read_invoice(pdf_bytes, extraction_choice, ocr_profile, custom_rule, log)
+    data, timings = read["data"], read["timings"]
+
+    used_model, totals_ok = ("template", True) if data else (None, False)
+    if data is None:
+        t_ai = time.perf_counter()
+        # --- GENERATION CALL (Routed model tier) ---
+        log("3. Sending Text to AI Model..." if read["mode"] in TEXT_MODES else "3. Sending Document to AI Model...")
+        tier, why = read["tier"], read["why"]
+        if model_choice != AUTO_TIER: tier, why = model_choice, "chosen in sidebar"
+        log(f"   - Starting on {MODEL_TIERS[tier]} ({why})")
+
+        def generate(model):
+            on_generate()
+            return stream_invoice_reply(client, model, read["contents"], on_header=on_header, on_line=on_line)
+
+        log("4. Parsing Response...")
+        data, used_model, attempts = extract_with_escalation(
+            generate, tier, on_attempt=lambda a: log(f"   - {a['model']}: {a['reason']} ({a['seconds']:.1f}s)")
+        )
+        totals_ok = attempts[-1]["ok"]
+        timings["ai"] = round(time.perf_counter() - t_ai, 2)
+
+    header_df, lines_df, extracted_keys = finish_invoice(data, master_suppliers, pdf_hash, log)
+    timings["total"] = round(time.perf_counter() - t_start, 2)
+    return {
+        "header": header_df, "lines": lines_df, "extracted_keys": extracted_keys,
+        "meta": invoice_meta(read, used_model, totals_ok, extracted_keys),
+    }
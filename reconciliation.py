@@ -0,0 +1,317 @@
+import streamlit as st
+import pandas as pd
+import re
+import hashlib
+from thefuzz import process, fuzz
+
+from integrations import fetch_shopify_products_by_vendor, get_cin7_product_id
+from rule_engine import resolve_format, volume_cl, parse_volume_cl, volumes_match, clean_name
+from storage import lookup_learned_matches, record_match_hits, remember_matches
+
+# ==========================================
+# RECONCILIATION & DATA CLEANING
+# ==========================================
+
+def normalize_vol_string(v_str):
+    if not v_str: return "0"
+    v_str = str(v_str).lower().strip()
+    nums = re.findall(r'\d+\.?\d*', v_str)
+    if not nums: return "0"
+    val = float(nums[0])
+    if "ml" in v_str: val = val / 10
+    if val.is_integer(): return str(int(val))
+    return str(val)
+
+RESULT_COLS = ['Shopify_Status', 'Matched_Product', 'Matched_Variant', 'Image', 'Shopify_Variant_ID',
+               'London_SKU', 'Cin7_London_ID', 'Gloucester_SKU', 'Cin7_Glou_ID']
+# storage.MATCH_VALUE_COLS <-> result columns
+LEARNED_COLS = {
+    'matched_product': 'Matched_Product', 'matched_variant': 'Matched_Variant', 'variant_id': 'Shopify_Variant_ID',
+    'image': 'Image', 'london_sku': 'London_SKU', 'cin7_london_id': 'Cin7_London_ID',
+    'glou_sku': 'Gloucester_SKU', 'cin7_glou_id': 'Cin7_Glou_ID',
+}
+
+# --- ROW FINGERPRINTS (Only re-check lines that changed) ---
+FINGERPRINT_COL = 'Check_Fingerprint'
+FINGERPRINT_COLS = ['Supplier_Name', 'Product_Name', 'Format', 'Pack_Size', 'Volume']
+
+def row_fingerprint(row):
+    raw = "\x1f".join(str(row.get(c, '') if pd.notna(row.get(c, '')) else '') for c in FINGERPRINT_COLS)
+    return hashlib.sha1(raw.encode()).hexdigest()[:12]
+
+def line_attributes(row):
+    """(inv_pack, inv_vol, canon_fmt, inv_fmt, inv_cl) for an invoice line, as matching sees it."""
+    raw_pack = str(row.get('Pack_Size', '')).strip()
+    inv_pack = "1" if raw_pack.lower() in ['none', 'nan', '', '0'] else raw_pack.replace('.0', '')
+    inv_vol = normalize_vol_string(row.get('Volume', ''))
+    canon_fmt, _ = resolve_format(row.get('Format', ''), row.get('Volume', ''))
+    inv_fmt = (canon_fmt or str(row.get('Format', ''))).lower()
+    inv_cl = volume_cl(canon_fmt, row.get('Volume', ''))
+    return inv_pack, inv_vol, canon_fmt, inv_fmt, inv_cl
+
+def match_key(row):
+    """Learned-match key: (supplier, normalized product, format, pack, volume)."""
+    inv_pack, inv_vol, _, inv_fmt, inv_cl = line_attributes(row)
+    product = clean_name(str(row.get('Product_Name', '') or '')).lower()
+    volume = f"{inv_cl:.1f}cl" if inv_cl else inv_vol
+    return (str(row.get('Supplier_Name', '') or '').strip().lower(), product, inv_fmt, inv_pack, volume)
+
+def prepare_candidates(products):
+    """Splits each Shopify title once per vendor ("Brewery / Product / Format" -> Product)."""
+    prepared = []
+    for edge in products:
+        prod = edge['node']
+        clean_name = prod['title']
+        if "/" in clean_name:
+            parts = [p.strip() for p in clean_name.split("/")]
+            if len(parts) >= 2: clean_name = parts[1]
+        prepared.append((prod, clean_name, clean_name.lower()))
+    return prepared
+
+def run_reconciliation_check(lines_df, use_learned=True, incremental=True):
+    """
+    Matches invoice lines to Shopify variants + Cin7 IDs. With `incremental`, lines that
+    are still ✅ Match and whose match columns are unchanged since the last check
+    (FINGERPRINT_COL) keep their result without any lookups.
+    """
+    if lines_df.empty: return lines_df, ["No Lines to check."]
+    logs = []
+    df = lines_df.copy()
+    records = df.to_dict('records')
+    fingerprints = [row_fingerprint(row) for row in records]
+    # Matches with no Cin7 ID at all (e.g. products just created in Shopify) are looked up
+    # again; a Gloucester-only product has just the Gloucester ID
+    keep = [
+        incremental and row.get(FINGERPRINT_COL) == fp and row.get('Shopify_Status') == "✅ Match"
+        and any(str(row.get(c) or '').strip() for c in ('Cin7_London_ID', 'Cin7_Glou_ID'))
+        for row, fp in zip(records, fingerprints)
+    ]
+    if any(keep): logs.append(f"♻️ {sum(keep)} unchanged matched line(s) kept.")
+
+    # --- LEARNED MATCHES FIRST (No Shopify fetch for lines seen before) ---
+    keys = [None if k else match_key(row) for row, k in zip(records, keep)]
+    learned = lookup_learned_matches([k for k in keys if k]) if use_learned else {}
+    if learned:
+        record_match_hits([k for k in keys if k in learned])
+        logs.append(f"📌 {sum(k in learned for k in keys)} line(s) resolved from learned matches.")
+
+    suppliers = list(dict.fromkeys(
+        row.get('Supplier_Name') for row, key in zip(records, keys)
+        if key and key not in learned and isinstance(row.get('Supplier_Name'), str) and row.get('Supplier_Name').strip()
+    ))
+    shopify_cache = {}
+    
+    progress_bar = st.progress(0)
+    for i, supplier in enumerate(suppliers):
+        progress_bar.progress((i)/len(suppliers))
+        logs.append(f"🔎 **Fetching Shopify Data:** `{supplier}`")
+        products = fetch_shopify_products_by_vendor(supplier)
+        shopify_cache[supplier] = prepare_candidates(products)
+        logs.append(f"   -> Found {len(products)} products.")
+    progress_bar.progress(1.0)
+
+    results = []
+    for row, key in zip(records, keys):
+        if key is None:
+            results.append(tuple(row.get(c, "") for c in RESULT_COLS))
+            continue
+        if key in learned:
+            hit = learned[key]
+            logs.append(f"📌 LEARNED: **{row['Product_Name']}** -> `{hit['matched_variant']}` | SKU: `{hit['london_sku']}`")
+            cin7_l_id = hit['cin7_london_id'] or (get_cin7_product_id(hit['london_sku']) if hit['london_sku'] else "")
+            cin7_g_id = hit['cin7_glou_id'] or (get_cin7_product_id(hit['glou_sku']) if hit['glou_sku'] else "")
+            results.append(("✅ Match", hit['matched_product'], hit['matched_variant'], hit['image'], hit['variant_id'],
+                            hit['london_sku'], cin7_l_id, hit['glou_sku'], cin7_g_id))
+            continue
+
+        status = "❓ Vendor Not Found"
+        london_sku, glou_sku, cin7_l_id, cin7_g_id, img_url, variant_id = "", "", "", "", "", ""
+        matched_prod_name, matched_var_name = "", ""
+        
+        supplier = str(row.get('Supplier_Name', ''))
+        inv_prod_name = row['Product_Name']
+        inv_pack, inv_vol, canon_fmt, inv_fmt, inv_cl = line_attributes(row)
+        
+        logs.append(f"Checking: **{inv_prod_name}** ({inv_fmt})")
+
+        if supplier in shopify_cache and shopify_cache[supplier]:
+            candidates = shopify_cache[supplier]
+            scored_candidates = []
+            inv_prod_lower = inv_prod_name.lower()
+            for prod, shop_prod_name_clean, shop_clean_lower in candidates:
+                score = fuzz.token_sort_ratio(inv_prod_name, shop_prod_name_clean)
+                if inv_prod_lower in shop_clean_lower: score += 10
+                if score > 40: scored_candidates.append((score, prod, shop_prod_name_clean))
+            
+            scored_candidates.sort(key=lambda x: x[0], reverse=True)
+            match_found = False
+            
+            for score, prod, clean_name in scored_candidates:
+                if score < 75: continue 
+                
+                shop_fmt_meta = prod.get('format_meta', {}).get('value', '') or ""
+                shop_title_lower = prod['title'].lower()
+                shop_format_str = f"{shop_fmt_meta} {shop_title_lower}".lower()
+                
+                is_compatible = True
+                if "steel" in inv_fmt:
+                    if "keykeg" in shop_format_str or "poly" in shop_format_str or "dolium" in shop_format_str: is_compatible = False
+                elif "keykeg" in inv_fmt:
+                    if "steel" in shop_format_str or "stainless" in shop_format_str: is_compatible = False
+                elif "cask" in inv_fmt or "firkin" in inv_fmt:
+                    if "keg" in shop_format_str and "cask" not in shop_format_str: is_compatible = False
+                
+                if not is_compatible: continue
+
+                for v_edge in prod['variants']['edges']:
+                    variant = v_edge['node']
+                    v_title = variant['title'].lower()
+                    v_sku = str(variant.get('sku', '')).strip()
+                    pack_ok = False
+                    if inv_pack == "1":
+                        if " x " not in v_title: pack_ok = True
+                    else:
+                        if f"{inv_pack} x" in v_title or f"{inv_pack}x" in v_title: pack_ok = True
+                    # Sizes compared in cl via the compiled rulebook (firkin/pin/gallons/litres)
+                    var_cl = parse_volume_cl(variant['title'])
+                    if inv_cl and var_cl: vol_ok = volumes_match(inv_cl, var_cl)
+                    else: vol_ok = inv_vol in v_title or (len(inv_vol) == 2 and f"{inv_vol}0" in v_title)
+                    
+                    if pack_ok and vol_ok:
+                        logs.append(f"   ✅ MATCH: `{variant['title']}` | SKU: `{v_sku}`")
+                        # --- UPDATE: GREEN STATUS ---
+                        status = "✅ Match"
+                        match_found = True
+                        full_title = prod['title']
+                        matched_prod_name = full_title[2:] if full_title.startswith("L-") or full_title.startswith("G-") else full_title
+                        matched_var_name = variant['title']
+                        variant_id = variant.get('id', '')
+                        if prod.get('featuredImage'): img_url = prod['featuredImage']['url']
+                        if v_sku and len(v_sku) > 2:
+                            base_sku = v_sku[2:]
+                            london_sku = f"L-{base_sku}"
+                            glou_sku = f"G-{base_sku}"
+                        break
+                if match_found: break
+            
+            # --- UPDATE: RED STATUS ---
+            if not match_found: 
+                status = "🟥 Check and Upload"
+        
+        if london_sku: cin7_l_id = get_cin7_product_id(london_sku)
+        if glou_sku: cin7_g_id = get_cin7_product_id(glou_sku)
+
+        results.append((status, matched_prod_name, matched_var_name, img_url, variant_id,
+                        london_sku, cin7_l_id, glou_sku, cin7_g_id))
+    
+    results_df = pd.DataFrame(results, columns=RESULT_COLS, index=df.index)
+    for col in RESULT_COLS: df[col] = results_df[col]
+    df[FINGERPRINT_COL] = fingerprints
+    return df, logs
+
+def remember_confirmed_matches(lines_df, source, original_keys=None):
+    """
+    Stores every ✅ Match line of `lines_df` in the learned-match store. `original_keys`
+    ({index: key} from extraction time) also teaches the as-extracted spelling of lines
+    the user corrected in the editor. Returns the number of keys written.
+    """
+    if lines_df is None or lines_df.empty or 'Shopify_Status' not in lines_df.columns: return 0
+    matched = lines_df[lines_df['Shopify_Status'] == "✅ Match"].fillna("")
+    found = []
+    for idx, row in zip(matched.index, matched.to_dict('records')):
+        values = {col: row.get(result_col, "") for col, result_col in LEARNED_COLS.items()}
+        if not values['matched_variant']: continue
+        key = match_key(row)
+        found.append((key, values))
+        orig = (original_keys or {}).get(idx)
+        if orig and tuple(orig) != key: found.append((tuple(orig), values))
+    return remember_matches(found, source)
+
+def normalize_supplier_names(df, master_list):
+    if df is None or df.empty or not master_list: return df
+    def match_name(name):
+        if not isinstance(name, str): return name
+        match, score = process.extractOne(name, master_list)
+        return match if score >= 88 else name
+    if 'Supplier_Name' in df.columns:
+        df['Supplier_Name'] = df['Supplier_Name'].apply(match_name)
+    return df
+
+MATRIX_KEYS = ['Supplier_Name', 'Collaborator', 'Product_Name', 'ABV']
+MATRIX_FIELDS = ['Format', 'Pack_Size', 'Volume', 'Item_Price', 'Create']
+MAX_FORMATS = 3
+
+def create_product_matrix(df, max_formats=MAX_FORMATS):
+    if df is None or df.empty: return pd.DataFrame()
+    df = df.fillna("")
+    # --- UPDATE: Check for "✅ Match" ---
+    if 'Shopify_Status' in df.columns:
+        df = df[df['Shopify_Status'] != "✅ Match"]
+    if df.empty: return pd.DataFrame()
+
+    # One row per product, its first `max_formats` lines pivoted into Format1..N columns
+    df = df.copy()
+    for c in MATRIX_KEYS + MATRIX_FIELDS[:-1]:
+        if c not in df.columns: df[c] = ""
+    grouped = df.groupby(MATRIX_KEYS, sort=False)
+    df['_group'] = grouped.ngroup()
+    df['_slot'] = grouped.cumcount() + 1
+    df = df[df['_slot'] <= max_formats]
+    df['Create'] = False
+
+    wide = df.pivot(index='_group', columns='_slot', values=MATRIX_FIELDS)
+    wide.columns = [f"{field}{slot}" for field, slot in wide.columns]
+    keys = df.drop_duplicates('_group').set_index('_group')[MATRIX_KEYS]
+    matrix_df = keys.join(wide).reset_index(drop=True)
+
+    format_cols = [f"{field}{i}" for i in range(1, max_formats + 1) for field in MATRIX_FIELDS]
+    final_cols = MATRIX_KEYS + [c for c in format_cols if c in matrix_df.columns]
+    return matrix_df[final_cols]
+
+# --- NEW PRODUCTS (Matrix Create boxes -> Shopify -> back into the lines) ---
+def matrix_to_new_products(matrix_df, max_formats=MAX_FORMATS):
+    """One dict per ticked Create{i} box: product, format, pack, volume, cost, label and SKU stem."""
+    from integrations import make_base_sku
+    if matrix_df is None or matrix_df.empty: return []
+    products = []
+    for row in matrix_df.fillna("").to_dict('records'):
+        for i in range(1, max_formats + 1):
+            if row.get(f"Create{i}") not in (True, "True") or not row.get(f"Format{i}"): continue
+            raw_pack = str(row.get(f"Pack_Size{i}", "")).strip().replace('.0', '')
+            pack = "" if raw_pack.lower() in ['none', 'nan', '', '0', '1'] else raw_pack
+            p = {
+                'Supplier_Name': row.get('Supplier_Name', ''), 'Product_Name': row.get('Product_Name', ''),
+                'Collaborator': row.get('Collaborator', ''),
+                'ABV': row.get('ABV') or row.get('Untappd_ABV', ''),
+                'Format': row[f"Format{i}"], 'Pack_Size': pack, 'Volume': row.get(f"Volume{i}", ''),
+                'Item_Price': row.get(f"Item_Price{i}", ''),
+                'Image': row.get('Label_Thumb', ''), 'Description': row.get('Untappd_Desc', ''),
+            }
+            p['Base_SKU'] = make_base_sku(p['Supplier_Name'], p['Product_Name'], p['Format'], p['Volume'], pack)
+            products.append(p)
+    return products
+
+def apply_created_products(lines_df, new_products, created):
+    """Marks the invoice lines behind each created product as ✅ Match with the new variant/SKUs."""
+    if lines_df is None or lines_df.empty or not created: return lines_df, 0
+    df = lines_df.copy()
+    for col in RESULT_COLS:
+        if col not in df.columns: df[col] = ""
+    df[RESULT_COLS] = df[RESULT_COLS].astype(object)
+    by_key = {}
+    for c in created:
+        if not c["variants"]: continue
+        by_key[match_key(new_products[c["index"]])] = (c, new_products[c["index"]], c["variants"][0])
+    updated = 0
+    for idx, row in zip(df.index, df.to_dict('records')):
+        hit = by_key.get(match_key(row))
+        if not hit: continue
+        c, p, variant = hit
+        sku = variant.get('sku') or ""
+        df.loc[idx, RESULT_COLS] = [
+            "✅ Match", c["title"], variant.get('title', ''), p.get('Image', ''), variant.get('id', ''),
+            sku, "", f"G-{sku[2:]}" if len(sku) > 2 else "", "",
+        ]
+        updated += 1
+    return df, updated
+
@@ -0,0 +1,174 @@
+import re
+import pandas as pd
+from functools import lru_cache
+
+from knowledge_base import VALID_FORMATS
+
+# ==========================================
+# COMPILED RULEBOOK (Machine-readable GLOBAL_RULES / VALID_FORMATS)
+# ==========================================
+# Everything here is compiled once at import. The same tables drive post-LLM
+# cleanup (normalize_lines) and Shopify matching (volume_cl / volumes_match).
+
+GALLON_CL = 454.609
+VOLUME_TOLERANCE = 0.005  # 33cl and 34cl cans are different variants
+CASK_TOLERANCE = 0.03     # nominal cask sizes: a "40.9L" or "41L" cask is a firkin
+# Named cask/keg sizes sold as each other: 41L Kegstar ~ 9 gallon firkin, 20L keg ~ 4.5 gallon pin
+EQUIVALENT_VOLUMES_CL = [(4100.0, 9 * GALLON_CL), (2000.0, 4.5 * GALLON_CL)]
+
+KEG_FORMATS = {"KeyKeg", "Steel Keg", "PolyKeg", "UniKeg", "Dolium Keg", "EcoKeg", "US Dolium Keg", "Bag in Box"}
+SMALL_PACK_FORMATS = {"Bottles", "Cans"}
+
+# --- VOLUME PARSING ---
+UNIT_TO_CL = {
+    "gallon": GALLON_CL, "gallons": GALLON_CL, "gal": GALLON_CL, "g": GALLON_CL,
+    "litre": 100.0, "litres": 100.0, "liter": 100.0, "liters": 100.0, "ltr": 100.0, "l": 100.0,
+    "cl": 1.0, "ml": 0.1,
+}
+VOLUME_RE = re.compile(r"(\d+(?:\.\d+)?)\s*(gallons?|gal|g|litres?|liters?|ltr|l|cl|ml)\b", re.IGNORECASE)
+PACK_VOLUME_RE = re.compile(r"\b(\d+)\s*x\s*(\d+(?:\.\d+)?)\s*(cl|ml)\b", re.IGNORECASE)
+NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+CASK_SIZE_WORDS = [(re.compile(r"\bfirkin\b", re.I), 9 * GALLON_CL), (re.compile(r"\bpin\b", re.I), 4.5 * GALLON_CL)]
+
+@lru_cache(maxsize=4096)
+def parse_volume_cl(text):
+    """Explicit volume in centilitres ('9 Gallon', '30L', '24x44cl', 'Firkin'), else None."""
+    if not isinstance(text, str) or not text: return None
+    m = PACK_VOLUME_RE.search(text)
+    if m: return float(m.group(2)) * UNIT_TO_CL[m.group(3).lower()]
+    m = VOLUME_RE.search(text)
+    if m: return float(m.group(1)) * UNIT_TO_CL[m.group(2).lower()]
+    for rx, cl in CASK_SIZE_WORDS:
+        if rx.search(text): return cl
+    return None
+
+def volume_cl(fmt, volume):
+    """Invoice volume in cl. Unit-less numbers are read in the context of the format."""
+    cl = parse_volume_cl(f"{volume or ''}") or parse_volume_cl(f"{fmt or ''}")
+    if cl is not None: return cl
+    m = NUMBER_RE.search(str(volume or ""))
+    if not m: return None
+    val = float(m.group())
+    if fmt == "Cask": return val * (GALLON_CL if val <= 18 else 100.0)
+    if fmt in KEG_FORMATS: return val * 100.0
+    if fmt in SMALL_PACK_FORMATS: return val / 10 if val >= 100 else val
+    return None
+
+def volumes_match(a_cl, b_cl, tolerance=VOLUME_TOLERANCE):
+    """Same size within `tolerance`, or the two sides of a named EQUIVALENT_VOLUMES_CL pair."""
+    if not a_cl or not b_cl: return False
+    if abs(a_cl - b_cl) <= tolerance * max(a_cl, b_cl): return True
+    near = lambda x, y: abs(x - y) <= VOLUME_TOLERANCE * max(x, y)
+    return any((near(a_cl, x) and near(b_cl, y)) or (near(a_cl, y) and near(b_cl, x)) for x, y in EQUIVALENT_VOLUMES_CL)
+
+# --- VALID FORMATS TABLE ---
+def parse_valid_formats(text):
+    rows = []
+    for line in text.strip().splitlines():
+        if "|" not in line: continue
+        fmt, vol = [p.strip() for p in line.split("|", 1)]
+        rows.append((fmt, vol, parse_volume_cl(vol)))
+    return rows
+
+VALID_FORMAT_TABLE = parse_valid_formats(VALID_FORMATS)
+VALID_FORMAT_NAMES = sorted({fmt for fmt, _, _ in VALID_FORMAT_TABLE})
+VALID_VOLUMES_BY_FORMAT = {}
+for _fmt, _vol, _cl in VALID_FORMAT_TABLE:
+    if _cl: VALID_VOLUMES_BY_FORMAT.setdefault(_fmt, []).append((_cl, _vol))
+
+def volume_label(fmt, cl):
+    """Canonical Volume string: the VALID_FORMATS spelling when one is close, else '30 Litre' / '44cl'."""
+    if cl is None: return None
+    for valid_cl, label in VALID_VOLUMES_BY_FORMAT.get(fmt, []):
+        if volumes_match(cl, valid_cl, 0.005): return label
+    if fmt == "Cask" and volumes_match(cl, 9 * GALLON_CL, CASK_TOLERANCE): return "9 Gallon"
+    if fmt == "Cask" and volumes_match(cl, 4.5 * GALLON_CL, CASK_TOLERANCE): return "4.5 Gallon"
+    if fmt in KEG_FORMATS or fmt == "Cask": return f"{cl / 100:g} Litre"
+    return f"{round(cl, 1):g}cl"
+
+# --- FORMAT ALIASES (GLOBAL RULES #2) ---
+# (pattern, Format, fixed Volume or None). First match wins, so specific names come first.
+FORMAT_ALIASES = [
+    (r"\bus\s*dolium\b", "US Dolium Keg", None),
+    (r"\bdolium\b", "Dolium Keg", None),
+    (r"\bkey\s*-?keg\b|\bkk\b", "KeyKeg", None),
+    (r"\bpoly\s*-?keg\b|\bpoly\b", "PolyKeg", None),
+    (r"\buni\s*-?keg\b", "UniKeg", None),
+    (r"\beco\s*-?keg\b", "EcoKeg", None),
+    (r"\bbag\s*in\s*box\b|\bbib\b", "Bag in Box", None),
+    (r"\bfirkin\b", "Cask", "9 Gallon"),
+    (r"\bpin\b", "Cask", "4.5 Gallon"),
+    (r"\be-?cask\b|\bcask\b", "Cask", None),
+    (r"\bkegstar\b", "Steel Keg", None),    # 41L Kegstar handled in resolve_format
+    (r"\bl?ss\b|\bsteel\b|\bstainless\b|\be-?keg\b", "Steel Keg", None),
+    (r"\bcans?\b", "Cans", None),
+    (r"\bbottles?\b|\bbtls?\b", "Bottles", None),
+    (r"\bkeg\b", "Steel Keg", None),
+    (r"\bcellar\s*equipment\b", "Cellar Equipment", None),
+]
+FORMAT_ALIAS_RULES = [(re.compile(p, re.IGNORECASE), fmt, vol) for p, fmt, vol in FORMAT_ALIASES]
+KEGSTAR_RE = re.compile(r"\bkegstar\b", re.IGNORECASE)
+
+def resolve_format(fmt_text, volume_text=""):
+    """(Format, Volume) in VALID_FORMATS terms; either part is None when it can't be resolved."""
+    fmt_text = "" if fmt_text is None or (isinstance(fmt_text, float) and pd.isna(fmt_text)) else str(fmt_text)
+    volume_text = "" if volume_text is None or (isinstance(volume_text, float) and pd.isna(volume_text)) else str(volume_text)
+    fmt, fixed_vol = None, None
+    for name in VALID_FORMAT_NAMES:
+        if fmt_text.strip().lower() == name.lower(): fmt = name
+    if not fmt:
+        combined = f"{fmt_text} {volume_text}"
+        for rx, name, vol in FORMAT_ALIAS_RULES:
+            if rx.search(combined):
+                fmt, fixed_vol = name, vol
+                break
+    cl = volume_cl(fmt, volume_text) or volume_cl(fmt, fmt_text)
+    if fmt == "Steel Keg" and KEGSTAR_RE.search(f"{fmt_text} {volume_text}") and volumes_match(cl, 9 * GALLON_CL, CASK_TOLERANCE):
+        return "Cask", "9 Gallon"
+    if fixed_vol: return fmt, fixed_vol
+    return fmt, volume_label(fmt, cl)
+
+# --- NAME CLEANING (GLOBAL RULES #1) ---
+NAME_NOISE_RE = re.compile(r"\b\d+x\d+cl\b|\b\d+g\b", re.IGNORECASE)
+NAME_PREFIX_RE = re.compile(r"^(?:(?:SRM-|NRB\b|30EK\b|9G\b)\s*)+", re.IGNORECASE)
+WHITESPACE_RE = re.compile(r"\s+")
+
+def clean_name(name):
+    if not isinstance(name, str): return name
+    name = NAME_NOISE_RE.sub("", name.replace("|", ""))
+    name = NAME_PREFIX_RE.sub("", name.strip())
+    return WHITESPACE_RE.sub(" ", name).strip()
+
+# ==========================================
+# DATAFRAME NORMALIZATION (Vectorized)
+# ==========================================
+
+def clean_name_series(series):
+    """Vectorized clean_name. Non-string cells are left untouched."""
+    is_str = series.map(type).eq(str)
+    if not is_str.any(): return series
+    s = series[is_str].str.replace("|", "", regex=False)
+    s = s.str.replace(NAME_NOISE_RE, "", regex=True).str.strip()
+    s = s.str.replace(NAME_PREFIX_RE, "", regex=True)
+    s = s.str.replace(WHITESPACE_RE, " ", regex=True).str.strip()
+    out = series.astype(object).copy()
+    out[is_str] = s
+    return out
+
+def normalize_formats(df):
+    """Maps Format/Volume onto VALID_FORMATS spellings. Resolves each distinct pair once."""
+    if df is None or df.empty or 'Format' not in df.columns: return df
+    vols = df['Volume'] if 'Volume' in df.columns else pd.Series("", index=df.index)
+    pairs = list(zip(df['Format'], vols))
+    resolved = {p: resolve_format(*p) for p in set(pairs)}
+    df['Format'] = [resolved[p][0] or p[0] for p in pairs]
+    if 'Volume' in df.columns:
+        df['Volume'] = [resolved[p][1] or p[1] for p in pairs]
+    return df
+
+def normalize_lines(df):
+    """Post-LLM cleanup: product names + format/volume canonicalisation."""
+    if df is None or df.empty: return df
+    if 'Product_Name' in df.columns:
+        df['Product_Name'] = clean_name_series(df['Product_Name'])
+    return normalize_formats(df)
@@ -0,0 +1,300 @@
+import io
+import os
+import json
+import sqlite3
+import hashlib
+import datetime
+from contextlib import contextmanager
+import pandas as pd
+
+# ==========================================
+# LOCAL STORAGE (SQLite under data/)
+# ==========================================
+# Set INVOICE_DATA_DIR to keep the databases on a persistent volume.
+
+DATA_DIR = os.environ.get("INVOICE_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+MATCH_DB = "matches.sqlite"
+
+def data_path(name):
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return os.path.join(DATA_DIR, name)
+
+@contextmanager
+def connect(db_name):
+    """`with connect(db) as conn:` commits on success, rolls back on error, and always closes."""
+    conn = sqlite3.connect(data_path(db_name), timeout=10)
+    try:
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn: yield conn
+    finally:
+        conn.close()
+
+def now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+
+# --- LEARNED MATCHES (Invoice line -> Shopify variant + Cin7 IDs) ---
+# Key: (supplier, product, format, pack, volume) as built by reconciliation.match_key
+MATCH_KEY_COLS = ("supplier", "product", "format", "pack", "volume")
+MATCH_VALUE_COLS = ("matched_product", "matched_variant", "variant_id", "image",
+                    "london_sku", "cin7_london_id", "glou_sku", "cin7_glou_id")
+
+def _init_matches(conn):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS learned_matches (
+            {", ".join(f"{c} TEXT NOT NULL" for c in MATCH_KEY_COLS)},
+            {", ".join(f"{c} TEXT" for c in MATCH_VALUE_COLS)},
+            source TEXT, hits INTEGER DEFAULT 0, updated_at TEXT,
+            PRIMARY KEY ({", ".join(MATCH_KEY_COLS)})
+        )""")
+
+def lookup_learned_matches(keys):
+    """{key: {value col: ...}} for the keys that have a remembered match."""
+    keys = list(set(keys))
+    if not keys: return {}
+    suppliers = sorted({k[0] for k in keys})
+    found = {}
+    with connect(MATCH_DB) as conn:
+        _init_matches(conn)
+        marks = ",".join("?" * len(suppliers))
+        rows = conn.execute(f"SELECT * FROM learned_matches WHERE supplier IN ({marks})", suppliers).fetchall()
+    wanted = set(keys)
+    for r in rows:
+        key = tuple(r[c] for c in MATCH_KEY_COLS)
+        if key in wanted: found[key] = {c: r[c] or "" for c in MATCH_VALUE_COLS}
+    return found
+
+def record_match_hits(keys):
+    if not keys: return
+    with connect(MATCH_DB) as conn:
+        _init_matches(conn)
+        conn.executemany(
+            f"UPDATE learned_matches SET hits = hits + 1 WHERE {' AND '.join(f'{c} = ?' for c in MATCH_KEY_COLS)}",
+            list(keys),
+        )
+
+def remember_matches(records, source):
+    """records: [(key, {value col: ...})]. Newer confirmations overwrite older ones."""
+    if not records: return 0
+    cols = MATCH_KEY_COLS + MATCH_VALUE_COLS + ("source", "updated_at")
+    updates = ", ".join(f"{c} = excluded.{c}" for c in MATCH_VALUE_COLS + ("source", "updated_at"))
+    stamp = now_iso()
+    rows = [tuple(key) + tuple(str(values.get(c) or "") for c in MATCH_VALUE_COLS) + (source, stamp)
+            for key, values in records]
+    with connect(MATCH_DB) as conn:
+        _init_matches(conn)
+        conn.executemany(
+            f"INSERT INTO learned_matches ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))}) "
+            f"ON CONFLICT ({', '.join(MATCH_KEY_COLS)}) DO UPDATE SET {updates}",
+            rows,
+        )
+    return len(rows)
+
+def forget_matches(keys):
+    if not keys: return
+    with connect(MATCH_DB) as conn:
+        _init_matches(conn)
+        conn.executemany(
+            f"DELETE FROM learned_matches WHERE {' AND '.join(f'{c} = ?' for c in MATCH_KEY_COLS)}",
+            list(keys),
+        )
+
+# --- PO EXPORT LEDGER (One Cin7 PO per supplier + invoice number + PDF + location) ---
+EXPORT_DB = "exports.sqlite"
+EXPORT_KEY_COLS = ("supplier_id", "invoice_number", "pdf_hash", "location")
+CLAIM_TIMEOUT_SECONDS = 300   # an in-flight claim older than this is treated as abandoned
+# "submitting": header POST in flight; "submitting_lines": lines POST in flight on a task
+IN_FLIGHT_STATUSES = ("submitting", "submitting_lines")
+
+def _init_exports(conn):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS po_exports (
+            {", ".join(f"{c} TEXT NOT NULL" for c in EXPORT_KEY_COLS)},
+            status TEXT, task_id TEXT, message TEXT, lines INTEGER, created_at TEXT, updated_at TEXT,
+            PRIMARY KEY ({", ".join(EXPORT_KEY_COLS)})
+        )""")
+
+def _export_where():
+    return " AND ".join(f"{c} = ?" for c in EXPORT_KEY_COLS)
+
+def get_export(key):
+    with connect(EXPORT_DB) as conn:
+        _init_exports(conn)
+        row = conn.execute(f"SELECT * FROM po_exports WHERE {_export_where()}", tuple(key)).fetchone()
+    return dict(row) if row else None
+
+def claim_export(key):
+    """
+    Atomically marks `key` as "submitting" unless a live entry exists. Returns (claimed, entry):
+    claimed=False with the existing entry when it is complete or another submit is in flight.
+    Entries left at "header_created" are claimed as "submitting_lines" so the caller can
+    resume them, and are then in flight like any other claim.
+    """
+    stamp = now_iso()
+    with connect(EXPORT_DB) as conn:
+        _init_exports(conn)
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(f"SELECT * FROM po_exports WHERE {_export_where()}", tuple(key)).fetchone()
+        entry = dict(row) if row else None
+        if entry:
+            if entry["status"] == "complete": return False, entry
+            if entry["status"] in IN_FLIGHT_STATUSES:
+                age = (datetime.datetime.fromisoformat(stamp) - datetime.datetime.fromisoformat(entry["updated_at"])).total_seconds()
+                if age < CLAIM_TIMEOUT_SECONDS: return False, entry
+            # A created header keeps its task_id and resumes with the lines; failed/stale claims start again
+            status = "submitting_lines" if entry["task_id"] else "submitting"
+            conn.execute(f"UPDATE po_exports SET status = ?, updated_at = ? WHERE {_export_where()}", (status, stamp) + tuple(key))
+            entry.update(status=status, updated_at=stamp)
+            return True, entry
+        conn.execute(
+            f"INSERT INTO po_exports ({', '.join(EXPORT_KEY_COLS)}, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            tuple(key) + ("submitting", stamp, stamp),
+        )
+        return True, {"status": "submitting", "task_id": None}
+
+def record_export(key, status, task_id=None, message="", lines=None):
+    with connect(EXPORT_DB) as conn:
+        _init_exports(conn)
+        conn.execute(
+            f"UPDATE po_exports SET status = ?, task_id = COALESCE(?, task_id), message = ?, "
+            f"lines = COALESCE(?, lines), updated_at = ? WHERE {_export_where()}",
+            (status, task_id, message, lines, now_iso()) + tuple(key),
+        )
+
+def list_exports(limit=200):
+    with connect(EXPORT_DB) as conn:
+        _init_exports(conn)
+        rows = conn.execute("SELECT * FROM po_exports ORDER BY updated_at DESC LIMIT ?", (limit,)).fetchall()
+    return [dict(r) for r in rows]
+
+# --- PROCESSED INVOICE HISTORY (Keyed by PDF SHA-256) ---
+HISTORY_DB = "invoices.sqlite"
+
+def _init_history(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS invoices (
+            pdf_hash TEXT PRIMARY KEY, pdf_md5 TEXT, source_name TEXT, drive_id TEXT,
+            supplier TEXT, invoice_number TEXT, lines INTEGER, matched INTEGER,
+            header_json TEXT, lines_json TEXT, meta_json TEXT,
+            processed_at TEXT, updated_at TEXT
+        )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS invoices_drive ON invoices (drive_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS invoices_md5 ON invoices (pdf_md5)")
+
+def pdf_hashes(pdf_bytes):
+    """(sha256, md5). md5 is what Drive reports as md5Checksum, so listings match without a download."""
+    return hashlib.sha256(pdf_bytes).hexdigest(), hashlib.md5(pdf_bytes).hexdigest()
+
+def save_invoice(pdf_hash, header_df, lines_df, pdf_md5="", source_name="", drive_id="", meta=None):
+    """Insert or refresh an invoice. Keeps the first processed_at and any earlier meta keys."""
+    matched = int((lines_df['Shopify_Status'] == "✅ Match").sum()) if 'Shopify_Status' in lines_df.columns else 0
+    header = header_df.iloc[0] if not header_df.empty else {}
+    stamp = now_iso()
+    with connect(HISTORY_DB) as conn:
+        _init_history(conn)
+        old = conn.execute("SELECT meta_json FROM invoices WHERE pdf_hash = ?", (pdf_hash,)).fetchone()
+        merged = json.loads(old["meta_json"]) if old and old["meta_json"] else {}
+        merged.update(meta or {})
+        conn.execute("""
+            INSERT INTO invoices (pdf_hash, pdf_md5, source_name, drive_id, supplier, invoice_number, lines, matched,
+                                  header_json, lines_json, meta_json, processed_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (pdf_hash) DO UPDATE SET
+                pdf_md5 = COALESCE(NULLIF(excluded.pdf_md5, ''), pdf_md5),
+                source_name = COALESCE(NULLIF(excluded.source_name, ''), source_name),
+                drive_id = COALESCE(NULLIF(excluded.drive_id, ''), drive_id),
+                supplier = excluded.supplier, invoice_number = excluded.invoice_number,
+                lines = excluded.lines, matched = excluded.matched,
+                header_json = excluded.header_json, lines_json = excluded.lines_json,
+                meta_json = excluded.meta_json, updated_at = excluded.updated_at
+        """, (
+            pdf_hash, pdf_md5, source_name, drive_id or "", str(header.get('Payable_To', '') or ''),
+            str(header.get('Invoice_Number', '') or ''), len(lines_df), matched,
+            header_df.to_json(orient="split"), lines_df.to_json(orient="split"), json.dumps(merged, default=str),
+            stamp, stamp,
+        ))
+
+def find_invoice(pdf_hash=None, drive_id=None, pdf_md5=None):
+    """Summary row (no frames) of a saved invoice, or None."""
+    clauses = [(c, v) for c, v in (("pdf_hash", pdf_hash), ("drive_id", drive_id), ("pdf_md5", pdf_md5)) if v]
+    if not clauses: return None
+    with connect(HISTORY_DB) as conn:
+        _init_history(conn)
+        row = conn.execute(
+            "SELECT pdf_hash, source_name, supplier, invoice_number, lines, matched, processed_at, updated_at "
+            f"FROM invoices WHERE {' OR '.join(f'{c} = ?' for c, _ in clauses)} ORDER BY updated_at DESC LIMIT 1",
+            [v for _, v in clauses],
+        ).fetchone()
+    return dict(row) if row else None
+
+def load_invoice(pdf_hash):
+    """(header_df, lines_df, meta) for a saved invoice, or None."""
+    with connect(HISTORY_DB) as conn:
+        _init_history(conn)
+        row = conn.execute("SELECT header_json, lines_json, meta_json FROM invoices WHERE pdf_hash = ?", (pdf_hash,)).fetchone()
+    if not row: return None
+    header_df = pd.read_json(io.StringIO(row["header_json"]), orient="split", dtype=False)
+    lines_df = pd.read_json(io.StringIO(row["lines_json"]), orient="split", dtype=False)
+    return header_df, lines_df, json.loads(row["meta_json"] or "{}")
+
+def saved_invoice_hashes():
+    with connect(HISTORY_DB) as conn:
+        _init_history(conn)
+        return [r["pdf_hash"] for r in conn.execute("SELECT pdf_hash FROM invoices ORDER BY processed_at")]
+
+def processed_drive_files():
+    """{drive_id: summary} and {md5: summary} for marking Drive listings."""
+    with connect(HISTORY_DB) as conn:
+        _init_history(conn)
+        rows = conn.execute("SELECT drive_id, pdf_md5, supplier, invoice_number, matched, lines, updated_at FROM invoices").fetchall()
+    by_id = {r["drive_id"]: dict(r) for r in rows if r["drive_id"]}
+    by_md5 = {r["pdf_md5"]: dict(r) for r in rows if r["pdf_md5"]}
+    return by_id, by_md5
+
+# --- BATCH JOBS (Gemini batch API submissions awaiting results) ---
+def _init_batches(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS batch_jobs (
+            name TEXT PRIMARY KEY, tier TEXT, model TEXT, state TEXT, items_json TEXT,
+            summary_json TEXT, created_at TEXT, updated_at TEXT, finished_at TEXT
+        )""")
+
+def record_batch_job(name, tier, model, items, state="JOB_STATE_PENDING"):
+    stamp = now_iso()
+    with connect(HISTORY_DB) as conn:
+        _init_batches(conn)
+        conn.execute(
+            "INSERT OR REPLACE INTO batch_jobs (name, tier, model, state, items_json, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (name, tier, model, state, json.dumps(items, default=str), stamp, stamp),
+        )
+
+def update_batch_job(name, state, summary=None, finished=False):
+    stamp = now_iso()
+    with connect(HISTORY_DB) as conn:
+        _init_batches(conn)
+        conn.execute(
+            "UPDATE batch_jobs SET state = ?, summary_json = COALESCE(?, summary_json), updated_at = ?, "
+            "finished_at = CASE WHEN ? THEN ? ELSE finished_at END WHERE name = ?",
+            (state, json.dumps(summary) if summary is not None else None, stamp, finished, stamp, name),
+        )
+
+def list_batch_jobs(open_only=False, limit=100):
+    """Newest first; items_json is decoded into `items`."""
+    with connect(HISTORY_DB) as conn:
+        _init_batches(conn)
+        rows = conn.execute(
+            f"SELECT * FROM batch_jobs {'WHERE finished_at IS NULL' if open_only else ''} ORDER BY created_at DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+    jobs = []
+    for r in rows:
+        job = dict(r)
+        job["items"] = json.loads(job.pop("items_json") or "[]")
+        job["summary"] = json.loads(job.pop("summary_json") or "null")
+        jobs.append(job)
+    return jobs
+
+def queued_invoice_hashes():
+    """PDF hashes waiting in unfinished batch jobs, so a re-run does not submit them twice."""
+    return {item["key"] for job in list_batch_jobs(open_only=True, limit=10000) for item in job["items"]}
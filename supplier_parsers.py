@@ -0,0 +1,171 @@
+import re
+
+from rule_engine import resolve_format
+
+# ==========================================
+# DETERMINISTIC SUPPLIER PARSERS (Skip the LLM)
+# ==========================================
+# A parser turns OCR text into the same {"header": {...}, "line_items": [...]} shape
+# the AI returns. It is only trusted when enough candidate rows parsed AND the lines
+# add up to Total_Net; otherwise the caller falls back to Gemini.
+
+PARSERS = {}
+
+MIN_CONFIDENCE = 0.9
+TOTAL_TOLERANCE = 0.01   # 1% of Total_Net (min £1.00)
+
+def register_parser(supplier):
+    """Decorator: registers fn(text) -> (data, confidence) for a SUPPLIER_RULEBOOK key."""
+    def wrap(fn):
+        PARSERS[supplier] = fn
+        return fn
+    return wrap
+
+def to_number(s):
+    if s is None: return None
+    s = str(s).replace("£", "").replace(",", "").strip()
+    try: return float(s)
+    except ValueError: return None
+
+# --- GENERIC HEADER ---
+# Single-line patterns ([ \t] not \s) so a column title can't grab the next row's number
+HEADER_PATTERNS = {
+    "Invoice_Number": r"invoice[ \t]*(?:no\.?|number|#)?[ \t]*[:\-]?[ \t]*([A-Z]{0,4}-?\d[\w\-/]*)",
+    "Issue_Date": r"(?:issue[ \t]*date|invoice[ \t]*date|date)[ \t]*[:\-]?[ \t]*(\d{1,2}[/.\-]\d{1,2}[/.\-]\d{2,4})",
+    "Due_Date": r"due(?:[ \t]*date)?[ \t]*[:\-]?[ \t]*(\d{1,2}[/.\-]\d{1,2}[/.\-]\d{2,4})",
+    "Payment_Terms": r"payment[ \t]*terms[ \t]*[:\-]?[ \t]*(\d+[ \t]*days?)",
+    "Total_Net": r"(?:net[ \t]*total|total[ \t]*net|sub[ \t]*-?total)[ \t]*[:\-]?[ \t]*£?[ \t]*([\d,]+\.\d{2})",
+    "Total_VAT": r"\bvat\b(?:[ \t]*total)?[ \t]*[:\-]?[ \t]*£?[ \t]*([\d,]+\.\d{2})",
+    "Total_Gross": r"(?:gross[ \t]*total|total[ \t]*gross|invoice[ \t]*total|(?<!sub)(?<!net )total)[ \t]*[:\-]?[ \t]*£?[ \t]*([\d,]+\.\d{2})",
+    "Shipping_Charge": r"(?:delivery|carriage|shipping)[ \t]*(?:charge)?[ \t]*[:\-]?[ \t]*£?[ \t]*([\d,]+\.\d{2})",
+}
+HEADER_REGEXES = {k: re.compile(p, re.IGNORECASE) for k, p in HEADER_PATTERNS.items()}
+MONEY_FIELDS = ("Total_Net", "Total_VAT", "Total_Gross", "Shipping_Charge")
+
+def extract_header(text, payable_to):
+    header = {
+        "Payable_To": payable_to, "Invoice_Number": "", "Issue_Date": "", "Payment_Terms": "", "Due_Date": "",
+        "Total_Net": None, "Total_VAT": 0.0, "Total_Gross": None, "Total_Discount_Amount": 0.0, "Shipping_Charge": 0.0,
+    }
+    for field, rx in HEADER_REGEXES.items():
+        m = rx.search(text)
+        if not m: continue
+        header[field] = to_number(m.group(1)) if field in MONEY_FIELDS else m.group(1).strip()
+    return header
+
+# --- VALIDATION ---
+def lines_total(line_items):
+    return round(sum((to_number(l.get("Quantity")) or 0) * (to_number(l.get("Item_Price")) or 0) for l in line_items), 2)
+
+def check_totals(data, require_net=True):
+    """
+    (ok, reason). Lines plus shipping, less any header discount, must match Total_Net
+    (a net quoted before the discount is accepted too). Without a Total_Net the result
+    is `not require_net`: templates must have one, an LLM reply may not.
+    """
+    header = data.get("header", {})
+    net = to_number(header.get("Total_Net"))
+    if not net: return (False, "no Total_Net") if require_net else (True, "no Total_Net to check")
+    expected = net - (to_number(header.get("Shipping_Charge")) or 0)
+    discount = abs(to_number(header.get("Total_Discount_Amount")) or 0)
+    got = lines_total(data.get("line_items", []))
+    tolerance = max(net * TOTAL_TOLERANCE, 1.0)
+    if min(abs(got - expected), abs(got - discount - expected)) > tolerance:
+        return False, f"lines {got:.2f} != net {expected:.2f}" + (f" (discount {discount:.2f})" if discount else "")
+    return True, "totals match"
+
+def parse_invoice_text(text, supplier):
+    """
+    Runs the registered parser for `supplier`. Returns (data, reason); data is None
+    when there is no parser or the result is not trustworthy (use the LLM instead).
+    """
+    parser = PARSERS.get(supplier)
+    if not parser: return None, f"no parser for {supplier or 'unknown supplier'}"
+    try:
+        data, confidence = parser(text)
+    except Exception as e:
+        return None, f"parser error: {e}"
+    if not data or not data.get("line_items"): return None, "parser found no lines"
+    if confidence < MIN_CONFIDENCE: return None, f"low confidence ({confidence:.0%})"
+    ok, reason = check_totals(data)
+    if not ok: return None, reason
+    return data, f"{supplier} parser ({len(data['line_items'])} lines, {reason})"
+
+def make_line(supplier_name, product, abv, fmt, volume, qty, price, pack=None, collaborator=""):
+    return {
+        "Supplier_Name": supplier_name, "Collaborator": collaborator, "Product_Name": product, "ABV": abv,
+        "Format": fmt, "Pack_Size": pack, "Volume": volume, "Quantity": qty, "Item_Price": price,
+    }
+
+# ==========================================
+# SUPPLIER TEMPLATES
+# ==========================================
+
+# --- THORNBRIDGE ---
+# 18.0000 0.0000 18.0000B/JAIP-ECA09-059 Jaipur Ecask - 5.9% ABV 9 Gallon 97.00 ECask 1,746.00
+THORNBRIDGE_ROW = re.compile(
+    r"^(?P<qty>\d+\.\d{4})\s+\d+\.\d{4}\s+\d+\.\d{4}\s*(?P<code>[A-Z]/[A-Z0-9\-]+)\s+"
+    r"(?P<desc>.+?)\s*-\s*(?P<abv>\d+(?:\.\d+)?)%\s*ABV\s+"
+    r"(?P<vol>\d+(?:\.\d+)?\s*(?:Gallon|Litre|Ltr|L|cl|ml))\s+"
+    r"(?P<price>[\d,]+\.\d{2})\s+(?P<unit>\S+)\s+(?P<total>[\d,]+\.\d{2})\s*$",
+    re.IGNORECASE,
+)
+THORNBRIDGE_CANDIDATE = re.compile(r"^\d+\.\d{4}\s+\d+\.\d{4}")
+THORNBRIDGE_FORMATS = [("ecask", "Cask"), ("ekeg", "Steel Keg"), ("keg", "KeyKeg"), ("cask", "Cask")]
+KELHAM_PRODUCTS = ("pale rider", "easy rider")
+
+@register_parser("Thornbridge Brewery")
+def parse_thornbridge(text):
+    lines, candidates = [], 0
+    for raw in text.splitlines():
+        raw = raw.strip()
+        if not THORNBRIDGE_CANDIDATE.match(raw): continue
+        candidates += 1
+        m = THORNBRIDGE_ROW.match(raw)
+        if not m: continue
+        desc = m.group("desc").strip()
+        fmt = None
+        for suffix, name in THORNBRIDGE_FORMATS:
+            if desc.lower().endswith(" " + suffix):
+                desc, fmt = desc[: -len(suffix)].strip(), name
+                break
+        if not fmt: continue
+        brewery = "Kelham Island Brewery" if desc.lower() in KELHAM_PRODUCTS else "Thornbridge Brewery"
+        lines.append(make_line(
+            brewery, desc, f"{m.group('abv')}%", fmt, m.group("vol").strip(),
+            to_number(m.group("qty")), to_number(m.group("price")),
+        ))
+    confidence = len(lines) / candidates if candidates else 0.0
+    return {"header": extract_header(text, "Thornbridge Brewery"), "line_items": lines}, confidence
+
+# --- BEAK ---
+# QTY ITEM UNIT PRICE DISCOUNT VAT LINE PRICE
+# 3 Aloft 5% DDH pale - 30L SS £135.00 £16.875 / 12.5% 20% £354.38
+BEAK_ROW = re.compile(
+    r"^(?P<qty>\d+)\s+(?P<desc>.+?)\s+£(?P<unit>[\d,]+\.\d+)\s+£(?P<disc>[\d,]*\.?\d+)\s*/\s*(?P<pct>[\d.]+)%"
+    r"\s+(?P<vat>\d+)%\s+£(?P<total>[\d,]+\.\d{2})\s*$"
+)
+BEAK_CANDIDATE = re.compile(r"^\d+\s+.+£[\d,]+\.\d{2}\s*$")
+BEAK_DESC = re.compile(r"^(?P<name>.+?)\s+(?P<abv>\d+(?:\.\d+)?)%.*?-\s*(?P<fmt>[^-]+)$")
+@register_parser("The Beak Brewery Limited")
+def parse_beak(text):
+    lines, candidates, discount = [], 0, 0.0
+    for raw in text.splitlines():
+        raw = raw.strip()
+        if not BEAK_CANDIDATE.match(raw): continue
+        candidates += 1
+        m = BEAK_ROW.match(raw)
+        if not m: continue
+        d = BEAK_DESC.match(m.group("desc"))
+        if not d: continue
+        fmt, volume = resolve_format(d.group("fmt"))   # "30L SS", "Firkin", ...
+        if not fmt or not volume: continue
+        qty = int(m.group("qty"))
+        discount += (to_number(m.group("disc")) or 0) * qty
+        # Rulebook: item price is the line price divided by the quantity
+        price = round(to_number(m.group("total")) / qty, 2) if qty else 0.0
+        lines.append(make_line("The Beak Brewery", d.group("name").strip(), f"{d.group('abv')}%", fmt, volume, qty, price))
+    data = {"header": extract_header(text, "The Beak Brewery Limited"), "line_items": lines}
+    data["header"]["Total_Discount_Amount"] = round(discount, 2)
+    confidence = len(lines) / candidates if candidates else 0.0
+    return data, confidence